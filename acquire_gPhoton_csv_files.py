@@ -1,15 +1,31 @@
 import os
 import sys
 import re
+import json
+import time
+import queue
+import shutil
+import tempfile
+import threading
+import http.server
 import requests
 import csv
 import argparse
+import resource
 from uuid import uuid4
 import multiprocessing as mp
 import numpy as np
 import pandas as pd
 import pyarrow as pa
-import pyarrow.parquet as pq
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import tracing
+from ingest_metrics import IngestMetrics, combine_summaries, format_summary
+from gphoton_schema import header, header_dtypes, schema
+from partition_layout import PartitionRouter
+from pipeline import Pipeline, Stage, StageCounter
+from parquet_profiles import profiles, write_table
+from sky_index import healpix_nest
 
 parser = argparse.ArgumentParser(description='Get path to TXT file containing names of CSVs to be downloaded.')
 parser.add_argument('txt_file', help='Path to TXT file.')
@@ -18,14 +34,58 @@ parser.add_argument('-t', '--test', action='store_true',
                     help='To test the search_partitions function. If flagged, only test will be run.')
 parser.add_argument('-m', '--multiprocessing', action='store_true',
                     help='To parallelize the downloads.')
+parser.add_argument('-b', '--block', action='store_true',
+                    help='Parse the CSVs in large blocks into typed columns instead of row by row.')
+parser.add_argument('-s', '--blocksize', default=64, type=int, metavar='',
+                    help='Size in MB of the blocks read when --block is flagged (default: 64).')
+parser.add_argument('-P', '--pipeline', action='store_true',
+                    help='Download, parse and write in concurrent stages connected by bounded queues (implies --block).')
+parser.add_argument('--parsers', default=2, type=int, metavar='',
+                    help='Number of parser threads when --pipeline is flagged (default: 2).')
+parser.add_argument('--writers', default=2, type=int, metavar='',
+                    help='Number of Parquet writer threads when --pipeline is flagged (default: 2).')
+parser.add_argument('--queuedepth', default=4, type=int, metavar='',
+                    help='Number of items each stage can queue before the stage feeding it waits (default: 4).')
+parser.add_argument('-W', '--writer', default='default', choices=sorted(profiles), metavar='',
+                    help='Parquet writer profile: {} (default: default).'.format(', '.join(sorted(profiles))))
+parser.add_argument('-x', '--skyindex', action='store_true',
+                    help='Add an hpx column of HEALPix nested pixel ids computed from cx, cy, cz and sort the '
+                         'Parquet files by it instead of by ra.')
+parser.add_argument('-r', '--memory', default=1024, type=int, metavar='',
+                    help='Memory budget in MB per process for the rows buffered across all partitions (default: 1024).')
+parser.add_argument('-c', '--manifest', default=None, metavar='',
+                    help='Path to folder of manifests recording the progress of each CSV, to resume interrupted '
+                         'downloads and skip CSVs already downloaded.')
+parser.add_argument('-k', '--checkpoint', default=256, type=int, metavar='',
+                    help='Number of MB downloaded between commits to the manifest (default: 256).')
+parser.add_argument('-e', '--retries', default=5, type=int, metavar='',
+                    help='Number of times to resume a dropped download before giving up (default: 5).')
+parser.add_argument('-z', '--partitionsize', default=25, type=int, metavar='',
+                    help='Size in MB of the rows buffered for a single partition before it is written (default: 25).')
+parser.add_argument('-p', '--profile', default=None, metavar='',
+                    help='Path of a metrics file to append a JSON line to every --interval seconds, per worker: rows/s, '
+                         'input MB/s, Parquet MB written, rows dropped by reason, open partitions and RSS '
+                         '(default: not written).')
+parser.add_argument('-i', '--interval', default=1.0, type=float, metavar='',
+                    help='Seconds between two samples of the progress and metrics (default: 1).')
+parser.add_argument('-T', '--trace', default=None, metavar='',
+                    help='Path of a file to write a span of each stage to, per CSV, block and Parquet file '
+                         '(default: not traced, unless set by the {} environment variable).'.format(tracing.trace_variable))
+parser.add_argument('--traceformat', default='jsonl', choices=tracing.trace_formats, metavar='',
+                    help='Format of the trace file: jsonl or otlp, OpenTelemetry JSON (default: jsonl).')
 args = parser.parse_args()
+if args.pipeline:
+    args.block = True
 
-header = [       'zoneID',     'time',        'cx',        'cy',         'cz',        'x',           'y',         'xa',
-                   'ya',        'q',          'xi',        'eta',        'ra',       'dec',         'flag'              ]
-header_dtypes = [np.int32,    np.int64,    np.float64,   np.float64,  np.float64,  np.float64,    np.float64,   np.int16,
-                 np.int16,    np.int16,    np.float64,   np.float64,  np.float64,  np.float64,    np.int8                ]
-ra_max = 360
-ra_factor = 36
+routers = {}
+# counters of the ingest of this process, sampled by the progress output and the metrics file
+metrics = IngestMetrics('main')
+# rows of the row by row parser are added to the counters in batches of this many
+rows_per_update = 10000
+# values that can be converted to the integer/float dtypes of the schema; a leading + of an integer
+# is stripped before it is cast, since Arrow does not parse it
+int_pattern = r'^-?\d{1,18}$'
+float_pattern = r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$|^[+-]?([nN][aA][nN]|[iI][nN][fF]([iI][nN][iI][tT][yY])?)$'
 
 def test():
     tests = [
@@ -91,44 +151,700 @@ def test():
                                                                                                                test,
                                                                                                                expected[index],
                                                                                                                result)
+
+    # values parse_block keeps and drops, as the row by row ingest does
+    row = '10831|991644817053|0.99|0.0|0.0045|98.6|92.9|6|56|26|0.16|0.63|0.0|0.26|1'
+    block = '\n'.join([
+        row,
+        row.replace('|6|56|', '|+6|-56|', 1),
+        '+' + row,
+        row.replace('|0.16|', '|+0.16|', 1),
+        '++' + row,
+        'x' + row,
+        row.replace('|6|56|', '|99999|56|', 1),
+        '1|2|3'
+    ]).encode() + b'\n'
+    tbl, num_rows_read = parse_block(block)
+    assert num_rows_read == 8, num_rows_read
+    assert tbl['zoneID'].to_pylist() == [10831]*4, tbl['zoneID'].to_pylist()
+    assert tbl['xa'].to_pylist() == [6, 6, 6, 6] and tbl['ya'].to_pylist() == [56, -56, 56, 56]
+    assert tbl['xi'].to_pylist() == [0.16]*4
+
+    test_resume()
     print('All tests passed.')
 
 
-def search_partitions(params, index=0, path=args.save_path):
-    folders = list(filter(lambda x: os.path.isdir(os.path.join(path, x)), os.listdir(path)))
-    if index == 0:
-        # ZONE ID partitions
-        fldrs = [int(re.findall('\d+', fldr)[0]) for fldr in folders]
-        fldr_index = fldrs.index(params['zoneID'])
-        return search_partitions(params=params, index=index+1, path=os.path.join(path, folders[fldr_index]))
-    else:
-        # RA partitions
-        folders = sorted(folders, key=lambda x: int(re.findall('[-\d]+', x)[0]))
-        if params['ra'] == ra_max:
-            fldr_index = int((params['ra']/ra_factor))-1
-        else:
-            fldr_index = int((params['ra']/ra_factor))
-        return os.path.join(path, folders[fldr_index])
+def test_resume():
+    '''
+    Ingest a CSV served by a local server which drops the connection partway through every response,
+    first giving up at the first drop as an interrupted process would, then resuming from the manifest,
+    and check the rows written against an ingest of the same CSV without drops.
+    '''
+    rng = np.random.default_rng(0)
+    num_rows = 60000
+    row = '{}|{}|0.99|0.0|0.0045|98.6|92.9|6|56|26|0.16|0.63|{:.6f}|0.26|1'
+    content = '\n'.join(row.format(zone, time, ra) for zone, time, ra in zip(rng.integers(10829, 10832, num_rows),
+                                                                             rng.integers(0, 2**40, num_rows),
+                                                                             rng.uniform(0, 360, num_rows))).encode() + b'\n'
+    # bytes sent before each dropped connection, for as many requests as drops are left
+    server_state = {'drops': 0, 'drop_after': 1536*1024}
+
+    class DroppingHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            start = 0
+            if self.headers.get('Range'):
+                start = int(re.match(r'bytes=(\d+)-', self.headers['Range']).group(1))
+            if start >= len(content):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self.send_response(206 if start else 200)
+            self.send_header('Content-Length', str(len(content) - start))
+            self.end_headers()
+            body = content[start:]
+            if server_state['drops'] > 0:
+                # the connection is closed after the response, short of its Content-Length
+                server_state['drops'] -= 1
+                body = body[:server_state['drop_after']]
+            self.wfile.write(body)
+
+        def log_message(self, *log_args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('localhost', 0), DroppingHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    file_name = 'http://localhost:{}/resume.csv'.format(server.server_address[1])
+    root = 'resume'
+    saved_args = dict(vars(args))
+    work_path = tempfile.mkdtemp()
+
+    def copy_layout(name):
+        # the partition folders of the save path, without their Parquet files
+        path = os.path.join(work_path, name)
+        shutil.copytree(saved_args['save_path'], path,
+                        ignore=lambda folder, files: [file for file in files if file.endswith('.parquet')])
+        return path
+
+    def get_written(path):
+        return sorted(os.path.relpath(os.path.join(folder, file), path) for folder, _, files in os.walk(path)
+                      for file in files if file.endswith('.parquet'))
+
+    def read_written(path):
+        df = pd.concat([pd.read_parquet(os.path.join(path, file)) for file in get_written(path)])
+        return df.sort_values(header).reset_index(drop=True)
+
+    try:
+        # 1 MB blocks, a commit after every block and a Parquet file for every partition of a block
+        args.block = True
+        args.pipeline = False
+        args.multiprocessing = False
+        args.blocksize = 1
+        args.checkpoint = 1
+        args.partitionsize = 0
+        args.profile = None
+
+        args.save_path = copy_layout('clean')
+        args.manifest = None
+        content_download([file_name])
+        expected = read_written(args.save_path)
+        assert len(expected), 'No rows of the test CSV belong to a partition.'
+
+        args.save_path = copy_layout('resumed')
+        args.manifest = os.path.join(work_path, 'manifest')
+        os.makedirs(args.manifest)
+        server_state['drops'] = 100
+        args.retries = 0
+        try:
+            content_download([file_name])
+            raise AssertionError('The first drop did not interrupt the ingest.')
+        except requests.exceptions.RequestException:
+            pass
+        # files of the rows read after the last commit, which the rerun removes, with one the replay of
+        # the rows does not write again, as a process killed later in the block would leave
+        uncommitted = get_written(args.save_path)
+        assert uncommitted, 'No files were written before the first drop.'
+        shutil.copy(os.path.join(args.save_path, uncommitted[0]),
+                    os.path.join(args.save_path, os.path.dirname(uncommitted[0]), root + '.00000.99999.parquet'))
+        args.retries = 10
+        content_download([file_name])
+        assert 100 - server_state['drops'] >= 3, 'The ingest was resumed fewer than twice.'
+        resumed = read_written(args.save_path)
+        assert resumed.equals(expected), 'Rows of the resumed ingest differ from those of the clean one.'
+
+        entry = load_manifest(root, file_name)
+        assert entry['complete'] and entry['offset'] == len(content), entry
+        assert entry['num_rows_read'] == num_rows and entry['num_rows_retained'] == len(expected), entry
+        assert sorted(entry['files']) == get_written(args.save_path)
+
+        written = get_written(args.save_path)
+        content_download([file_name])
+        assert get_written(args.save_path) == written, 'The rerun of a complete CSV wrote files.'
+    finally:
+        server.shutdown()
+        server.server_close()
+        vars(args).update(saved_args)
+        shutil.rmtree(work_path, ignore_errors=True)
+
+
+def get_router(path=None):
+    '''
+    Router over the partitions in path (default: the save path), built on first use.
+    '''
+    path = path if path is not None else args.save_path
+    if path not in routers:
+        routers[path] = PartitionRouter.from_path(path)
+    return routers[path]
+
 
+def search_partitions(params, path=None):
+    router = get_router(path)
+    partition_id = router.route([params['zoneID']], [params['ra']])[0]
+    if partition_id < 0:
+        return None
+    return router.paths[partition_id]
 
-def write_parquet_file(path, data):
+
+@tracing.traced('write_parquet_file')
+def write_parquet_file(path, data, file_name=None):
     i = -1
     while path[i] != '/':
         i -= 1
-    save_path = os.path.join(path[:i], str(uuid4()) + '.parquet')
-    print('Generating DataFrame and writing Parquet file to {}'.format(save_path))
-    df = pd.DataFrame(data[path]['data'], columns=header)
-    for i in range(len(header)):
-        df[header[i]] = df[header[i]].astype(header_dtypes[i])
-    df = df.sort_values(['ra'])
-    tbl = pa.Table.from_pandas(df, preserve_index=False)
-    pq.write_table(tbl,
-                   save_path,
-                   compression='snappy')
+    if file_name is None:
+        file_name = str(uuid4()) + '.parquet'
+    save_path = os.path.join(path[:i], file_name)
+    if isinstance(data[path]['data'][0], pa.Table):
+        # blocks that have already been parsed into typed columns
+        tbl = pa.concat_tables(data[path]['data'])
+    else:
+        df = pd.DataFrame(data[path]['data'], columns=header)
+        for i in range(len(header)):
+            df[header[i]] = df[header[i]].astype(header_dtypes[i])
+        tbl = pa.Table.from_pandas(df, preserve_index=False)
+    if args.skyindex:
+        tbl = tbl.append_column('hpx', pa.array(healpix_nest(tbl['cx'].to_numpy(),
+                                                             tbl['cy'].to_numpy(),
+                                                             tbl['cz'].to_numpy())))
+        tbl = tbl.sort_by('hpx')
+    else:
+        tbl = tbl.sort_by('ra')
+    write_table(tbl, save_path, args.writer)
+    num_bytes = os.path.getsize(save_path)
+    metrics.add(parquet_files=1, parquet_bytes=num_bytes)
+    tracing.current().set(path=save_path, rows=tbl.num_rows, bytes=num_bytes)
+    return save_path
+
+
+class PartitionBuffers:
+    '''
+    Rows buffered per partition with their size in bytes.
+
+    A partition is written to Parquet when its buffer reaches max_size bytes. When the buffers of
+    all partitions together reach the memory budget, the largest buffers are written first until
+    half of the budget is free again.
+
+    Files are named with a uuid unless a prefix is set, in which case they are numbered in the order
+    they are written so that replaying the same rows writes the same files.
+    '''
+    def __init__(self, max_size, budget, write=write_parquet_file):
+        self.data = {}
+        self.write = write
+        self.max_size = max_size
+        self.budget = budget
+        self.total = 0
+        self.peak = 0
+        # partitions with rows buffered
+        self.num_open = 0
+        self.peak_open = 0
+        self.num_spills = 0
+        self.prefix = None
+        self.files = []
+        # waits for the files handed to write to be written
+        self.sync = lambda: None
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def add(self, path, rows, size):
+        if path not in self.data:
+            self.data[path] = {
+                       'data': [],
+                       'size': 0
+            }
+        if not self.data[path]['data']:
+            self.num_open += 1
+            self.peak_open = max(self.peak_open, self.num_open)
+        self.data[path]['data'].append(rows)
+        self.data[path]['size'] += size
+        self.total += size
+        self.peak = max(self.peak, self.total)
+        if self.data[path]['size'] >= self.max_size:
+            self.flush(path)
+        if self.total >= self.budget:
+            self.spill()
+
+    def flush(self, path):
+        if len(self.data[path]['data']):
+            file_name = None
+            if self.prefix is not None:
+                file_name = '{}.{:05d}.parquet'.format(self.prefix, len(self.files))
+            self.files.append(self.write(path, {path: {'data': self.data[path]['data']}}, file_name))
+            self.num_open -= 1
+        self.total -= self.data[path]['size']
+        self.data[path]['data'] = []
+        self.data[path]['size'] = 0
+
+    def spill(self):
+        for path in sorted(self.data, key=lambda x: self.data[x]['size'], reverse=True):
+            if self.total <= self.budget/2:
+                break
+            self.num_spills += 1
+            self.flush(path)
+
+    def flush_all(self):
+        for path in self.data:
+            self.flush(path)
+        self.data.clear()
+        self.sync()
+
+
+def get_row_size(row):
+    '''
+    Bytes held by a row read with csv.reader: the list, the strings it holds and its slot in the buffer.
+    '''
+    return sys.getsizeof(row) + sum(map(sys.getsizeof, row)) + 8
+
+
+def get_peak_rss():
+    '''
+    Peak resident set size of the process in MB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak/(1024*1024) if sys.platform == 'darwin' else peak/1024
+
+
+def get_rss():
+    '''
+    Resident set size of the process in MB, or its peak where /proc is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/(1024*1024)
+    except (OSError, ValueError):
+        return get_peak_rss()
+
+
+def open_stream(file_name, offset=0):
+    '''
+    Stream a CSV from byte offset onwards, using an HTTP Range request when resuming.
+
+    Returns
+    -------
+    tuple
+        (response or None if there is nothing left to read,
+         number of bytes to skip if the server ignored the range,
+         offset of the end of the CSV or None if unknown)
+    '''
+    headers = {'Accept-Encoding': 'identity'}
+    if offset:
+        headers['Range'] = 'bytes={}-'.format(offset)
+    response = requests.get(file_name, stream=True, headers=headers, timeout=60)
+    if offset and response.status_code == 416:
+        return None, 0, offset
+    response.raise_for_status()
+    skip = offset if offset and response.status_code != 206 else 0
+    length = response.headers.get('Content-Length')
+    end = offset - skip + int(length) if length is not None else None
+    return response, skip, end
+
+
+def read_blocks(response, block_size, skip=0):
+    '''
+    Split a streamed download into blocks of roughly block_size bytes which end on a row boundary,
+    after skipping the first skip bytes.
+    '''
+    if response is None:
+        return
+    remainder = b''
+    for chunk in response.iter_content(chunk_size=block_size):
+        if skip:
+            chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+        block = remainder + chunk
+        end = block.rfind(b'\n') + 1
+        if not end:
+            remainder = block
+            continue
+        remainder = block[end:]
+        yield block[:end]
+    if remainder:
+        yield remainder
+
+
+def get_convertable_mask(column, dtype):
+    '''
+    Boolean mask of the values in a string column that can be converted to dtype.
+    '''
+    if np.issubdtype(dtype, np.integer):
+        mask = pc.match_substring_regex(column, int_pattern)
+        values = pc.cast(pc.if_else(mask, column, '0'), pa.int64())
+        info = np.iinfo(dtype)
+        in_range = pc.and_(pc.greater_equal(values, info.min), pc.less_equal(values, info.max))
+        return pc.and_(mask, in_range)
+    return pc.match_substring_regex(column, float_pattern)
+
+
+@tracing.traced('parse_block')
+def parse_block(block):
+    '''
+    Parse a block of pipe-delimited rows into a table with the gPhoton schema.
+
+    Rows which are not the expected length or which hold values not convertable to the dtype
+    of their column are dropped.
+
+    Parameters
+    ----------
+    block: bytes
+        rows of the CSV, ending on a row boundary
+
+    Returns
+    -------
+    tuple
+        (table, number of rows read)
+    '''
+    invalid_rows = []
+    def invalid_row_handler(row):
+        invalid_rows.append(row)
+        return 'skip'
+    tbl = pv.read_csv(pa.py_buffer(block),
+                      read_options=pv.ReadOptions(column_names=header,
+                                                  block_size=min(len(block), 1 << 30)),
+                      parse_options=pv.ParseOptions(delimiter='|',
+                                                    invalid_row_handler=invalid_row_handler),
+                      convert_options=pv.ConvertOptions(column_types={name: pa.string() for name in header},
+                                                        strings_can_be_null=False,
+                                                        quoted_strings_can_be_null=False))
+    num_rows_read = tbl.num_rows + len(invalid_rows)
+    if invalid_rows:
+        metrics.drop('wrong_length', len(invalid_rows))
+        print('\n{:,} rows are not the expected length of {} elements.'.format(len(invalid_rows), len(header)))
+    columns = []
+    index = 0
+    while index < len(header):
+        try:
+            columns.append(pc.cast(tbl[header[index]], schema.field(index).type))
+            index += 1
+        except pa.ArrowInvalid:
+            column = tbl[header[index]]
+            if (np.issubdtype(header_dtypes[index], np.integer) and
+                    pc.any(pc.match_substring_regex(column, r'^\+\d')).as_py()):
+                # int() of the row by row ingest accepts +1; cast it as 1
+                tbl = tbl.set_column(index, header[index], pc.replace_substring_regex(column, r'^\+(\d)', r'\1'))
+                continue
+            # fall back to masking out the rows which are not convertable and start over
+            mask = get_convertable_mask(tbl[header[index]], header_dtypes[index])
+            metrics.drop('not_convertable', len(mask) - pc.sum(mask).as_py())
+            print('\n{:,} values for element {} not convertable to dtype {}'.format(len(mask) - pc.sum(mask).as_py(),
+                                                                                 header[index],
+                                                                                 header_dtypes[index].__name__))
+            tbl = tbl.filter(mask)
+            columns = []
+            index = 0
+    tracing.current().set(bytes=len(block), rows=num_rows_read, rows_dropped=num_rows_read - tbl.num_rows)
+    return pa.Table.from_arrays(columns, schema=schema), num_rows_read
 
+
+def partition_block(tbl):
+    '''
+    Group the rows of a parsed block by partition.
+
+    Returns
+    -------
+    generator
+        (path to partition, rows of the block in that partition)
+    '''
+    router = get_router()
+    partition_ids = router.route(tbl['zoneID'].to_numpy(), tbl['ra'].to_numpy())
+    if (partition_ids < 0).any():
+        metrics.drop('no_partition', int((partition_ids < 0).sum()))
+        print('\n{:,} rows do not belong to any partition.'.format(int((partition_ids < 0).sum())))
+    for partition_id, indices in router.group(partition_ids):
+        yield router.paths[partition_id], tbl.take(indices)
+
+
+def ingest_block(block, root, data_collection):
+    '''
+    Parse a block of rows into typed columns and buffer them by partition.
+
+    Returns
+    -------
+    tuple
+        (number of rows read, number of rows retained)
+    '''
+    tbl, num_rows_read = parse_block(block)
+    num_rows_retained = 0
+    # Parquet files written when the buffers fill up are nested in this span
+    with tracing.span('partition', rows=tbl.num_rows) as partition:
+        for path, rows in partition_block(tbl):
+            num_rows_retained += rows.num_rows
+            data_collection.add(os.path.join(path, root), rows, rows.nbytes)
+        partition.set(rows_retained=num_rows_retained)
+    metrics.add(rows_read=num_rows_read, rows_retained=num_rows_retained)
+    return num_rows_read, num_rows_retained
+
+
+def ingest_rows(block, root, data_collection):
+    '''
+    Parse a block of rows one row at a time and buffer them by partition.
+
+    Returns
+    -------
+    tuple
+        (number of rows read, number of rows retained)
+    '''
+    num_rows_read = 0
+    num_rows_retained = 0
+    num_rows_counted = (0, 0)
+    reader = csv.reader(block.decode('utf-8').splitlines(), delimiter='|')
+    for row in reader:
+        num_rows_read += 1
+        if num_rows_read % rows_per_update == 0:
+            metrics.add(rows_read=num_rows_read - num_rows_counted[0],
+                        rows_retained=num_rows_retained - num_rows_counted[1])
+            num_rows_counted = (num_rows_read, num_rows_retained)
+        if None in row:
+            metrics.drop('null_value')
+            print('\n\nNone type found in row.\n{}'.format(row))
+            continue
+        if len(row) != len(header):
+            metrics.drop('wrong_length')
+            print('\n\nRow is not the expected length of {} elements:\n{} elements -> {}\n'.format(len(header),
+                                                                                                   len(row),
+                                                                                                   row))
+            continue
+        params = {}
+        for element in ['zoneID', 'ra']:
+            try:
+                index = header.index(element)
+                temp = header_dtypes[index](row[index])
+                params[element] = temp
+            except:
+                print('Value {} for element {} not convertable to dtype {}'.format(row[index],
+                                                                                   element,
+                                                                                   header_dtypes[index].__name__))
+                break
+        if len(params) != 2:
+            metrics.drop('not_convertable')
+            continue
+        path = search_partitions(params)
+        if path is None:
+            metrics.drop('no_partition')
+            print('\n\nRow does not belong to any partition:\n{}\n'.format(row))
+            continue
+        num_rows_retained += 1
+        data_collection.add(os.path.join(path, root), row, get_row_size(row))
+    metrics.add(rows_read=num_rows_read - num_rows_counted[0], rows_retained=num_rows_retained - num_rows_counted[1])
+    return num_rows_read, num_rows_retained
+
+
+def load_manifest(root, file_name):
+    '''
+    Progress committed for a CSV: the byte offset and rows committed and the Parquet files produced.
+    '''
+    path = os.path.join(args.manifest, root + '.json')
+    if os.path.exists(path):
+        with open(path) as manifest:
+            return json.load(manifest)
+    return {
+        'source': file_name,
+        'offset': 0,
+        'num_rows_read': 0,
+        'num_rows_retained': 0,
+        'checkpoint': 0,
+        'files': [],
+        'complete': False
+    }
+
+
+def save_manifest(root, entry):
+    path = os.path.join(args.manifest, root + '.json')
+    with open(path + '.tmp', 'w') as manifest:
+        json.dump(entry, manifest, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def commit(root, entry, data_collection, offset, num_rows_read, num_rows_retained, complete=False):
+    '''
+    Write all the buffered rows and record them in the manifest as committed up to offset.
+    '''
+    data_collection.flush_all()
+    entry['offset'] = offset
+    entry['num_rows_read'] += num_rows_read
+    entry['num_rows_retained'] += num_rows_retained
+    entry['files'].extend(os.path.relpath(path, args.save_path) for path in data_collection.files)
+    entry['checkpoint'] += 1
+    entry['complete'] = complete
+    save_manifest(root, entry)
+    data_collection.files = []
+    data_collection.prefix = '{}.{:05d}'.format(root, entry['checkpoint'])
+
+
+def remove_uncommitted_files(root, checkpoint):
+    '''
+    Remove the Parquet files written for a CSV after its last commit.
+    '''
+    pattern = re.compile(r'^{}\.(\d+)\.\d+\.parquet$'.format(re.escape(root)))
+    for path in get_router().paths:
+        for file in os.listdir(path):
+            match = pattern.match(file)
+            if match and int(match.group(1)) >= checkpoint:
+                os.remove(os.path.join(path, file))
+
+
+def stream_blocks(file_name, offset=0):
+    '''
+    Blocks of rows of a CSV from byte offset onwards, with the offset of the end of each block.
+    If the connection drops, the download is resumed after the last block.
+    '''
+    num_retries = 0
+    while True:
+        try:
+            # ------------------------------- lazy -------------------------------
+            downloaded_csv, skip, end = open_stream(file_name, offset)
+            # ------------------------------- lazy -------------------------------
+            for block in read_blocks(downloaded_csv, args.blocksize*1024*1024, skip):
+                offset += len(block)
+                yield block, offset
+            if end is not None and offset < end:
+                raise requests.exceptions.ConnectionError('Connection closed at byte {:,} of {:,}'.format(offset, end))
+            return
+        except requests.exceptions.RequestException as error:
+            num_retries += 1
+            if num_retries > args.retries:
+                raise
+            print('\nDownload of {} dropped at byte {:,}; resuming ({}).'.format(file_name, offset, error))
+
+
+def trace_blocks(blocks, parent=None):
+    '''
+    Blocks of stream_blocks, recording a download span for the time spent waiting on each block,
+    nested in parent or else in the span open when the block is read.
+    '''
+    start = time.time()
+    for block, end in blocks:
+        tracing.record_span('download', start, time.time(), parent=parent, bytes=len(block), offset=end)
+        yield block, end
+        start = time.time()
+
+
+def ingest_serially(file_name, root, offset, data_collection):
+    '''
+    Download, parse and buffer the blocks of a CSV one after another.
+
+    Returns
+    -------
+    generator
+        (offset of the end of the block, number of rows read, number of rows retained) per block
+    '''
+    for block, end in trace_blocks(stream_blocks(file_name, offset)):
+        with tracing.span('ingest', bytes=len(block), offset=end) as ingest:
+            if args.block:
+                num_rows_read, num_rows_retained = ingest_block(block, root, data_collection)
+            else:
+                num_rows_read, num_rows_retained = ingest_rows(block, root, data_collection)
+            ingest.set(rows=num_rows_read, rows_retained=num_rows_retained)
+        yield end, num_rows_read, num_rows_retained
+
+
+def ingest_pipelined(file_name, root, offset, data_collection):
+    '''
+    Download, parse and write the blocks of a CSV in concurrent stages connected by bounded queues:
+    a network reader, a pool of parsers and a pool of Parquet writers.
+
+    Parsed blocks are buffered in the order they were read, so the same files are written and the
+    same offsets are committed as when the blocks are ingested serially.
+
+    Returns
+    -------
+    generator
+        (offset of the end of the block, number of rows read, number of rows retained) per block
+    '''
+    # the spans of the stages, which run in threads of their own, are nested in the span of the CSV
+    parent = tracing.current_span.get()
+    pipe = Pipeline()
+    writers = Stage(pipe, 'write', tracing.bind(lambda item: write_parquet_file(*item)), args.writers, args.queuedepth,
+                    size=lambda item: sum(rows.nbytes for rows in item[1][item[0]]['data']))
+
+    def parse(item):
+        seq, block, end = item
+        if block is None:
+            return seq, end, 0, None
+        tbl, num_rows_read = parse_block(block)
+        with tracing.span('partition', rows=tbl.num_rows):
+            return seq, end, num_rows_read, list(partition_block(tbl))
+    parsed = queue.Queue(maxsize=args.queuedepth)
+    parsers = Stage(pipe, 'parse', tracing.bind(parse), args.parsers, args.queuedepth, output=parsed,
+                    size=lambda item: len(item[1]) if item[1] is not None else 0)
+
+    def blocks():
+        seq = 0
+        for seq, (block, end) in enumerate(trace_blocks(stream_blocks(file_name, offset), parent), start=1):
+            yield seq - 1, block, end
+        # marks the end of the CSV once every block before it has been parsed
+        yield seq, None, None
+    pipe.source('read', blocks(), parsers, size=lambda item: len(item[1]) if item[1] is not None else 0)
+
+    def submit_write(path, data, file_name=None):
+        if file_name is None:
+            file_name = str(uuid4()) + '.parquet'
+        writers.submit((path, data, file_name))
+        return os.path.join(os.path.dirname(path), file_name)
+    data_collection.write = submit_write
+    data_collection.sync = writers.join
+    buffer_counter = StageCounter('buffer', 1)
+    pipe.counters.append(buffer_counter)
+
+    pending = {}
+    next_seq = 0
+    try:
+        while True:
+            item = pipe.get(parsed)
+            pending[item[0]] = item
+            while next_seq in pending:
+                seq, end, num_rows_read, groups = pending.pop(next_seq)
+                next_seq += 1
+                if groups is None:
+                    return
+                start = time.time()
+                num_rows_retained = 0
+                for path, rows in groups:
+                    num_rows_retained += rows.num_rows
+                    data_collection.add(os.path.join(path, root), rows, rows.nbytes)
+                metrics.add(rows_read=num_rows_read, rows_retained=num_rows_retained)
+                buffer_counter.record(sum(rows.nbytes for _, rows in groups), time.time()-start)
+                buffer_counter.sample(parsed.qsize())
+                yield end, num_rows_read, num_rows_retained
+    finally:
+        data_collection.flush_all()
+        data_collection.write = write_parquet_file
+        data_collection.sync = lambda: None
+        pipe.close()
+        pipe.check()
+        print('\nPipeline stages of {}:'.format(root))
+        print('\t{:<8}{:>8}{:>10}{:>10}{:>10}{:>8}{:>16}'.format('stage', 'workers', 'MB', 'busy s',
+                                                               'MB/s', 'util', 'queue mean/max'))
+        stages = ['read', 'parse', 'buffer', 'write']
+        for report in sorted(pipe.report(), key=lambda x: stages.index(x['stage'])):
+            print('\t{stage:<8}{workers:>8}{mb:>10.1f}{busy_seconds:>10.2f}{mb_per_second:>10.1f}'
+                  '{utilization:>8.0%}{queue_depth_mean:>11.1f}/{queue_depth_max:<4}'.format(**report))
+
+
+@tracing.traced('content_download')
 def content_download(file_names):
     '''
     Download CSVs and incrementally create parquet files from the CSV files.
+
+    A dropped download is resumed from the last row read. With a manifest, progress is committed
+    every --checkpoint MB so that a rerun resumes from the last commit and skips finished CSVs.
         
     Parameters
     ----------
@@ -137,75 +853,76 @@ def content_download(file_names):
         
     Returns
     -------
-    None
+    dict
+        summary of the ingest by IngestMetrics, with the number of rows read and retained, number of
+        spills, peak buffered MB and peak RSS
     '''
     
+    global metrics
     num_rows_read = 0
     num_rows_retained = 0
-    data_collection = {}
-    for file_name in file_names:
-        print('Downloading content from: {}'.format(file_name))
-        # ------------------------------- lazy -------------------------------
-        downloaded_csv = requests.get(file_name, stream=True)
-        lines = (line.decode('utf-8') for line in downloaded_csv.iter_lines())
-        reader = csv.reader(lines, delimiter='|')
-        # ------------------------------- lazy -------------------------------
-        max_size = int(2.5e+7)
-        if not args.multiprocessing:
-            print('Maximum file size: {} MB'.format(int(max_size*1e-6)))
-        root = file_name.split('/')[-1].replace('.csv', '')
-        for cnt, row in enumerate(reader):
-            num_rows_read += 1
-            if not args.multiprocessing:
-                print('\rReading row #{:,}'.format(cnt), end='', flush=True)
-            if cnt and cnt % 50000 == 0:
+    data_collection = PartitionBuffers(args.partitionsize*1024*1024, args.memory*1024*1024)
+    ingest = ingest_pipelined if args.pipeline else ingest_serially
+    # workers of a pool are named by their CSV, and print their progress on lines of their own
+    name = (file_names[0].split('/')[-1].replace('.csv', '') if len(file_names) == 1
+            else 'process {}'.format(os.getpid()))
+    metrics = IngestMetrics(name, args.interval, args.profile,
+                            gauges={'open_partitions': lambda: data_collection.num_open,
+                                    'buffered_mb': lambda: data_collection.total/(1024*1024),
+                                    'rss_mb': get_rss},
+                            in_place=not args.multiprocessing).start()
+    try:
+        for file_name in file_names:
+            root = file_name.split('/')[-1].replace('.csv', '')
+            offset = 0
+            if args.manifest:
+                entry = load_manifest(root, file_name)
+                if entry['complete']:
+                    print('Skipping {}: {:,} rows already written to {} files.'.format(file_name,
+                                                                                       entry['num_rows_retained'],
+                                                                                       len(entry['files'])))
+                    continue
+                remove_uncommitted_files(root, entry['checkpoint'])
+                data_collection.prefix = '{}.{:05d}'.format(root, entry['checkpoint'])
+                offset = entry['offset']
+            with tracing.span('csv', file_name=file_name, offset=offset) as csv_span:
+                print('Downloading content from: {}{}'.format(file_name, ' (from byte {:,})'.format(offset) if offset else ''))
                 if not args.multiprocessing:
-                    print()
-                else:
-                    print('Process:', file_name)
-                for _ in data_collection:
-                    print('\t{} -> {:,} rows, ~{:.4f} MB'.format(_,
-                                                                 len(data_collection[_]['data']),
-                                                                 sys.getsizeof(data_collection[_]['data'])*1e-6))
-            if None in row:
-                print('\n\nNone type found in row.\n{}'.format(row))
-                continue
-            if len(row) != len(header):
-                print('\n\nRow is not the expected length of {} elements:\n{} elements -> {}\n'.format(len(header),
-                                                                                                       len(row),
-                                                                                                       row))
-                continue
-            else:
-                params = {}
-                for element in ['zoneID', 'ra']:
-                    try:
-                        index = header.index(element)
-                        temp = header_dtypes[index](row[index])
-                        params[element] = temp
-                    except:
-                        print('Value {} for element {} not convertable to dtype {}'.format(row[index],
-                                                                                           element,
-                                                                                           header_dtypes[index].__name__))
-                        continue
-            num_rows_retained += 1
-            path = search_partitions(params)
-            path = os.path.join(path, root)
-            if path not in data_collection:
-                data_collection[path] = {
-                           'data': []
-                }
-            if sys.getsizeof(data_collection[path]['data']) >= max_size:
-                write_parquet_file(path, data_collection)
-                data_collection[path]['data'] = []
-            else:
-                data_collection[path]['data'].append(row)
+                    print('Maximum partition size: {} MB; memory budget: {} MB'.format(args.partitionsize, args.memory))
+                committed = offset
+                previous_offset = offset
+                start_offset, csv_rows_read, csv_rows_retained = offset, num_rows_read, num_rows_retained
+                num_rows_read_since_commit = 0
+                num_rows_retained_since_commit = 0
+                for offset, num_read, num_retained in ingest(file_name, root, offset, data_collection):
+                    num_rows_read += num_read
+                    num_rows_retained += num_retained
+                    num_rows_read_since_commit += num_read
+                    num_rows_retained_since_commit += num_retained
+                    metrics.add(bytes_read=offset - previous_offset)
+                    previous_offset = offset
+                    if args.manifest and offset - committed >= args.checkpoint*1024*1024:
+                        commit(root, entry, data_collection, offset,
+                               num_rows_read_since_commit, num_rows_retained_since_commit)
+                        committed = offset
+                        num_rows_read_since_commit = 0
+                        num_rows_retained_since_commit = 0
 
-        for path in data_collection:
-            if len(data_collection[path]['data']):
-                write_parquet_file(path, data_collection)
-        data_collection.clear()
-        
-    return {'num_rows_read': num_rows_read, 'num_rows_retained': num_rows_retained}
+                if args.manifest:
+                    commit(root, entry, data_collection, offset,
+                           num_rows_read_since_commit, num_rows_retained_since_commit, complete=True)
+                else:
+                    data_collection.flush_all()
+                csv_span.set(rows=num_rows_read - csv_rows_read, rows_retained=num_rows_retained - csv_rows_retained,
+                             bytes=offset - start_offset)
+    finally:
+        # the peaks kept by the buffers and the kernel, which samples can miss
+        summary = metrics.stop(num_rows_read=num_rows_read, num_rows_retained=num_rows_retained,
+                               num_spills=data_collection.num_spills,
+                               peak_open_partitions=data_collection.peak_open,
+                               peak_buffered_mb=data_collection.peak/(1024*1024),
+                               peak_rss_mb=get_peak_rss())
+    return summary
 
 if __name__ == '__main__':
     if args.test:
@@ -213,19 +930,30 @@ if __name__ == '__main__':
     else:
         with open(args.txt_file) as txt_file:
             file_names = list(filter(lambda x: len(x), txt_file.read().split('\n')))
+        if args.manifest:
+            os.makedirs(args.manifest, exist_ok=True)
+        if args.trace:
+            # the workers forked by the pool append to the same file
+            tracing.enable(args.trace, args.traceformat)
         total_num_rows_read = 0
         total_num_rows_retained = 0
+        peak_rss = 0
+        start_time = time.time()
         if args.multiprocessing:
             num_processes = os.cpu_count() if len(file_names) >= os.cpu_count() else len(file_names)
             file_names = [[x] for x in file_names]
             pool = mp.Pool(processes=num_processes)
-            for result in pool.map(content_download, file_names):
-                total_num_rows_read += result['num_rows_read']
-                total_num_rows_retained += result['num_rows_retained']
-            
+            results = pool.map(content_download, file_names)
         else:
-            result = content_download(file_names)
+            results = [content_download(file_names)]
+        for result in results:
             total_num_rows_read += result['num_rows_read']
             total_num_rows_retained += result['num_rows_retained']
+            peak_rss = max(peak_rss, result['peak_rss_mb'])
+            print('\n' + format_summary(result))
+            print('\tspills: {}'.format(result['num_spills']))
+        if len(results) > 1:
+            print('\n' + format_summary(combine_summaries(results, time.time() - start_time)))
         print('\nTotal number of rows read: {}\nTotal number of rows retained: {}'.format(total_num_rows_read,
                                                                                           total_num_rows_retained))
+        print('Peak RSS of a worker: ~{:.1f} MB'.format(peak_rss))
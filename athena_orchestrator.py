@@ -0,0 +1,259 @@
+import time
+import asyncio
+import argparse
+import functools
+import tracing
+from botocore.exceptions import ClientError
+
+final_states = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+throttling_errors = ('TooManyRequestsException', 'ThrottlingException')
+# maximum number of ids batch_get_query_execution accepts
+batch_size = 50
+
+
+class QueryOrchestrator:
+    '''
+    Keep many Athena query executions in flight from one process.
+
+    Queries are started from an asyncio event loop, with the blocking client calls run in threads.
+    One poller checks all the running executions with batch_get_query_execution. The wait between two
+    checks of an execution starts at min_wait and grows by backoff up to max_wait. A query ends as soon
+    as Athena reports SUCCEEDED, FAILED or CANCELLED, and a query running for longer than query_life
+    seconds is stopped.
+
+    Every query gets a future resolved with a dict describing its end:
+        execution_id, query, state (SUCCEEDED, FAILED or CANCELLED), reason, submitted (seconds since
+        the epoch when Athena accepted it), elapsed (seconds), statistics (the Statistics Athena
+        reports) and output_location (of the CSV result)
+    '''
+    def __init__(self, athena_client, athena_database, s3_output_location, athena_workgroup, query_life=10,
+                 min_wait=0.05, max_wait=2.0, backoff=1.5, max_in_flight=100, verbose=True):
+        self.athena_client = athena_client
+        self.athena_database = athena_database
+        self.s3_output_location = s3_output_location
+        self.athena_workgroup = athena_workgroup
+        self.query_life = query_life
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.backoff = backoff
+        self.max_in_flight = max_in_flight
+        self.verbose = verbose
+        self.pending = {}
+        self.poller = None
+        self.semaphore = None
+        self.wakeup = None
+        self.num_requests = 0
+        self.num_throttled = 0
+
+    async def call(self, function, **kwargs):
+        '''
+        Run a blocking client call in a thread, retrying with backoff while Athena throttles.
+        '''
+        wait = self.min_wait
+        while True:
+            self.num_requests += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(None, functools.partial(function, **kwargs))
+            except ClientError as error:
+                if error.response['Error']['Code'] not in throttling_errors:
+                    raise
+                self.num_throttled += 1
+                await asyncio.sleep(wait)
+                wait = min(wait*self.backoff, self.max_wait)
+
+    async def submit(self, query, on_start=None):
+        '''
+        Start a query, waiting while max_in_flight queries are running; on_start is called with the
+        execution id once the query has started.
+
+        Returns
+        -------
+        asyncio.Future
+            resolved with the dict describing the end of the query
+        '''
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+            self.wakeup = asyncio.Event()
+        await self.semaphore.acquire()
+        try:
+            response = await self.call(self.athena_client.start_query_execution,
+                                       QueryString=query,
+                                       QueryExecutionContext={'Database': self.athena_database},
+                                       ResultConfiguration={'OutputLocation': self.s3_output_location},
+                                       WorkGroup=self.athena_workgroup)
+        except Exception:
+            self.semaphore.release()
+            raise
+        if self.verbose:
+            print('Query submitted:\n{}\n'.format(query))
+        if on_start is not None:
+            on_start(response['QueryExecutionId'])
+        now = time.monotonic()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[response['QueryExecutionId']] = {'future': future, 'query': query, 'start': now,
+                                                      'submitted': time.time(),
+                                                      'wait': self.min_wait, 'next_poll': now + self.min_wait}
+        if self.poller is None or self.poller.done():
+            self.poller = asyncio.ensure_future(self.poll())
+        self.wakeup.set()
+        return future
+
+    def finish(self, execution_id, state, reason=None, execution=None):
+        item = self.pending.pop(execution_id)
+        self.semaphore.release()
+        execution = execution or {}
+        result = {
+            'execution_id': execution_id,
+            'query': item['query'],
+            'state': state,
+            'reason': reason,
+            'submitted': item['submitted'],
+            'elapsed': time.monotonic() - item['start'],
+            'statistics': execution.get('Statistics', {}),
+            'output_location': execution.get('ResultConfiguration', {}).get('OutputLocation')
+        }
+        if self.verbose and state != 'SUCCEEDED':
+            print('QUERY {}: Query {} after ~{:.1f} seconds: {}'.format(state, execution_id, result['elapsed'], reason))
+        if not item['future'].done():
+            item['future'].set_result(result)
+
+    async def poll(self):
+        try:
+            while self.pending:
+                now = time.monotonic()
+                # executions reaching query_life are checked once more before they are stopped
+                expired = [execution_id for execution_id, item in self.pending.items()
+                           if item['start'] + self.query_life <= now]
+                due = [execution_id for execution_id, item in self.pending.items()
+                       if item['next_poll'] <= now or item['start'] + self.query_life <= now]
+                for index in range(0, len(due), batch_size):
+                    response = await self.call(self.athena_client.batch_get_query_execution,
+                                               QueryExecutionIds=due[index:index+batch_size])
+                    for execution in response['QueryExecutions']:
+                        self.update(execution)
+                for execution_id in expired:
+                    if execution_id in self.pending:
+                        await self.call(self.athena_client.stop_query_execution, QueryExecutionId=execution_id)
+                        self.finish(execution_id, 'CANCELLED',
+                                    'ran for longer than {} seconds'.format(self.query_life))
+                if not self.pending:
+                    break
+                delay = min(min(item['next_poll'] for item in self.pending.values()),
+                            min(item['start'] + self.query_life for item in self.pending.values())) - time.monotonic()
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=max(delay, 0))
+                except asyncio.TimeoutError:
+                    pass
+        except Exception as error:
+            # resolve every waiting future so that no caller waits forever
+            for item in self.pending.values():
+                if not item['future'].done():
+                    item['future'].set_exception(error)
+            raise
+
+    def update(self, execution):
+        execution_id = execution['QueryExecutionId']
+        if execution_id not in self.pending:
+            return
+        status = execution['Status']
+        if status['State'] in final_states:
+            self.finish(execution_id, status['State'], status.get('StateChangeReason'), execution)
+        else:
+            item = self.pending[execution_id]
+            item['wait'] = min(item['wait']*self.backoff, self.max_wait)
+            item['next_poll'] = time.monotonic() + item['wait']
+
+    async def as_completed(self, futures):
+        '''
+        Async iterator of the executions of the futures, in the order they end.
+        '''
+        for future in asyncio.as_completed(futures):
+            yield await future
+
+    async def run(self, queries):
+        '''
+        Run queries concurrently.
+
+        Returns
+        -------
+        list
+            the dict describing the end of each query, in the order of the queries
+        '''
+        futures = await asyncio.gather(*[self.submit(query) for query in queries])
+        return list(await asyncio.gather(*futures))
+
+
+def run_queries(athena_client, queries, athena_database, s3_output_location, athena_workgroup, **options):
+    '''
+    Run queries concurrently from synchronous code; options are those of QueryOrchestrator.
+
+    Returns
+    -------
+    list
+        the dict describing the end of each query, in the order of the queries
+    '''
+    orchestrator = QueryOrchestrator(athena_client, athena_database, s3_output_location, athena_workgroup, **options)
+    return asyncio.run(orchestrator.run(queries))
+
+
+def trace_executions(executions, attributes=None):
+    '''
+    Record a span per query execution, nested in the span open, from when Athena accepted it to when
+    its end was seen, with the time Athena queued it and the time its engine ran it as nested spans.
+    attributes, if given, are added to the span of the execution of the same index.
+    '''
+    if tracing.tracer is None:
+        return
+    for index, execution in enumerate(executions):
+        statistics = execution['statistics']
+        query_span = tracing.record_span('athena.query', execution['submitted'],
+                                         execution['submitted'] + execution['elapsed'],
+                                         execution_id=execution['execution_id'], state=execution['state'],
+                                         bytes=statistics.get('DataScannedInBytes', 0),
+                                         **(attributes[index] if attributes is not None else {}))
+        if 'QueryQueueTimeInMillis' in statistics and 'EngineExecutionTimeInMillis' in statistics:
+            queue_end = execution['submitted'] + statistics['QueryQueueTimeInMillis']/1000
+            tracing.record_span('athena.queue', execution['submitted'], queue_end, parent=query_span)
+            tracing.record_span('athena.execute', queue_end, queue_end + statistics['EngineExecutionTimeInMillis']/1000,
+                                parent=query_span)
+
+
+if __name__ == '__main__':
+    from athena_stub import AthenaStub
+
+    parser = argparse.ArgumentParser(description='Run many queries against the Athena stub to test the orchestrator.')
+    parser.add_argument('-n', '--numqueries', default=300, type=int, metavar='',
+                        help='Number of queries (default=300).')
+    parser.add_argument('-r', '--runtime', default='0.2,2.0', metavar='',
+                        help='Minimum and maximum run time in seconds of a query (default=0.2,2.0).')
+    parser.add_argument('-f', '--failurerate', default=0.05, type=float, metavar='',
+                        help='Fraction of the queries failing (default=0.05).')
+    parser.add_argument('-t', '--throttlerate', default=0.02, type=float, metavar='',
+                        help='Fraction of the calls throttled (default=0.02).')
+    parser.add_argument('-l', '--querylife', default=1.5, type=float, metavar='',
+                        help='Seconds after which a query is stopped (default=1.5).')
+    args = parser.parse_args()
+
+    stub = AthenaStub(run_time=[float(value) for value in args.runtime.split(',')], failure_rate=args.failurerate,
+                      throttle_rate=args.throttlerate)
+    orchestrator = QueryOrchestrator(stub, 'database', 's3://bucket/results/', 'primary', query_life=args.querylife,
+                                     max_in_flight=args.numqueries, verbose=False)
+    start = time.time()
+    results = asyncio.run(orchestrator.run(['SELECT * FROM gPhoton_partitioned WHERE zoneID = {};'.format(zone_id)
+                                            for zone_id in range(args.numqueries)]))
+    elapsed = time.time()-start
+    for state in final_states:
+        runs = [result for result in results if result['state'] == state]
+        if runs:
+            lag = [result['elapsed'] - stub.executions[result['execution_id']]['run_time'] for result in runs
+                   if state != 'CANCELLED']
+            print('{:<10}{:>5} queries{}'.format(state, len(runs), ', detected ~{:.3f} seconds after the end on '
+                                                                    'average'.format(sum(lag)/len(lag)) if lag else ''))
+    # every query ends within query_life, whatever its state
+    assert all(result['elapsed'] < args.querylife + orchestrator.max_wait for result in results)
+    assert all(result['state'] != 'CANCELLED' or
+               stub.executions[result['execution_id']]['run_time'] > args.querylife - orchestrator.min_wait
+               for result in results)
+    print('{} queries in ~{:.2f} seconds with {} API calls ({} throttled): {}'.format(
+        args.numqueries, elapsed, orchestrator.num_requests, orchestrator.num_throttled, dict(stub.calls)))
@@ -1,7 +1,12 @@
 import boto3
 import argparse
 import numpy as np
-import pandas as pd
+import pyarrow as pa
+from uuid import uuid4
+from athena_orchestrator import run_queries
+from cone_search import read_csv_table
+from gphoton_schema import schema
+from partition_layout import PartitionRouter, get_uniform_layout, load_layout
 
 parser = argparse.ArgumentParser(description='Get query args and AWS credentials.')
 parser.add_argument('-p', '--profile', default='default', metavar='',
@@ -17,8 +22,10 @@ parser.add_argument('decmax', type=float, help='Maximum of dec range to be queri
 parser.add_argument('radius', type=float, help='Radius used to determine the zone to be searched.')
 parser.add_argument('-l', '--querylife', default=10, type=int, metavar='',
                     help='Maximum number of seconds query should be allowed to run before stopping/cancelling (default=10).')
-parser.add_argument('-w', '--wait', default=0.1, type=int, metavar='',
-                    help='Time to wait between checks to see if a query is still running (default=0.1 seconds).')
+parser.add_argument('-w', '--wait', default=0.1, type=float, metavar='',
+                    help='Initial time to wait between checks to see if a query is still running (default=0.1 seconds).')
+parser.add_argument('-y', '--layout', default=None, metavar='',
+                    help='Path to the layout spec written by generate_directory.py (default: 10 equal RA partitions).')
 args = parser.parse_args()
 assert 0 <= args.ramin <= 360, '0<= RA min <= 360.'
 assert 0 <= args.ramax <= 360, '0<= RA max <= 360.'
@@ -28,27 +35,18 @@ assert args.radius > 0, 'Radius must be greater than 0.'
 assert args.ramin <= args.ramax, 'RA min must be less than or equal to RA max.'
 assert args.decmin <= args.decmax, 'DEC min must be less than or equal to DEC max.'
 
-ra_partitions = [
-    '0<=ra<36',
-    '36<=ra<72',
-    '72<=ra<108',
-    '108<=ra<144',
-    '144<=ra<180',
-    '180<=ra<216',
-    '216<=ra<252',
-    '252<=ra<288',
-    '288<=ra<324',
-    '324<=ra<=360'
-]
-
 def get_min_max_zoneids(dec, radius):
     zoneHeight = 30.0/3600.0
     min_zoneid = np.floor((dec - radius + 90.0) / zoneHeight)
     max_zoneid = np.floor((dec + radius + 90.0) / zoneHeight)
     return (min_zoneid, max_zoneid)
-def get_ra_partition_index(ra_value):
-    ra_factor = 36
-    return int((ra_value/ra_factor))
+def get_selected_partitions(layout, min_zoneid, max_zoneid, ramin, ramax):
+    '''
+    zoneID/ra folders of the partitions of the layout holding rows of the zones and RA range.
+    '''
+    router = PartitionRouter.from_layout('', layout)
+    return [router.paths[partition_id]
+            for partition_id in router.get_partitions(min_zoneid, max_zoneid, ramin, ramax)]
 
 if __name__ == '__main__':
     # ==============================
@@ -63,22 +61,17 @@ if __name__ == '__main__':
     #s3://trossbach-gphoton-bucket/athena/results/13b94fee-5e47-46cc-8b15-6b1c08e6311f.csv
     
     min_zoneid, max_zoneid = get_min_max_zoneids(args.decmin, args.radius)
-    min_ra_partition_index = get_ra_partition_index(args.ramin)
-    max_ra_partition_index = get_ra_partition_index(args.ramax)
-    print('min: {}, max: {}'.format(min_ra_partition_index, max_ra_partition_index))
-    # endpoint of ra range is not inclusive, except for the last range (i.e. 324<=ra<=360)
-    if min_ra_partition_index == max_ra_partition_index:
-        if min_ra_partition_index == len(ra_partitions):
-            min_ra_partition_index -= 1
-        selected_ra_partitions = ra_partitions[min_ra_partition_index]
+    if args.layout is None:
+        layout = get_uniform_layout(range(int(min_zoneid), int(max_zoneid) + 1))
     else:
-        if args.ramax < 360:
-            max_ra_partition_index += 1
-        selected_ra_partitions = ra_partitions[min_ra_partition_index:max_ra_partition_index]
+        layout = load_layout(args.layout)
+    # endpoint of ra range is not inclusive, except for the last range of a zone (e.g. 324<=ra<=360)
+    selected_partitions = get_selected_partitions(layout, min_zoneid, max_zoneid, args.ramin, args.ramax)
+    print('Selected {} partitions: {}'.format(len(selected_partitions), selected_partitions))
 
     queries = {
         'create': '''
-                  CREATE EXTERNAL TABLE gPhoton (
+                  CREATE EXTERNAL TABLE {} (
                   zoneID INT,
                   time BIGINT,
                   cx DOUBLE,
@@ -95,69 +88,41 @@ if __name__ == '__main__':
                   dec DOUBLE,
                   flag TINYINT
                   ) STORED AS PARQUET
-                  LOCATION 's3://trossbach-gphoton-bucket/{}/{}'
+                  LOCATION 's3://trossbach-gphoton-bucket/{}'
                   tblproperties ("parquet.compress"="SNAPPY")
                   ''',
         'select': '''
                   SELECT COUNT(*)
-                  FROM gPhoton
+                  FROM {}
                   WHERE ra BETWEEN {} AND {};
                   ''',
         'delete': '''
-                  DROP TABLE `gphoton`;
+                  DROP TABLE `{}`;
                   '''
     }
-    
+
+    # a table per partition so that the partitions are queried concurrently: all the tables are
+    # created, then all selected from, then all dropped
+    table_names = ['gphoton_{}'.format(uuid4().hex) for _ in selected_partitions]
     query_args = {
-        'select': (args.ramin, args.ramax),
-        'delete': (None,)
+        'create': [(table_name, partition) for table_name, partition in zip(table_names, selected_partitions)],
+        'select': [(table_name, args.ramin, args.ramax) for table_name in table_names],
+        'delete': [(table_name,) for table_name in table_names]
     }
 
-    execution_ids = []
-    for zoneid in range(min_zoneid, max_zoneid):
-        for ra_partition in selected_ra_partitions:
-            query_args['create'] = (zoneid, ra_partition)
-            for query in ['create', 'select', 'delete']:
-                response = athena_client.start_query_execution(
-                    QueryString=queries[query].format(*query_args[query].values()),
-                    QueryExecutionContext={
-                        'Database': args.database
-                    },
-                    ResultConfiguration={
-                        'OutputLocation': args.output_location
-                    },
-                    WorkGroup=args.workgroup
-                )
-
-                rsp = athena_client.get_query_execution(QueryExecutionId=response['QueryExecutionId'])
-                succeeded_query = True if rsp['QueryExecution']['Status']['State'] == 'SUCCEEDED' else False
-                num_sec_query_has_been_running = 0
-                # check to see if the query has succeeded
-                while not succeeded_query:
-                    if num_sec_query_has_been_running >= args.querylife:
-                        print('QUERY CANCELLED: Query {} has been running for ~{} seconds.'.format(response['QueryExecutionId'],
-                                                                                                   num_sec_query_has_been_running))
-                        _ = athena_client.stop_query_execution(QueryExecutionId=response['QueryExecutionId'])
-                        break
-                    if num_sec_query_has_been_running % 60 == 0 and num_sec_query_has_been_running:
-                        duration = int(num_sec_query_has_been_running/60)
-                        word = 'minutes' if duration > 1 else 'minute'
-                        print('...Query has been running for ~{} {}.'.format(duration, word))
-                    # wait until query has succeeded to start the next query
-                    if num_sec_query_has_been_running + args.wait > args.querylife:
-                        sleep_time = args.querylife - num_sec_query_has_been_running
-                    else:
-                        sleep_time = args.wait
-                    time.sleep(sleep_time)
-                    num_sec_query_has_been_running += sleep_time
-                    rsp = athena_client.get_query_execution(QueryExecutionId=response['QueryExecutionId'])
-                    succeeded_query = True if rsp['QueryExecution']['Status']['State'] == 'SUCCEEDED' else False
-                if query == 'SELECT':
-                    execution_ids.append(response['QueryExecutionId'])
+    results = {}
+    for query in ['create', 'select', 'delete']:
+        results[query] = run_queries(athena_client, [queries[query].format(*values) for values in query_args[query]],
+                                     args.database, args.output_location, args.workgroup,
+                                     query_life=args.querylife, min_wait=args.wait)
+    execution_ids = [result['execution_id'] for result in results['select'] if result['state'] == 'SUCCEEDED']
+    print('{} of {} SELECT queries succeeded.'.format(len(execution_ids), len(selected_partitions)))
     # accumulate the CSVs from the different SELECT statements
-    dfs = []
-    for cnt, execution_id in enumerate(execution_ids):
-        path_to_csv = s3_path + execution_id + '.csv'
-        s3_client.download_file(bucket, path_to_csv, where_to_save)
-        dfs.append(pd.read_csv(where_to_save))
-    df = pd.concat(dfs)
+    tables = []
+    for result in results['select']:
+        if result['state'] != 'SUCCEEDED':
+            continue
+        bucket, key = result['output_location'][len('s3://'):].split('/', 1)
+        tables.append(read_csv_table(s3_client, bucket, key, '{}.csv'.format(result['execution_id'])))
+    tbl = pa.concat_tables(tables) if tables else schema.empty_table()
+    print(tbl.to_pandas())
@@ -0,0 +1,124 @@
+import time
+import heapq
+import random
+import threading
+from uuid import uuid4
+from datetime import datetime, timezone
+from collections import Counter
+from botocore.exceptions import ClientError
+
+
+class AthenaStub:
+    '''
+    In-process stand-in for the Athena client methods used to run queries, for testing without AWS.
+
+    A query is QUEUED for queue_time seconds, RUNNING for a run time drawn between run_time[0] and
+    run_time[1], and then SUCCEEDED, or FAILED if it contains 'FAIL' or with probability failure_rate.
+    Calls are throttled with probability throttle_rate, like Athena does under load.
+
+    With max_running, at most that many queries run at once, like the concurrency limit of a
+    workgroup: the others stay QUEUED, first in first out, until a running query ends. A query
+    stopped early still holds its slot until the end of its run time.
+    '''
+    def __init__(self, queue_time=0.0, run_time=(0.1, 0.5), failure_rate=0.0, throttle_rate=0.0, seed=0,
+                 bytes_scanned=10*1024*1024, max_running=None):
+        self.queue_time = queue_time
+        self.run_time = run_time
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        self.bytes_scanned = bytes_scanned
+        self.max_running = max_running
+        # end times of the queries holding the running slots
+        self.slots = []
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.executions = {}
+        self.calls = Counter()
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+            throttled = self.random.random() < self.throttle_rate
+        if throttled:
+            raise ClientError({'Error': {'Code': 'TooManyRequestsException', 'Message': 'Rate exceeded'}}, name)
+
+    def start_query_execution(self, QueryString, QueryExecutionContext=None, ResultConfiguration=None,
+                              WorkGroup='primary'):
+        self.call('start_query_execution')
+        execution_id = str(uuid4())
+        with self.lock:
+            submitted = time.time()
+            run_time = self.random.uniform(*self.run_time)
+            started = submitted + self.queue_time
+            if self.max_running is not None:
+                if len(self.slots) >= self.max_running:
+                    started = max(started, heapq.heappop(self.slots))
+                heapq.heappush(self.slots, started + run_time)
+            self.executions[execution_id] = {
+                'query': QueryString,
+                'output_location': (ResultConfiguration or {}).get('OutputLocation', ''),
+                'workgroup': WorkGroup,
+                'submitted': submitted,
+                'started': started,
+                'run_time': run_time,
+                'fails': 'FAIL' in QueryString or self.random.random() < self.failure_rate,
+                'stopped': None
+            }
+        return {'QueryExecutionId': execution_id}
+
+    def describe(self, execution_id):
+        item = self.executions[execution_id]
+        now = time.time()
+        end = item['started'] + item['run_time']
+        status = {'SubmissionDateTime': datetime.fromtimestamp(item['submitted'], timezone.utc)}
+        statistics = {}
+        if item['stopped'] is not None and item['stopped'] < end:
+            status.update({'State': 'CANCELLED', 'StateChangeReason': 'Query was cancelled by user',
+                           'CompletionDateTime': datetime.fromtimestamp(item['stopped'], timezone.utc)})
+        elif now >= end:
+            status['CompletionDateTime'] = datetime.fromtimestamp(end, timezone.utc)
+            if item['fails']:
+                status.update({'State': 'FAILED', 'StateChangeReason': 'Query failed in stub'})
+            else:
+                status['State'] = 'SUCCEEDED'
+                statistics = {'DataScannedInBytes': self.bytes_scanned,
+                              'EngineExecutionTimeInMillis': int(1000*item['run_time']),
+                              'QueryQueueTimeInMillis': int(1000*(item['started'] - item['submitted'])),
+                              'TotalExecutionTimeInMillis': int(1000*(end - item['submitted']))}
+        elif now >= item['started']:
+            status['State'] = 'RUNNING'
+        else:
+            status['State'] = 'QUEUED'
+        return {
+            'QueryExecutionId': execution_id,
+            'Query': item['query'],
+            'ResultConfiguration': {'OutputLocation': item['output_location'].rstrip('/') + '/' + execution_id + '.csv'},
+            'WorkGroup': item['workgroup'],
+            'Status': status,
+            'Statistics': statistics
+        }
+
+    def get_query_execution(self, QueryExecutionId):
+        self.call('get_query_execution')
+        with self.lock:
+            return {'QueryExecution': self.describe(QueryExecutionId)}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        self.call('batch_get_query_execution')
+        if len(QueryExecutionIds) > 50:
+            raise ClientError({'Error': {'Code': 'InvalidRequestException', 'Message': 'Too many ids'}},
+                              'batch_get_query_execution')
+        with self.lock:
+            return {'QueryExecutions': [self.describe(execution_id) for execution_id in QueryExecutionIds
+                                        if execution_id in self.executions],
+                    'UnprocessedQueryExecutionIds': [{'QueryExecutionId': execution_id, 'ErrorCode': 'INVALID_INPUT',
+                                                      'ErrorMessage': 'QueryExecution {} was not found'.format(execution_id)}
+                                                     for execution_id in QueryExecutionIds
+                                                     if execution_id not in self.executions]}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.call('stop_query_execution')
+        with self.lock:
+            if self.executions[QueryExecutionId]['stopped'] is None:
+                self.executions[QueryExecutionId]['stopped'] = time.time()
+        return {}
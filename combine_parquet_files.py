@@ -1,35 +1,121 @@
 import os
 import argparse
-import numpy as np
+import multiprocessing as mp
 import pyarrow as pa
 import pyarrow.parquet as pq
+from parquet_profiles import profiles
 
 parser = argparse.ArgumentParser(description='Get path to read PARQUET files and path to write PARQUET files.')
-parser.add_argument('read', help='Path to PARQUET files to be read.')
-parser.add_argument('write', help='Path where to write new PARQUET files.')
-parser.add_argument('-f', '--factor', type=int, default=10, metavar='',
-                    help='Factor of 10 used to reduce the number of files (default: 10).')
+parser.add_argument('read', help='Path to PARQUET files to be read; folders below it are compacted separately.')
+parser.add_argument('write', help='Path where to write new PARQUET files, in the same folders as they were read from.')
+parser.add_argument('-s', '--size', default=128, type=int, metavar='',
+                    help='Target size in MB of the files written (default: 128).')
+parser.add_argument('-b', '--batchsize', default=65536, type=int, metavar='',
+                    help='Number of rows read from an input file at a time (default: 65536).')
+parser.add_argument('-W', '--writer', default='default', choices=sorted(profiles), metavar='',
+                    help='Parquet writer profile: {} (default: default).'.format(', '.join(sorted(profiles))))
+parser.add_argument('-m', '--multiprocessing', action='store_true',
+                    help='To compact several output files at a time, one per core.')
 args = parser.parse_args()
 
-read_path = args.read
-write_path = args.write
-files = sorted(os.listdir(read_path))
-files = list(filter(lambda x: x.endswith('parquet'), files))
-root = files[0].split('.')[0]
-# split the range of files into chunks
-segments = np.linspace(0, len(files), int(len(files)/args.factor)).astype(int)
-for index in range(len(segments)-1):
-    start, end = segments[index], segments[index+1]
-    file_range = files[start:end]
-    tbl = pq.read_table(os.path.join(read_path, file_range[0]))
-    file_name = root + '.' + str(index).zfill(2) + '.parquet'
-    with pq.ParquetWriter(os.path.join(write_path, file_name),
-                          tbl.schema) as writer:
-        msg = 'Writing {} to {}'.format(file_range[0], file_name)
-        print(msg)
-        writer.write_table(tbl)
-        for file in file_range[1:]:
-            tbl = pq.read_table(os.path.join(read_path, file))
-            print('Writing {} to {}'.format(file, file_name))
-            writer.write_table(tbl)
-    print('='*len(msg))
+
+def get_bins(files, target_size):
+    '''
+    Pack files into bins of at most target_size bytes, first-fit decreasing; a file larger than
+    target_size gets a bin of its own.
+
+    Parameters
+    ----------
+    files: list
+        (path, size in bytes) of the files
+
+    Returns
+    -------
+    list
+        lists of paths, in the order the files were given
+    '''
+    bins = []
+    for path, size in sorted(files, key=lambda x: x[1], reverse=True):
+        for item in bins:
+            if item['size'] + size <= target_size:
+                item['paths'].append(path)
+                item['size'] += size
+                break
+        else:
+            bins.append({'paths': [path], 'size': size})
+    order = {path: index for index, (path, _) in enumerate(files)}
+    return sorted([sorted(item['paths'], key=order.get) for item in bins], key=lambda x: order[x[0]])
+
+
+def compact(task):
+    '''
+    Stream the row groups of the input files into one output file, holding at most one output
+    row group in memory.
+
+    Parameters
+    ----------
+    task: tuple
+        (paths of the input files, path of the output file)
+
+    Returns
+    -------
+    tuple
+        (path of the output file, number of rows written)
+    '''
+    paths, save_path = task
+    options = dict(profiles[args.writer])
+    row_group_size = options.pop('row_group_size', 1024*1024)
+    schema = pq.read_schema(paths[0]).remove_metadata()
+    num_rows = 0
+    batches = []
+    num_rows_buffered = 0
+    with pq.ParquetWriter(save_path, schema, **options) as writer:
+        for path in paths:
+            print('Writing {} to {}'.format(path, save_path))
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=args.batchsize):
+                batches.append(batch)
+                num_rows_buffered += batch.num_rows
+                if num_rows_buffered >= row_group_size:
+                    writer.write_table(pa.Table.from_batches(batches).cast(schema), row_group_size=row_group_size)
+                    num_rows += num_rows_buffered
+                    batches = []
+                    num_rows_buffered = 0
+        if batches:
+            writer.write_table(pa.Table.from_batches(batches).cast(schema), row_group_size=row_group_size)
+            num_rows += num_rows_buffered
+    return save_path, num_rows
+
+
+def get_tasks(read_path, write_path, target_size):
+    '''
+    Output files to write for every folder below read_path holding PARQUET files.
+    '''
+    tasks = []
+    for folder, _, file_names in sorted(os.walk(read_path)):
+        files = sorted(filter(lambda x: x.endswith('parquet'), file_names))
+        if not files:
+            continue
+        save_folder = os.path.join(write_path, os.path.relpath(folder, read_path))
+        os.makedirs(save_folder, exist_ok=True)
+        root = files[0].split('.')[0]
+        files = [(os.path.join(folder, file), os.path.getsize(os.path.join(folder, file))) for file in files]
+        for index, paths in enumerate(get_bins(files, target_size)):
+            file_name = root + '.' + str(index).zfill(2) + '.parquet'
+            tasks.append((paths, os.path.join(save_folder, file_name)))
+    return tasks
+
+
+if __name__ == '__main__':
+    tasks = get_tasks(args.read, args.write, args.size*1024*1024)
+    print('Compacting {} files into {} files.'.format(sum(len(paths) for paths, _ in tasks), len(tasks)))
+    total_num_rows = 0
+    if args.multiprocessing:
+        pool = mp.Pool(processes=os.cpu_count())
+        results = pool.imap_unordered(compact, tasks)
+    else:
+        results = map(compact, tasks)
+    for save_path, num_rows in results:
+        total_num_rows += num_rows
+        msg = 'Wrote {:,} rows to {}'.format(num_rows, save_path)
+        print(msg + '\n' + '='*len(msg))
+    print('\nTotal number of rows written: {:,}'.format(total_num_rows))
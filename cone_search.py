@@ -2,11 +2,22 @@ import os
 import boto3
 import argparse
 import time
+import tempfile
 from uuid import uuid4
 import numpy as np
 from numpy import math
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
 import multiprocessing as mp
+import tracing
+from gphoton_schema import schema, batch_schema, cast_to_schema
+from athena_orchestrator import run_queries, trace_executions
+from result_stream import read_csv_stream, csv_column_types
+from sky_index import cone_ranges, get_range_predicate
+from partition_layout import PartitionRouter, load_layout, select_partitions, get_partition_predicate
+
+output_formats = ('csv', 'parquet', 'feather', 'arrow')
 
 def get_alpha(radius, dec):
     if abs(dec) + radius > 89.9:
@@ -17,49 +28,301 @@ def get_alpha(radius, dec):
                   ))
             )))
 
+def get_search_plan(ra, dec, radius):
+    '''
+    Everything a cone search needs to know about the cone, shared by the Athena and local backends.
+
+    Returns
+    -------
+    dict
+        cx, cy, cz: unit vector of the center of the cone
+        cos_radius: rows whose dot product with the center is greater are in the cone
+        alpha: half-width in RA of the box around the cone
+        ra: RA of the center, shifted by 360 when the box starts below 0
+        min_zoneid, max_zoneid: zones overlapping the cone
+        dec_range: (min, max) dec of the box
+        ra_ranges: (min, max) RA of the box, plus (0, max) of its part past 360 when the box wraps
+    '''
+    cx = math.cos(math.radians(dec)) * math.cos(math.radians(ra))
+    cy = math.cos(math.radians(dec)) * math.sin(math.radians(ra))
+    cz = math.sin(math.radians(dec))
+    alpha = get_alpha(radius, dec)
+    if (ra - alpha) < 0:
+        ra = ra + 360
+    zoneHeight = 30.0/3600.0
+    ra_ranges = [(ra - alpha, ra + alpha)]
+    if (ra + alpha) > 360:
+        ra_ranges.append((0, ra - 360 + alpha))
+    return {
+        'cx': cx,
+        'cy': cy,
+        'cz': cz,
+        'cos_radius': math.cos(math.radians(radius)),
+        'alpha': alpha,
+        'ra': ra,
+        'min_zoneid': int(np.floor((dec - radius + 90.0) / zoneHeight)),
+        'max_zoneid': int(np.floor((dec + radius + 90.0) / zoneHeight)),
+        'dec_range': (dec - radius, dec + radius),
+        'ra_ranges': ra_ranges
+    }
+
+def get_alphas(radius, dec):
+    '''
+    get_alpha for arrays of radii and decs.
+    '''
+    radius, dec = np.broadcast_arrays(np.asarray(radius, dtype=np.float64), np.asarray(dec, dtype=np.float64))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alpha = np.degrees(np.abs(np.arctan(
+                    np.sin(np.radians(radius)) /
+                    np.sqrt(np.abs(np.cos(np.radians(dec - radius)) * np.cos(np.radians(dec + radius))))
+                )))
+    return np.where(np.abs(dec) + radius > 89.9, 180.0, alpha)
+
+def get_search_plans(ra, dec, radius):
+    '''
+    get_search_plan for arrays of targets, computed with NumPy; the constants can differ from those of
+    get_search_plan in the last bit, which only matters for rows right on the edge of a cone.
+
+    Returns
+    -------
+    dict
+        arrays with one value per target: cx, cy, cz, cos_radius, alpha, ra, min_zoneid, max_zoneid,
+        dec_min and dec_max, as in get_search_plan, and arrays with one value per RA range: range_target
+        (index of the target), range_min and range_max; a target whose box wraps past 360 has two ranges
+    '''
+    ra, dec, radius = np.broadcast_arrays(np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64),
+                                          np.asarray(radius, dtype=np.float64))
+    alpha = get_alphas(radius, dec)
+    zoneHeight = 30.0/3600.0
+    plans = {
+        'cx': np.cos(np.radians(dec)) * np.cos(np.radians(ra)),
+        'cy': np.cos(np.radians(dec)) * np.sin(np.radians(ra)),
+        'cz': np.sin(np.radians(dec)),
+        'cos_radius': np.cos(np.radians(radius)),
+        'alpha': alpha,
+        'ra': np.where(ra - alpha < 0, ra + 360, ra),
+        'min_zoneid': np.floor((dec - radius + 90.0) / zoneHeight).astype(np.int64),
+        'max_zoneid': np.floor((dec + radius + 90.0) / zoneHeight).astype(np.int64),
+        'dec_min': dec - radius,
+        'dec_max': dec + radius
+    }
+    wraps = np.flatnonzero(plans['ra'] + alpha > 360)
+    plans['range_target'] = np.concatenate([np.arange(len(ra)), wraps])
+    plans['range_min'] = np.concatenate([plans['ra'] - alpha, np.zeros(len(wraps))])
+    plans['range_max'] = np.concatenate([plans['ra'] + alpha, plans['ra'][wraps] - 360 + alpha[wraps]])
+    return plans
+
+def group_targets(plans, max_targets=500):
+    '''
+    Group the targets into combined scans: targets whose zones overlap share a scan, and a scan holds at
+    most max_targets targets.
+
+    Returns
+    -------
+    list
+        arrays of the indices of the targets of each scan
+    '''
+    order = np.lexsort((plans['ra'], plans['min_zoneid']))
+    groups = []
+    current = []
+    current_max_zoneid = None
+    for index in order:
+        if current and (plans['min_zoneid'][index] > current_max_zoneid or len(current) >= max_targets):
+            groups.append(np.array(current))
+            current = []
+        if not current:
+            current_max_zoneid = plans['max_zoneid'][index]
+        current.append(index)
+        current_max_zoneid = max(current_max_zoneid, plans['max_zoneid'][index])
+    if current:
+        groups.append(np.array(current))
+    return groups
+
+def get_zone_groups(min_zoneid, max_zoneid, width):
+    '''
+    Split the zones min_zoneid to max_zoneid into (first, last) groups of width zones.
+    '''
+    return [(start, min(start + width - 1, max_zoneid)) for start in range(min_zoneid, max_zoneid + 1, width)]
+
+def format_double(value):
+    '''
+    SQL literal of a double which Athena parses back to the same double.
+    '''
+    return '{:.17e}'.format(value)
+
+def get_unload_query(query):
+    '''
+    Query writing the rows of a SELECT query as PARQUET files to a location, given as its last argument.
+    '''
+    return 'UNLOAD (' + query.strip().rstrip(';') + """)
+            TO '{}'
+            WITH (format = 'PARQUET', compression = 'SNAPPY');"""
+
+def fetch_csv(s3_client, bucket, key, download_path):
+    '''
+    Download the CSV result of a query to download_path.
+    '''
+    with tracing.span('fetch', key=key) as fetch:
+        s3_client.download_file(bucket, key, download_path)
+        fetch.set(bytes=os.path.getsize(download_path))
+
+def parse_csv(path):
+    '''
+    Read a downloaded CSV result into Arrow, with the gPhoton names and dtypes.
+    '''
+    with tracing.span('parse', key=os.path.basename(path)) as parse:
+        tbl = cast_to_schema(pcsv.read_csv(path, convert_options=pcsv.ConvertOptions(column_types=csv_column_types)))
+        parse.set(rows=tbl.num_rows)
+    return tbl
+
+def read_csv_table(s3_client, bucket, key, download_path):
+    '''
+    Download the CSV result of a query and read it into Arrow, with the gPhoton names and dtypes.
+    '''
+    fetch_csv(s3_client, bucket, key, download_path)
+    tbl = parse_csv(download_path)
+    os.remove(download_path)
+    return tbl
+
+def read_parquet_result(s3_client, bucket, prefix, result_schema=schema):
+    '''
+    Read the PARQUET files an UNLOAD query wrote below prefix into one table with the gPhoton dtypes,
+    then delete them. An UNLOAD finding no rows writes no files, which gives an empty table of
+    result_schema.
+    '''
+    tables = []
+    keys = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            with tracing.span('fetch', key=item['Key']) as fetch:
+                body = s3_client.get_object(Bucket=bucket, Key=item['Key'])['Body'].read()
+                fetch.set(bytes=len(body))
+            with tracing.span('parse', key=item['Key']) as parse:
+                tables.append(cast_to_schema(pq.read_table(pa.BufferReader(body))))
+                parse.set(rows=tables[-1].num_rows)
+            keys.append({'Key': item['Key']})
+    for index in range(0, len(keys), 1000):
+        s3_client.delete_objects(Bucket=bucket, Delete={'Objects': keys[index:index+1000]})
+    return pa.concat_tables(tables) if tables else result_schema.empty_table()
+
+class ResultWriter:
+    '''
+    Sink writing the rows found to a new file in local_output_location as csv, parquet, feather (lz4
+    compressed Arrow IPC) or arrow (uncompressed Arrow IPC, which open_result memory-maps without
+    copying), one table or record batch at a time.
+    '''
+    def __init__(self, local_output_location, output_format, schema):
+        if output_format not in output_formats:
+            raise ValueError('Unknown output format {}'.format(output_format))
+        self.output_location = os.path.join(local_output_location, '{}.{}'.format(uuid4(), output_format))
+        self.sink = None
+        if output_format == 'csv':
+            # an unquoted header, as pandas writes it
+            self.sink = pa.OSFile(self.output_location, 'wb')
+            self.sink.write((','.join(schema.names) + '\n').encode())
+            self.writer = pcsv.CSVWriter(self.sink, schema,
+                                         write_options=pcsv.WriteOptions(include_header=False, quoting_style='needed'))
+        elif output_format == 'parquet':
+            self.writer = pq.ParquetWriter(self.output_location, schema)
+        else:
+            self.writer = pa.ipc.new_file(self.output_location, schema, options=pa.ipc.IpcWriteOptions(
+                compression='lz4' if output_format == 'feather' else None))
+
+    def write(self, data):
+        if isinstance(data, pa.RecordBatch):
+            self.writer.write_batch(data)
+        else:
+            self.writer.write_table(data)
+
+    def close(self):
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+        print('\nData written to {}\n'.format(self.output_location))
+        return self.output_location
+
+def write_result(tbl, local_output_location, output_format):
+    '''
+    Write the rows found, a table or a DataFrame, to a new file in local_output_location with
+    ResultWriter. Nothing is written when local_output_location is None.
+    '''
+    if local_output_location is None:
+        return None
+    tbl = tbl if isinstance(tbl, pa.Table) else pa.Table.from_pandas(tbl, preserve_index=False)
+    with tracing.span('write', output_format=output_format, rows=tbl.num_rows) as write:
+        writer = ResultWriter(local_output_location, output_format, tbl.schema)
+        writer.write(tbl)
+        output_location = writer.close()
+        write.set(bytes=os.path.getsize(output_location))
+    return output_location
+
+def open_result(output_location):
+    '''
+    Table of a result written by write_result. Arrow IPC files (arrow, feather) are memory-mapped, so
+    the columns of an uncompressed arrow file are read without copying them.
+    '''
+    extension = os.path.splitext(output_location)[1].lstrip('.')
+    if extension in ('arrow', 'feather'):
+        return pa.ipc.open_file(pa.memory_map(output_location)).read_all()
+    if extension == 'parquet':
+        return pq.read_table(output_location)
+    return pcsv.read_csv(output_location)
+
+def to_result(tbl, as_arrow):
+    '''
+    The rows found as the table itself, or as a DataFrame converted from it without consolidating the
+    columns into blocks, so that numeric columns of one chunk without nulls are not copied.
+    '''
+    return tbl if as_arrow else tbl.to_pandas(split_blocks=True)
+
+@tracing.traced('cone_search')
 def cone_search(ra, dec, radius, time_start, time_end, flag,
                 aws_profile, aws_region, s3_output_location, local_output_location,
-                athena_database, athena_workgroup, query_life=10, wait_time=0.1, single_query=True):
-    
-    def query_athena(query, query_args):
-        query = query.format(*query_args)
-        response = athena_client.start_query_execution(
-            QueryString=query,
-            QueryExecutionContext={
-                'Database': athena_database
-            },
-            ResultConfiguration={
-                'OutputLocation': s3_output_location
-            },
-            WorkGroup=athena_workgroup
-        )
-        print('Query submitted:\n{}\n'.format(query))
-        rsp = athena_client.get_query_execution(QueryExecutionId=response['QueryExecutionId'])
-        succeeded_query = True if rsp['QueryExecution']['Status']['State'] == 'SUCCEEDED' else False
-        num_sec_query_has_been_running = 0
-        # check to see if the query has succeeded
-        while not succeeded_query:
-            if num_sec_query_has_been_running >= query_life:
-                print('QUERY CANCELLED: Query {} has been running for ~{} seconds.'.format(response['QueryExecutionId'],
-                                                                                           num_sec_query_has_been_running))
-                _ = athena_client.stop_query_execution(QueryExecutionId=response['QueryExecutionId'])
-                return None
-            if num_sec_query_has_been_running % 60 == 0 and num_sec_query_has_been_running:
-                duration = int(num_sec_query_has_been_running/60)
-                word = 'minutes' if duration > 1 else 'minute'
-                print('...Query has been running for ~{} {}.'.format(duration, word))
-            # wait until query has succeeded to start the next query
-            if num_sec_query_has_been_running + wait_time > query_life:
-                sleep_time = query_life - num_sec_query_has_been_running
-            else:
-                sleep_time = wait_time
-            time.sleep(sleep_time)
-            num_sec_query_has_been_running += sleep_time
-            rsp = athena_client.get_query_execution(QueryExecutionId=response['QueryExecutionId'])
-            succeeded_query = True if rsp['QueryExecution']['Status']['State'] == 'SUCCEEDED' else False
-        return response['QueryExecutionId']
-            
-                
+                athena_database, athena_workgroup, query_life=10, wait_time=0.1, single_query=True,
+                sky_index=False, cache=None, result_format='csv', output_format=None, strategy=None,
+                zone_width=1, planner=None, layout=None, streaming=False, as_arrow=False):
+    '''
+    Rows of the cone and time window with the given flag, queried with Athena.
+
+    The zones of the cone are queried with one of the strategies of query_planner.QueryPlanner:
+    'single' (one zoneID BETWEEN query), 'per-zone' (one query with a UNION ALL of a SELECT per zone)
+    or 'grouped' (concurrent queries of zone_width zones each). The strategy defaults to 'single', or
+    'per-zone' when single_query is False. With a planner the cheapest strategy is chosen instead, and
+    its prediction is logged next to the observed time.
+
+    With a layout (the spec of generate_directory.py, or the path to it) each SELECT also filters on
+    the zone and ra_slab partition keys registered by register_partitions.py, so that Athena only
+    reads the RA slabs the cone touches, and a cone wrapping past 360 is one SELECT over both slabs
+    instead of a UNION ALL.
+
+    With a cache (result_cache.ResultCache) the rows of a query that was cached, or that is
+    contained in a cached query, are read from it instead, and the rows queried are cached.
+
+    With result_format='parquet' Athena UNLOADs the rows as PARQUET files below s3_output_location,
+    which are read straight into Arrow instead of downloading and parsing a CSV. With streaming=True
+    the CSV results are fetched with concurrent ranged GETs and parsed as they arrive (result_stream.py)
+    instead of downloaded to disk first.
+
+    The results of the queries are read into Arrow and concatenated as the chunks of one table, which
+    is returned as is with as_arrow=True, or else as a DataFrame converted from it. Writing the rows
+    is optional: unless local_output_location is None they are also written there as output_format:
+    csv, parquet, feather or arrow (default: csv for CSV results, parquet for PARQUET results).
+    '''
+    if output_format is None:
+        output_format = 'csv' if result_format == 'csv' else 'parquet'
+    tracing.current().set(ra=ra, dec=dec, radius=radius, result_format=result_format)
+
+    if cache is not None:
+        start_time = time.time()
+        with tracing.span('cache.get') as cache_get:
+            tbl = cache.get(athena_database, ra, dec, radius, time_start, time_end, flag, as_arrow=True)
+            cache_get.set(hit=tbl is not None)
+        if tbl is not None:
+            print('Time taken to read from cache: ~{:.4f} seconds'.format(time.time()-start_time))
+            write_result(tbl, local_output_location, output_format)
+            print(tbl.slice(0, 5).to_pandas())
+            return to_result(tbl, as_arrow)
+
     sess = boto3.Session(profile_name=aws_profile,
                          region_name=aws_region)
     athena_client = sess.client('athena')
@@ -71,7 +334,7 @@ def cone_search(ra, dec, radius, time_start, time_end, flag,
         'single': '''
             SELECT *
             FROM gPhoton_partitioned
-            WHERE zoneID BETWEEN {} AND {}
+            WHERE zoneID BETWEEN {} AND {}{}
                 AND dec BETWEEN {} AND {}
                 AND ra BETWEEN {} AND {}
                 AND ({}*cx + {}*cy + {}*cz) > {}
@@ -81,81 +344,255 @@ def cone_search(ra, dec, radius, time_start, time_end, flag,
         'multiple': '''
             SELECT *
             FROM gPhoton_partitioned
-            WHERE zoneID = {}
+            WHERE zoneID = {}{}
                 AND dec BETWEEN {} AND {}
                 AND ra BETWEEN {} AND {}
                 AND ({}*cx + {}*cy + {}*cz) > {}
                 AND time >= {} AND time < {}
                 AND flag = {};
+         ''',
+        'pruned': '''
+            SELECT *
+            FROM gPhoton_partitioned
+            WHERE {}
+                AND zoneID BETWEEN {} AND {}{}
+                AND dec BETWEEN {} AND {}
+                AND ({})
+                AND ({}*cx + {}*cy + {}*cz) > {}
+                AND time >= {} AND time < {}
+                AND flag = {};
          '''
     }
     
-    cx = math.cos(math.radians(dec)) * math.cos(math.radians(ra))
-    cy = math.cos(math.radians(dec)) * math.sin(math.radians(ra))
-    cz = math.sin(math.radians(dec))
-    alpha = get_alpha(radius, dec)
-    if (ra - alpha) < 0:
-        ra = ra + 360
-    zoneHeight = 30.0/3600.0
-    min_zoneid = int(np.floor((dec - radius + 90.0) / zoneHeight))
-    max_zoneid = int(np.floor((dec + radius + 90.0) / zoneHeight))
+    plan_start = time.time()
+    plan = get_search_plan(ra, dec, radius)
+    min_zoneid, max_zoneid = plan['min_zoneid'], plan['max_zoneid']
+    # prune by the sky pixels covering the cone before the exact dot-product test
+    hpx_predicate = ''
+    if sky_index:
+        hpx_predicate = '\n                AND ' + get_range_predicate(cone_ranges(plan['ra'], dec, radius))
     
     query_args_collection = {
-        'non-conditional': [
-            dec - radius, dec + radius,
-            ra - alpha, ra + alpha,
-            cx, cy, cz, math.cos(math.radians(radius)),
-            time_start, time_end,
-            flag
-        ],
-        'conditional': [
-            dec - radius, dec + radius,
-            0, ra - 360 + alpha,
-            cx, cy, cz, math.cos(math.radians(radius)),
+        name: [
+            hpx_predicate,
+            *plan['dec_range'],
+            *ra_range,
+            plan['cx'], plan['cy'], plan['cz'], plan['cos_radius'],
             time_start, time_end,
             flag
         ]
+        for name, ra_range in zip(['non-conditional', 'conditional'], plan['ra_ranges'])
     }
 
-    query_collection = ''
-    query_argument_collection = []
-    for zoneid in range(min_zoneid, max_zoneid+1):
-        query = queries['single'] if single_query else queries['multiple']
-        zone_args = [min_zoneid, max_zoneid] if single_query else [zoneid]
-        query_args = zone_args + query_args_collection['non-conditional']
-        if (ra + alpha) > 360:
-            query = query.replace(';', '') + '\n            UNION ALL\n' + query
-            additional_args = [min_zoneid, max_zoneid] if single_query else [zoneid]
-            query_args = query_args + additional_args + query_args_collection['conditional']
-        temp_query = query.replace(';', '') + '\n            UNION ALL\n' if not single_query and zoneid != max_zoneid else query
-        query_collection += temp_query
-        query_argument_collection.extend(query_args)
-        if single_query:
-            break
+    if planner is not None:
+        estimate = planner.choose(plan)
+        strategy, zone_width = estimate['strategy'], estimate['width']
+        print('Planned strategy: {} (width {}), ~{:.4f} seconds predicted'.format(strategy, zone_width,
+                                                                                estimate['predicted_seconds']))
+    elif strategy is None:
+        strategy = 'single' if single_query else 'per-zone'
+
+    router = None
+    if layout is not None:
+        router = PartitionRouter.from_layout('', load_layout(layout) if isinstance(layout, str) else layout)
+
+    def get_query(template, zone_args_list):
+        # a SELECT per zone argument list, and per RA range of the cone, joined by UNION ALL
+        query_collection = ''
+        query_argument_collection = []
+        for index, zone_args in enumerate(zone_args_list):
+            query = template
+            query_args = list(zone_args) + query_args_collection['non-conditional']
+            if router is not None:
+                # one SELECT over the RA slabs of both ranges of a wrapping cone
+                query = queries['pruned']
+                zone_min, zone_max = zone_args[0], zone_args[-1]
+                query_args = [
+                    get_partition_predicate(router, select_partitions(router, zone_min, zone_max, plan['ra_ranges'])),
+                    zone_min, zone_max,
+                    hpx_predicate,
+                    *plan['dec_range'],
+                    ' OR '.join('ra BETWEEN {} AND {}'.format(*ra_range) for ra_range in plan['ra_ranges']),
+                    plan['cx'], plan['cy'], plan['cz'], plan['cos_radius'],
+                    time_start, time_end,
+                    flag
+                ]
+            elif 'conditional' in query_args_collection:
+                query = query.replace(';', '') + '\n            UNION ALL\n' + query
+                query_args = query_args + list(zone_args) + query_args_collection['conditional']
+            temp_query = query.replace(';', '') + '\n            UNION ALL\n' if index != len(zone_args_list) - 1 else query
+            query_collection += temp_query
+            query_argument_collection.extend(query_args)
+        return query_collection, query_argument_collection
+
+    if strategy == 'per-zone':
+        zone_ranges = [(min_zoneid, max_zoneid)]
+        zone_queries = [get_query(queries['multiple'], [[zoneid] for zoneid in range(min_zoneid, max_zoneid+1)])]
+    elif strategy in ('single', 'grouped'):
+        zone_ranges = [(min_zoneid, max_zoneid)] if strategy == 'single' else get_zone_groups(min_zoneid, max_zoneid,
+                                                                                              zone_width)
+        zone_queries = [get_query(queries['single'], [zone_range]) for zone_range in zone_ranges]
+    else:
+        raise ValueError('Unknown strategy {}'.format(strategy))
+    if result_format == 'parquet':
+        unload_prefixes = [os.path.join(additional_s3_path, 'unload', str(uuid4())) + '/' for _ in zone_queries]
+        zone_queries = [(get_unload_query(query), query_args + ['s3://{}/{}'.format(bucket, prefix)])
+                        for (query, query_args), prefix in zip(zone_queries, unload_prefixes)]
+    tracing.record_span('plan', plan_start, time.time(), strategy=strategy, queries=len(zone_queries))
     start_time = time.time()
-    execution_id = query_athena(query_collection, query_argument_collection)
-    print('Time taken to query: ~{:.4f} seconds'.format(time.time()-start_time))
-
-    # get single CSV or accumulate the CSVs from the different SELECT statements
-    dfs = []
-    download_paths = []
-    if execution_id is not None:
-        path_to_csv = os.path.join(additional_s3_path, execution_id + '.csv')
-        download_path = os.path.join(local_output_location, execution_id + '.csv')
+    with tracing.span('athena', queries=len(zone_queries)):
+        executions = run_queries(athena_client, [query.format(*query_args) for query, query_args in zone_queries],
+                                 athena_database, s3_output_location, athena_workgroup,
+                                 query_life=query_life, min_wait=wait_time)
+        trace_executions(executions, [{'zoneID_min': zone_min, 'zoneID_max': zone_max}
+                                      for zone_min, zone_max in zone_ranges])
+    succeeded = all(execution['state'] == 'SUCCEEDED' for execution in executions)
+    elapsed = time.time()-start_time
+    print('Time taken to query: ~{:.4f} seconds'.format(elapsed))
+    if planner is not None:
+        planner.record(estimate, elapsed if succeeded else None, executions)
+
+    # get the CSVs, or the PARQUET files of the UNLOADs
+    if succeeded:
         start_time = time.time()
-        s3_client.download_file(bucket,
-                                path_to_csv,
-                                download_path)
+        keys = [os.path.join(additional_s3_path, execution['execution_id'] + '.csv') for execution in executions]
+        with tracing.span('download', streaming=streaming) as download:
+            if result_format == 'parquet':
+                tbl = pa.concat_tables([read_parquet_result(s3_client, bucket, prefix) for prefix in unload_prefixes])
+            elif streaming:
+                tbl = read_csv_stream(s3_client, bucket, keys)
+            else:
+                download_location = (local_output_location if local_output_location is not None
+                                     else tempfile.gettempdir())
+                tbl = pa.concat_tables([read_csv_table(s3_client, bucket, key,
+                                                       os.path.join(download_location, os.path.basename(key)))
+                                        for key in keys])
+            download.set(rows=tbl.num_rows, bytes=tbl.nbytes)
         print('Time taken to download: ~{:.4f} seconds'.format(time.time()-start_time))
-        dfs.append(pd.read_csv(download_path, engine='python'))
-        download_paths.append(download_path)
-    if len(dfs):
-        df = pd.concat(dfs)
-        output_location = os.path.join(local_output_location, str(uuid4()) + '.csv')
-        df.to_csv(output_location, index=False)
-        print('\nData written to {}\n'.format(output_location))
-        for download_path in download_paths:
-            os.remove(download_path)
-        print(df.head())
+        write_result(tbl, local_output_location, output_format)
+        print(tbl.slice(0, 5).to_pandas())
+        if cache is not None:
+            scanned = [execution['statistics'].get('DataScannedInBytes') for execution in executions]
+            cache.put(athena_database, ra, dec, radius, time_start, time_end, flag, tbl,
+                      sum(scanned) if None not in scanned else None)
+        return to_result(tbl, as_arrow)
     else:
+        tracing.current().set(failed=True)
         print('No CSVs were found.')
+
+batch_query = '''
+            WITH targets (target_id, zone_min, zone_max, dec_min, dec_max, ra_min, ra_max, cx, cy, cz, cos_radius) AS (
+                VALUES
+                    {}
+            )
+            SELECT targets.target_id, gPhoton_partitioned.*
+            FROM gPhoton_partitioned
+            JOIN targets
+                ON gPhoton_partitioned.zoneID BETWEEN targets.zone_min AND targets.zone_max
+                AND gPhoton_partitioned.dec BETWEEN targets.dec_min AND targets.dec_max
+                AND gPhoton_partitioned.ra BETWEEN targets.ra_min AND targets.ra_max
+                AND (targets.cx*gPhoton_partitioned.cx + targets.cy*gPhoton_partitioned.cy +
+                     targets.cz*gPhoton_partitioned.cz) > targets.cos_radius
+            WHERE gPhoton_partitioned.zoneID BETWEEN {} AND {}
+                AND gPhoton_partitioned.dec BETWEEN {} AND {}
+                AND gPhoton_partitioned.time >= {} AND gPhoton_partitioned.time < {}
+                AND gPhoton_partitioned.flag = {};
+         '''
+
+def get_batch_query(plans, targets, target_ids, time_start, time_end, flag):
+    '''
+    Query of a combined scan: the targets are joined to the rows of the zones and decs they span,
+    one row of the targets table per RA range.
+    '''
+    values = []
+    for index in np.flatnonzero(np.isin(plans['range_target'], targets)):
+        target = plans['range_target'][index]
+        values.append('({}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {})'.format(
+            target_ids[target], plans['min_zoneid'][target], plans['max_zoneid'][target],
+            *[format_double(value) for value in [plans['dec_min'][target], plans['dec_max'][target],
+                                                 plans['range_min'][index], plans['range_max'][index],
+                                                 plans['cx'][target], plans['cy'][target], plans['cz'][target],
+                                                 plans['cos_radius'][target]]]))
+    return batch_query.format(',\n                    '.join(values),
+                              plans['min_zoneid'][targets].min(), plans['max_zoneid'][targets].max(),
+                              format_double(plans['dec_min'][targets].min()),
+                              format_double(plans['dec_max'][targets].max()),
+                              time_start, time_end, flag)
+
+@tracing.traced('cone_search_batch')
+def cone_search_batch(ra, dec, radius, time_start, time_end, flag,
+                      aws_profile, aws_region, s3_output_location, local_output_location,
+                      athena_database, athena_workgroup, query_life=10, wait_time=0.1, max_targets=500,
+                      target_ids=None, result_format='csv', output_format=None, streaming=False, as_arrow=False):
+    '''
+    Cone search many targets with one Athena query per group of targets sharing zones.
+
+    Parameters
+    ----------
+    ra, dec, radius: array_like
+        centers and radii of the cones in degrees
+    time_start, time_end, flag:
+        filters shared by all the targets, as in cone_search
+    max_targets: int
+        maximum number of targets per query
+    target_ids: array_like
+        integer id of each target (default: index of the target)
+    result_format, output_format, streaming, as_arrow:
+        as in cone_search; local_output_location may also be None
+
+    Returns
+    -------
+    pandas.DataFrame or pyarrow.Table
+        rows in the cones, with the id of the target of each row in a target_id column; a row in
+        several cones is returned once per target
+    '''
+    if output_format is None:
+        output_format = 'csv' if result_format == 'csv' else 'parquet'
+    plans = get_search_plans(ra, dec, radius)
+    num_targets = len(plans['cx'])
+    target_ids = np.arange(num_targets) if target_ids is None else np.asarray(target_ids)
+    sess = boto3.Session(profile_name=aws_profile,
+                         region_name=aws_region)
+    athena_client = sess.client('athena')
+    s3_client = sess.client('s3')
+    bucket = s3_output_location.replace('s3://', '').split('/')[0]
+    additional_s3_path = s3_output_location.replace('s3://{}/'.format(bucket), '')
+
+    # the groups run concurrently
+    start_time = time.time()
+    groups = group_targets(plans, max_targets)
+    queries = [get_batch_query(plans, targets, target_ids, time_start, time_end, flag) for targets in groups]
+    if result_format == 'parquet':
+        unload_prefixes = [os.path.join(additional_s3_path, 'unload', str(uuid4())) + '/' for _ in queries]
+        queries = [get_unload_query(query).format('s3://{}/{}'.format(bucket, prefix))
+                   for query, prefix in zip(queries, unload_prefixes)]
+    with tracing.span('athena', queries=len(queries), targets=num_targets):
+        executions = run_queries(athena_client, queries, athena_database, s3_output_location, athena_workgroup,
+                                 query_life=query_life, min_wait=wait_time)
+        trace_executions(executions, [{'targets': len(targets)} for targets in groups])
+    execution_ids = [execution['execution_id'] if execution['state'] == 'SUCCEEDED' else None
+                     for execution in executions]
+    elapsed = time.time()-start_time
+    print('Time taken to query {} targets in {} queries: ~{:.4f} seconds ({:,.0f} targets/minute)'.format(
+        num_targets, len(groups), elapsed, 60*num_targets/elapsed))
+
+    succeeded = [index for index, execution_id in enumerate(execution_ids) if execution_id is not None]
+    keys = [os.path.join(additional_s3_path, execution_ids[index] + '.csv') for index in succeeded]
+    if not succeeded:
+        tables = []
+    elif result_format == 'parquet':
+        tables = [read_parquet_result(s3_client, bucket, unload_prefixes[index], batch_schema) for index in succeeded]
+    elif streaming:
+        tables = [read_csv_stream(s3_client, bucket, keys, batch_schema)]
+    else:
+        download_location = local_output_location if local_output_location is not None else tempfile.gettempdir()
+        tables = [read_csv_table(s3_client, bucket, key, os.path.join(download_location, os.path.basename(key)))
+                  for key in keys]
+    # a group of targets far from any source gives an empty table, without the schema of the others
+    tables = [table for table in tables if table.num_rows]
+    if not tables:
+        print('No results were found.')
+        return to_result(batch_schema.empty_table(), as_arrow)
+    tbl = pa.concat_tables(tables)
+    write_result(tbl, local_output_location, output_format)
+    return to_result(tbl, as_arrow)
@@ -0,0 +1,68 @@
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from cone_search_local import cone_search_local, cone_search_local_batch, get_router
+
+parser = argparse.ArgumentParser(description='Compare the throughput of one cone search per target with batched cone searches.')
+parser.add_argument('path', help='Path to folder containing the zoneID partitions.')
+parser.add_argument('-t', '--targets', default=None, metavar='',
+                    help='Path to a CSV of targets with ra, dec and radius columns (default: random targets).')
+parser.add_argument('-n', '--numtargets', default=1000, type=int, metavar='',
+                    help='Number of random targets (default=1000).')
+parser.add_argument('-r', '--radius', default=0.008333333, type=float, metavar='',
+                    help='Radius of the random targets (default=0.008333333).')
+parser.add_argument('-s', '--timestart', default=0, type=int, metavar='',
+                    help='Start time to be searched in query (default=0).')
+parser.add_argument('-e', '--timeend', default=2**62, type=int, metavar='',
+                    help='End time to be searched in query (default=2**62).')
+parser.add_argument('-f', '--flag', default=0, type=int, metavar='',
+                    help='Flag to be searched in query (default=0).')
+parser.add_argument('-m', '--maxtargets', default=500, type=int, metavar='',
+                    help='Maximum number of targets per batched scan (default=500).')
+parser.add_argument('-l', '--limit', default=100, type=int, metavar='',
+                    help='Number of targets searched one at a time to estimate its throughput (default=100).')
+args = parser.parse_args()
+
+
+def get_random_targets(path, num_targets, radius, seed=0):
+    '''
+    Targets spread over the zones with partitions in path.
+    '''
+    zone_ids = get_router(path).zone_ids
+    zoneHeight = 30.0/3600.0
+    rng = np.random.default_rng(seed)
+    dec = (zone_ids.min() + rng.random(num_targets)*(zone_ids.max() + 1 - zone_ids.min()))*zoneHeight - 90.0
+    return pd.DataFrame({'ra': rng.uniform(0, 360, num_targets), 'dec': dec, 'radius': radius})
+
+
+if __name__ == '__main__':
+    if args.targets is not None:
+        targets = pd.read_csv(args.targets)
+    else:
+        targets = get_random_targets(args.path, args.numtargets, args.radius)
+    num_targets = len(targets)
+
+    start = time.time()
+    batch = cone_search_local_batch(targets['ra'], targets['dec'], targets['radius'], args.timestart, args.timeend,
+                                    args.flag, args.path, max_targets=args.maxtargets)
+    batch_elapsed = time.time()-start
+
+    limit = min(args.limit, num_targets)
+    counts = batch['target_id'].value_counts() if len(batch) else pd.Series(dtype=np.int64)
+    num_mismatches = 0
+    start = time.time()
+    for target_id in range(limit):
+        df = cone_search_local(targets['ra'][target_id], targets['dec'][target_id], targets['radius'][target_id],
+                               args.timestart, args.timeend, args.flag, args.path)
+        num_mismatches += len(df) != counts.get(target_id, 0)
+    single_elapsed = time.time()-start
+
+    print('\nRESULTS\n')
+    print('Targets: {:,}, rows found: {:,}'.format(num_targets, len(batch)))
+    print('One search per target ({} targets): ~{:.4f} seconds ({:,.0f} targets/minute)'.format(
+        limit, single_elapsed, 60*limit/single_elapsed))
+    print('Batched searches: ~{:.4f} seconds ({:,.0f} targets/minute)'.format(batch_elapsed,
+                                                                             60*num_targets/batch_elapsed))
+    print('Targets whose row counts differ between the two: {}'.format(num_mismatches))
@@ -0,0 +1,290 @@
+import os
+import time
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from cone_search import get_search_plan, get_search_plans, group_targets, write_result, to_result
+from gphoton_schema import schema, batch_schema
+from partition_layout import PartitionRouter
+from sky_index import cone_ranges
+
+routers = {}
+
+
+def get_router(path):
+    '''
+    Router over the partitions in path, built on first use.
+    '''
+    if path not in routers:
+        routers[path] = PartitionRouter.from_path(path)
+    return routers[path]
+
+
+def get_partition_files(router, partition_ids):
+    '''
+    PARQUET files of the partitions.
+    '''
+    files = []
+    for partition_id in partition_ids:
+        path = router.paths[partition_id]
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, file) for file in sorted(os.listdir(path)) if file.endswith('.parquet'))
+    return files
+
+
+def get_files(router, plan, ra_range):
+    '''
+    PARQUET files of the partitions overlapping the zones of the plan and an RA range.
+    '''
+    return get_partition_files(router, router.get_partitions(plan['min_zoneid'], plan['max_zoneid'], *ra_range))
+
+
+def get_box_expression(plan, ra_range, time_start, time_end, flag):
+    '''
+    Dataset expression of the zone, dec and RA box and the time and flag filters, used to prune row groups.
+    '''
+    field = ds.field
+    return ((field('zoneID') >= plan['min_zoneid']) & (field('zoneID') <= plan['max_zoneid']) &
+            (field('dec') >= plan['dec_range'][0]) & (field('dec') <= plan['dec_range'][1]) &
+            (field('ra') >= ra_range[0]) & (field('ra') <= ra_range[1]) &
+            (field('time') >= time_start) & (field('time') < time_end) &
+            (field('flag') == flag))
+
+
+def get_mask(tbl, plan, ra_range, time_start, time_end, flag, hpx_ranges=None):
+    '''
+    Rows of the table matching the WHERE clause cone_search sends to Athena, for one RA range.
+    '''
+    columns = {name: tbl[name].to_numpy() for name in ['zoneID', 'dec', 'ra', 'cx', 'cy', 'cz', 'time', 'flag']}
+    mask = (columns['zoneID'] >= plan['min_zoneid']) & (columns['zoneID'] <= plan['max_zoneid'])
+    mask &= (columns['dec'] >= plan['dec_range'][0]) & (columns['dec'] <= plan['dec_range'][1])
+    mask &= (columns['ra'] >= ra_range[0]) & (columns['ra'] <= ra_range[1])
+    mask &= (plan['cx']*columns['cx'] + plan['cy']*columns['cy'] + plan['cz']*columns['cz']) > plan['cos_radius']
+    mask &= (columns['time'] >= time_start) & (columns['time'] < time_end)
+    mask &= columns['flag'] == flag
+    if hpx_ranges is not None:
+        hpx = tbl['hpx'].to_numpy()
+        in_ranges = np.zeros(len(hpx), dtype=bool)
+        for first, last in hpx_ranges:
+            in_ranges |= (hpx >= first) & (hpx <= last)
+        mask &= in_ranges
+    return mask
+
+
+def prune(files, expression):
+    '''
+    Dataset of the row groups of the files whose statistics may match the expression.
+
+    Returns
+    -------
+    tuple
+        (pruned dataset, number of row groups kept, number of row groups in the files)
+    '''
+    dataset = ds.dataset(files, format='parquet')
+    fragments = []
+    num_row_groups = 0
+    for fragment in dataset.get_fragments():
+        num_row_groups += fragment.num_row_groups
+        fragments.extend(fragment.split_by_row_group(expression, schema=dataset.schema))
+    pruned = ds.FileSystemDataset(fragments, dataset.schema, dataset.format, filesystem=dataset.filesystem)
+    return pruned, len(fragments), num_row_groups
+
+
+def scan(files, expression, mask_function):
+    '''
+    Read the row groups of the files whose statistics may match the expression and keep the rows selected
+    by mask_function.
+
+    Returns
+    -------
+    tuple
+        (list of tables, number of row groups read, number of row groups in the files)
+    '''
+    pruned, num_read, num_row_groups = prune(files, expression)
+    tables = [pruned.schema.empty_table()]
+    for batch in pruned.to_batches():
+        tbl = pa.Table.from_batches([batch])
+        mask = mask_function(tbl)
+        if mask.any():
+            tables.append(tbl.filter(pa.array(mask)))
+    return tables, num_read, num_row_groups
+
+
+def cone_search_local(ra, dec, radius, time_start, time_end, flag, path, local_output_location=None,
+                      sky_index=False, output_format='csv', as_arrow=False):
+    '''
+    Run the plan of cone_search directly over the partitioned PARQUET files in path.
+
+    Partitions are pruned by zoneID and RA folder and row groups by their statistics; the exact
+    filters are then applied with NumPy. The rows are those the Athena query of cone_search returns,
+    including the repeats a query split around RA 360 can return.
+
+    Parameters
+    ----------
+    ra, dec, radius: float
+        center and radius of the cone in degrees
+    time_start, time_end: int
+        time range searched, end excluded
+    flag: int
+        flag of the rows returned
+    path: str
+        path to the folder containing the zoneID partitions
+    local_output_location: str
+        folder to write the rows to, like cone_search does (default: not written)
+    sky_index: bool
+        also require the hpx sky pixel of a row to be in the cover of the cone
+    output_format: str
+        format of the file written: csv, parquet, feather or arrow
+    as_arrow: bool
+        return the pyarrow.Table of the rows instead of a DataFrame converted from it
+
+    Returns
+    -------
+    pandas.DataFrame or pyarrow.Table
+        rows in the cone
+    '''
+    plan = get_search_plan(ra, dec, radius)
+    router = get_router(path)
+    hpx_ranges = cone_ranges(plan['ra'], dec, radius) if sky_index else None
+    tables = []
+    num_read = 0
+    num_row_groups = 0
+    for ra_range in plan['ra_ranges']:
+        files = get_files(router, plan, ra_range)
+        if not files:
+            continue
+        expression = get_box_expression(plan, ra_range, time_start, time_end, flag)
+        range_tables, range_num_read, range_num_row_groups = scan(
+            files, expression, lambda tbl: get_mask(tbl, plan, ra_range, time_start, time_end, flag, hpx_ranges))
+        tables.extend(range_tables)
+        num_read += range_num_read
+        num_row_groups += range_num_row_groups
+    print('Read {} of {} row groups.'.format(num_read, num_row_groups))
+    tbl = pa.concat_tables(tables) if tables else schema.empty_table()
+    write_result(tbl, local_output_location, output_format)
+    return to_result(tbl, as_arrow)
+
+
+def get_batch_matches(tbl, plans, ranges, time_start, time_end, flag):
+    '''
+    Rows of the table in the cones of the targets owning the RA ranges.
+
+    The rows are sorted by RA once; each range then only tests the rows of its RA slice.
+
+    Returns
+    -------
+    tuple
+        (indices of the rows, index of the target of each of them)
+    '''
+    columns = {name: tbl[name].to_numpy() for name in ['zoneID', 'dec', 'ra', 'cx', 'cy', 'cz', 'time', 'flag']}
+    keep = np.flatnonzero((columns['time'] >= time_start) & (columns['time'] < time_end) & (columns['flag'] == flag))
+    order = keep[np.argsort(columns['ra'][keep], kind='stable')]
+    sorted_ra = columns['ra'][order]
+    starts = np.searchsorted(sorted_ra, plans['range_min'][ranges], side='left')
+    ends = np.searchsorted(sorted_ra, plans['range_max'][ranges], side='right')
+    rows, targets = [], []
+    for index, start, end in zip(ranges, starts, ends):
+        if start == end:
+            continue
+        target = plans['range_target'][index]
+        candidates = order[start:end]
+        zone_ids = columns['zoneID'][candidates]
+        dec = columns['dec'][candidates]
+        mask = (zone_ids >= plans['min_zoneid'][target]) & (zone_ids <= plans['max_zoneid'][target])
+        mask &= (dec >= plans['dec_min'][target]) & (dec <= plans['dec_max'][target])
+        mask &= (plans['cx'][target]*columns['cx'][candidates] + plans['cy'][target]*columns['cy'][candidates] +
+                 plans['cz'][target]*columns['cz'][candidates]) > plans['cos_radius'][target]
+        rows.append(candidates[mask])
+        targets.append(np.full(mask.sum(), target))
+    if not rows:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(targets)
+
+
+def cone_search_local_batch(ra, dec, radius, time_start, time_end, flag, path, local_output_location=None,
+                            max_targets=500, target_ids=None, output_format='csv', as_arrow=False):
+    '''
+    Cone search many targets over the partitioned PARQUET files in path, reading the files of each
+    group of targets sharing zones once.
+
+    Parameters
+    ----------
+    ra, dec, radius: array_like
+        centers and radii of the cones in degrees
+    time_start, time_end, flag:
+        filters shared by all the targets, as in cone_search_local
+    max_targets: int
+        maximum number of targets per scan
+    target_ids: array_like
+        integer id of each target (default: index of the target)
+    output_format, as_arrow:
+        as in cone_search_local
+
+    Returns
+    -------
+    pandas.DataFrame or pyarrow.Table
+        rows in the cones, with the id of the target of each row in a target_id column; a row in
+        several cones is returned once per target
+    '''
+    plans = get_search_plans(ra, dec, radius)
+    target_ids = np.arange(len(plans['cx'])) if target_ids is None else np.asarray(target_ids)
+    router = get_router(path)
+    tables = []
+    for targets in group_targets(plans, max_targets):
+        ranges = np.flatnonzero(np.isin(plans['range_target'], targets))
+        partition_ids = set()
+        for index in ranges:
+            target = plans['range_target'][index]
+            partition_ids.update(router.get_partitions(plans['min_zoneid'][target], plans['max_zoneid'][target],
+                                                       plans['range_min'][index], plans['range_max'][index]))
+        files = get_partition_files(router, sorted(partition_ids))
+        if not files:
+            continue
+        group_plan = {'min_zoneid': plans['min_zoneid'][targets].min(),
+                      'max_zoneid': plans['max_zoneid'][targets].max(),
+                      'dec_range': (plans['dec_min'][targets].min(), plans['dec_max'][targets].max())}
+        expression = get_box_expression(group_plan, (plans['range_min'][ranges].min(), plans['range_max'][ranges].max()),
+                                        time_start, time_end, flag)
+        pruned, _, _ = prune(files, expression)
+        for batch in pruned.to_batches():
+            tbl = pa.Table.from_batches([batch])
+            rows, matched_targets = get_batch_matches(tbl, plans, ranges, time_start, time_end, flag)
+            if len(rows):
+                tables.append(tbl.take(pa.array(rows)).add_column(0, 'target_id',
+                                                                  pa.array(target_ids[matched_targets])))
+    tbl = pa.concat_tables(tables) if tables else batch_schema.empty_table()
+    write_result(tbl, local_output_location, output_format)
+    return to_result(tbl, as_arrow)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Cone search the partitioned PARQUET files on a local or mounted disk.')
+    parser.add_argument('path', help='Path to folder containing the zoneID partitions.')
+    parser.add_argument('ra', type=float, help='RA query parameter.')
+    parser.add_argument('dec', type=float, help='DEC query parameter.')
+    parser.add_argument('radius', type=float, help='Radius used to determine the zone to be searched.')
+    parser.add_argument('timestart', type=int, help='Start time to be searched in query.')
+    parser.add_argument('timeend', type=int, help='End time to be searched in query.')
+    parser.add_argument('flag', type=int, help='?')
+    parser.add_argument('-o', '--local_output_location', default=None, metavar='',
+                        help='Where to save the results (default: not saved).')
+    parser.add_argument('-f', '--outputformat', default='csv', choices=['csv', 'parquet', 'feather', 'arrow'],
+                        help='Format of the saved results; arrow files can be memory-mapped (default=csv).')
+    parser.add_argument('-x', '--skyindex', action='store_true',
+                        help='Prune with the hpx sky pixel column before the exact dot-product test.')
+    parser.add_argument('-i', '--numiterations', default=5, type=int, metavar='',
+                        help='Number of times to test the querying speed (default=5).')
+    args = parser.parse_args()
+    assert 0 <= args.ra <= 360, '0 <= RA <= 360.'
+    assert -90 <= args.dec <= 90, '-90 <= DEC <= 90.'
+    assert args.radius >= 0, 'Radius must be greater than or equal to 0.'
+
+    elapsed = []
+    for i in range(args.numiterations):
+        start = time.time()
+        df = cone_search_local(args.ra, args.dec, args.radius, args.timestart, args.timeend, args.flag, args.path,
+                               args.local_output_location if i == 0 else None, args.skyindex, args.outputformat)
+        elapsed.append(time.time()-start)
+        print('Found {:,} rows in ~{:.4f} seconds'.format(len(df), elapsed[-1]))
+    print('\nAverage query time after {} iterations: ~{:.4f} seconds'.format(args.numiterations, np.mean(elapsed)))
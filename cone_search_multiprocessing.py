@@ -2,17 +2,22 @@ import os
 import boto3
 import argparse
 import time
-from uuid import uuid4
 import numpy as np
 from numpy import math
-import pandas as pd
-import multiprocessing as mp
+import pyarrow as pa
+import tracing
+from cone_search import ResultWriter, write_result
+from gphoton_schema import schema
+from sky_index import cone_ranges, get_range_predicate
+from athena_orchestrator import run_queries, trace_executions
+from result_stream import iter_csv_batches
 
 
 class cone_search:
     def __init__(self, ra, dec, radius, time_start, time_end, flag,
                  aws_profile, aws_region, s3_output_location, local_output_location,
-                 athena_database, athena_workgroup, query_life=10, wait_time=0.1, single_query=True):
+                 athena_database, athena_workgroup, query_life=10, wait_time=0.1, single_query=True,
+                 sky_index=False, output_format='csv'):
         self.ra = ra
         self.dec = dec
         self.radius = radius
@@ -26,6 +31,8 @@ class cone_search:
         self.query_life = query_life
         self.wait_time = wait_time
         self.single_query = single_query
+        self.sky_index = sky_index
+        self.output_format = output_format
         sess = boto3.Session(profile_name=aws_profile,
                              region_name=aws_region)
         global athena_client, s3_client
@@ -37,7 +44,7 @@ class cone_search:
         self.query = '''
                 SELECT *
                 FROM gPhoton_partitioned
-                WHERE zoneID = {}
+                WHERE zoneID = {}{}
                 AND dec BETWEEN {} AND {}
                 AND ra BETWEEN {} AND {}
                 AND ({}*cx + {}*cy + {}*cz) > {}
@@ -55,9 +62,14 @@ class cone_search:
         self.zoneHeight = 30.0/3600.0
         self.min_zoneid = int(np.floor((self.dec - self.radius + 90.0) / self.zoneHeight))
         self.max_zoneid = int(np.floor((self.dec + self.radius + 90.0) / self.zoneHeight))
+        # prune by the sky pixels covering the cone before the exact dot-product test
+        self.hpx_predicate = ''
+        if self.sky_index:
+            self.hpx_predicate = '\n                AND ' + get_range_predicate(cone_ranges(self.ra, self.dec, self.radius))
     
         self.query_args_collection = {
             'non-conditional': [
+                self.hpx_predicate,
                 self.dec - self.radius, self.dec + self.radius,
                 self.ra - self.alpha, self.ra + self.alpha,
                 self.cx, self.cy, self.cz, math.cos(math.radians(self.radius)),
@@ -65,6 +77,7 @@ class cone_search:
                 self.flag
             ],
             'conditional': [
+                self.hpx_predicate,
                 self.dec - self.radius, self.dec + self.radius,
                 0, self.ra - 360 + self.alpha,
                 self.cx, self.cy, self.cz, math.cos(math.radians(self.radius)),
@@ -83,94 +96,60 @@ class cone_search:
                     )))
 
     
-    def _query_athena(self, query, query_args):
-        query = query.format(*query_args)
-        response = athena_client.start_query_execution(
-            QueryString=query,
-            QueryExecutionContext={
-                'Database': self.athena_database
-            },
-            ResultConfiguration={
-                'OutputLocation': self.s3_output_location
-            },
-            WorkGroup=self.athena_workgroup
-        )
-        print('Query submitted:\n{}\n'.format(query))
-        rsp = athena_client.get_query_execution(QueryExecutionId=response['QueryExecutionId'])
-        succeeded_query = True if rsp['QueryExecution']['Status']['State'] == 'SUCCEEDED' else False
-        num_sec_query_has_been_running = 0
-        # check to see if the query has succeeded
-        while not succeeded_query:
-            if num_sec_query_has_been_running >= self.query_life:
-                print('QUERY CANCELLED: Query {} has been running for ~{} seconds.'.format(response['QueryExecutionId'],
-                                                                                           num_sec_query_has_been_running))
-                _ = athena_client.stop_query_execution(QueryExecutionId=response['QueryExecutionId'])
-                return None
-            if num_sec_query_has_been_running % 60 == 0 and num_sec_query_has_been_running:
-                duration = int(num_sec_query_has_been_running/60)
-                word = 'minutes' if duration > 1 else 'minute'
-                print('...Query has been running for ~{} {}.'.format(duration, word))
-            # wait until query has succeeded to start the next query
-            if num_sec_query_has_been_running + self.wait_time > self.query_life:
-                sleep_time = self.query_life - num_sec_query_has_been_running
-            else:
-                sleep_time = self.wait_time
-            time.sleep(sleep_time)
-            num_sec_query_has_been_running += sleep_time
-            rsp = athena_client.get_query_execution(QueryExecutionId=response['QueryExecutionId'])
-            succeeded_query = True if rsp['QueryExecution']['Status']['State'] == 'SUCCEEDED' else False
-        return response['QueryExecutionId']
-    
-    
-    def _get_execution_id(self, zoneid):
+    def _get_query(self, zoneid):
         query = self.query
         query_args = [zoneid] + self.query_args_collection['non-conditional']
         if (self.ra + self.alpha) > 360:
             query = query.replace(';', '') + '\n            UNION ALL\n' + query
             query_args = query_args + [zoneid] + self.query_args_collection['conditional']
-        start_time = time.time()
-        execution_id = self._query_athena(query, query_args)
-        print('Time taken to query (Zone ID: {}; Execution ID: {}): ~{:.4f} seconds'.format(zoneid,
-                                                                                            execution_id,
-                                                                                            time.time()-start_time))
-        return execution_id
-    
-    
-    def _download_csvs(self, execution_id):
-        if execution_id is not None:
-            path_to_csv = os.path.join(self.additional_s3_path, execution_id + '.csv')
-            download_path = os.path.join(self.local_output_location, execution_id + '.csv')
-            start_time = time.time()
-            s3_client.download_file(self.bucket,
-                                    path_to_csv,
-                                    download_path)
-            print('Time taken to download (Execution ID: {}): ~{:.4f} seconds'.format(execution_id,
-                                                                                      time.time()-start_time))
-            return (download_path, pd.read_csv(download_path, engine='python'))
+        return query.format(*query_args)
     
+    @tracing.traced('cone_search.search_and_get')
     def search_and_get(self):
-        execution_ids = []
+        # the zone queries run concurrently from this process
         zoneid_range = list(range(self.min_zoneid, self.max_zoneid+1))
-        num_processes = os.cpu_count() if len(zoneid_range) >= os.cpu_count() else len(zoneid_range)
-        pool = mp.Pool(processes=num_processes)
-        for execution_id in pool.map(self._get_execution_id, zoneid_range):
-            execution_ids.append(execution_id)
+        tracing.current().set(ra=self.ra, dec=self.dec, radius=self.radius, zones=len(zoneid_range))
+        start_time = time.time()
+        with tracing.span('athena', queries=len(zoneid_range)):
+            executions = run_queries(athena_client, [self._get_query(zoneid) for zoneid in zoneid_range],
+                                     self.athena_database, self.s3_output_location, self.athena_workgroup,
+                                     query_life=self.query_life, min_wait=self.wait_time)
+            trace_executions(executions, [{'zoneID': zoneid} for zoneid in zoneid_range])
+        for zoneid, execution in zip(zoneid_range, executions):
+            print('Time taken to query (Zone ID: {}; Execution ID: {}): ~{:.4f} seconds'.format(zoneid,
+                                                                                                execution['execution_id'],
+                                                                                                execution['elapsed']))
+        print('Time taken to query {} zones: ~{:.4f} seconds'.format(len(zoneid_range), time.time()-start_time))
+        for zoneid, execution in zip(zoneid_range, executions):
+            if execution['state'] != 'SUCCEEDED':
+                print('QUERY {} (Zone ID: {}; Execution ID: {}): {}'.format(execution['state'], zoneid,
+                                                                            execution['execution_id'],
+                                                                            execution['reason']))
+        execution_ids = [execution['execution_id'] for execution in executions if execution['state'] == 'SUCCEEDED']
         
-        download_paths = []
-        dfs = []
-        num_processes = os.cpu_count() if len(execution_ids) >= os.cpu_count() else len(execution_ids)
-        pool = mp.Pool(processes=num_processes)
-        for item in pool.map(self._download_csvs, execution_ids):
-            download_paths.append(item[0])
-            dfs.append(item[1])
-            
-        if len(dfs):
-            df = pd.concat(dfs)
-            output_location = os.path.join(self.local_output_location, str(uuid4()) + '.csv')
-            df.to_csv(output_location, index=False)
-            print('\nData written to {}\n'.format(output_location))
-            for download_path in download_paths:
-                os.remove(download_path)
-            print(df.head())
-        else:
-            print('No CSVs were found.')
+        # stream the CSVs with ranged GETs, writing each batch while the rest downloads; the batches are
+        # kept as the chunks of the table returned, without copying them
+        start_time = time.time()
+        batches = []
+        writer = None
+        with tracing.span('stream', files=len(execution_ids), output_format=self.output_format) as stream:
+            for batch in iter_csv_batches(s3_client, self.bucket,
+                                          [os.path.join(self.additional_s3_path, execution_id + '.csv')
+                                           for execution_id in execution_ids]):
+                if writer is None and self.local_output_location is not None:
+                    writer = ResultWriter(self.local_output_location, self.output_format, batch.schema)
+                if writer is not None:
+                    writer.write(batch)
+                batches.append(batch)
+            if writer is not None:
+                writer.close()
+            stream.set(rows=sum(batch.num_rows for batch in batches), bytes=sum(batch.nbytes for batch in batches))
+        print('Time taken to download {} CSVs: ~{:.4f} seconds'.format(len(execution_ids), time.time()-start_time))
+
+        if batches:
+            print(batches[0].slice(0, 5).to_pandas())
+            return pa.Table.from_batches(batches)
+        print('No CSVs were found.')
+        tbl = schema.empty_table()
+        write_result(tbl, self.local_output_location, self.output_format)
+        return tbl
@@ -7,7 +7,10 @@ import numpy as np
 from numpy import math
 import pandas as pd
 
+import tracing
 from cone_search import cone_search, get_alpha
+from result_cache import ResultCache
+from query_planner import QueryPlanner
 
 parser = argparse.ArgumentParser(description='Get query args and AWS credentials.')
 parser.add_argument('-p', '--profile', default='default', metavar='',
@@ -28,31 +31,61 @@ parser.add_argument('-l', '--querylife', default=10, type=int, metavar='',
                     help='Maximum number of seconds query should be allowed to run before stopping/cancelling (default=10).')
 parser.add_argument('-w', '--wait', default=0.1, type=int, metavar='',
                     help='Time to wait between checks to see if a query is still running (default=0.1 seconds).')
+parser.add_argument('-x', '--skyindex', action='store_true',
+                    help='Prune with the hpx sky pixel column before the exact dot-product test.')
+parser.add_argument('-c', '--cache', default=None, metavar='',
+                    help='Path to folder where to cache the query results, in a subfolder per approach so that each '
+                         'is timed with its own hits (default: no cache).')
+parser.add_argument('-g', '--groupwidth', default=None, type=int, metavar='',
+                    help='Also test concurrent queries of this many zones each (default: not tested).')
+parser.add_argument('-s', '--statistics', default=None, metavar='',
+                    help='Partition statistics of query_planner.py to also test the planned strategy (default: not tested).')
+parser.add_argument('-k', '--plannerlog', default=None, metavar='',
+                    help='File where the planner appends its predicted and observed times (default: no log).')
+parser.add_argument('-y', '--layout', default=None, metavar='',
+                    help='Layout spec of generate_directory.py to prune partitions by the partition keys (default: no pruning).')
 parser.add_argument('-i', '--numiterations', default=5, type=int, metavar='',
                     help='Number of times to test the querying speed (default=5).')
+parser.add_argument('-T', '--trace', default=None, metavar='',
+                    help='Path of a file to write a span of each stage of every search to, as JSON lines '
+                         '(default: not traced, unless set by the {} environment variable).'.format(tracing.trace_variable))
 args = parser.parse_args()
 assert 0 <= args.ra <= 360, '0 <= RA <= 360.'
 assert -90 <= args.dec <= 90, '-90 <= DEC <= 90.'
 assert args.radius >= 0, 'Radius must be greater than or equal to 0.'
 
 if __name__ == '__main__':
+    if args.trace is not None:
+        tracing.enable(args.trace)
     query_approaches = {
         'single': {
-            'value': True,
+            'value': {'strategy': 'single'},
             'time-record': 0
         },
         'multiple': {
-            'value': False,
+            'value': {'strategy': 'per-zone'},
             'time-record': 0
         }
     }
+    if args.groupwidth is not None:
+        query_approaches['grouped'] = {'value': {'strategy': 'grouped', 'zone_width': args.groupwidth}, 'time-record': 0}
+    if args.statistics is not None:
+        planner = QueryPlanner.from_path(args.statistics, log_path=args.plannerlog,
+                                         partition_pruning=args.layout is not None)
+        query_approaches['planned'] = {'value': {'planner': planner}, 'time-record': 0}
+    # one cache per approach, so that an approach is not timed on the results of those before it
+    for approach in query_approaches:
+        query_approaches[approach]['cache'] = (ResultCache(os.path.join(args.cache, approach))
+                                               if args.cache is not None else None)
     for i in range(args.numiterations):
         for approach in query_approaches:
             print('\nQuery approach: {}\n'.format(approach))
             start = time.time()
             cone_search(args.ra, args.dec, args.radius, args.timestart, args.timeend, args.flag,
                         args.profile, args.region, args.s3_output_location, args.local_output_location,
-                        args.database, args.workgroup, args.querylife, args.wait, query_approaches[approach]['value'])
+                        args.database, args.workgroup, args.querylife, args.wait, sky_index=args.skyindex,
+                        cache=query_approaches[approach]['cache'], layout=args.layout,
+                        **query_approaches[approach]['value'])
             elapsed = time.time()-start
             query_approaches[approach]['time-record'] += elapsed
             print('='*130 + '\nElapsed Time: ~{:.4f} seconds'.format(elapsed))
@@ -61,3 +94,6 @@ if __name__ == '__main__':
         print('Query Approach: {}\nAverage query time after {} iterations: ~{:.4f} seconds\n'.format(approach,
                                                                                                      args.numiterations,
                                                                                                      query_approaches[approach]['time-record']/args.numiterations))
+        cache = query_approaches[approach]['cache']
+        if cache is not None:
+            print('Cache: {}\n'.format(', '.join('{} {:,}'.format(name, value) for name, value in cache.counters.items())))
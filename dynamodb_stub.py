@@ -0,0 +1,155 @@
+import re
+import random
+import threading
+from decimal import Decimal
+from collections import Counter
+from botocore.exceptions import ClientError
+
+clause_pattern = re.compile(r'\b(SET|ADD)\b', re.IGNORECASE)
+not_exists_pattern = re.compile(r'^attribute_not_exists\((\w+)\)$')
+
+
+class DynamoDBStub:
+    '''
+    In-process stand-in for the DynamoDB client methods used to log query times, for testing without
+    AWS. Every table has the hash key key_name, or the one key_names gives for it, and is created on
+    first use.
+
+    Batch calls leave each request unprocessed with probability unprocessed_rate, like DynamoDB does
+    under load, and reject batches over the DynamoDB limits. Updates take an attribute_not_exists
+    condition, and TransactWriteItems applies its updates all or none.
+    '''
+    def __init__(self, key_name='EXECUTION_ID', unprocessed_rate=0.0, seed=0, key_names=None):
+        self.key_name = key_name
+        self.key_names = key_names or {}
+        self.unprocessed_rate = unprocessed_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.calls = Counter()
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def get_table(self, table_name):
+        return self.tables.setdefault(table_name, {})
+
+    def get_key(self, table_name, item):
+        return item[self.key_names.get(table_name, self.key_name)]['S']
+
+    def unprocessed(self):
+        return self.random.random() < self.unprocessed_rate
+
+    def put_item(self, TableName, Item):
+        self.call('put_item')
+        with self.lock:
+            self.get_table(TableName)[self.get_key(TableName, Item)] = dict(Item)
+        return {}
+
+    def get_item(self, TableName, Key, AttributesToGet=None):
+        self.call('get_item')
+        with self.lock:
+            item = self.get_table(TableName).get(self.get_key(TableName, Key))
+        if item is None:
+            return {}
+        if AttributesToGet is not None:
+            item = {name: value for name, value in item.items() if name in AttributesToGet}
+        return {'Item': dict(item)}
+
+    def batch_get_item(self, RequestItems):
+        self.call('batch_get_item')
+        if sum(len(request['Keys']) for request in RequestItems.values()) > 100:
+            raise ClientError({'Error': {'Code': 'ValidationException',
+                                         'Message': 'Too many items requested for the BatchGetItem call'}},
+                              'BatchGetItem')
+        responses = {}
+        unprocessed = {}
+        with self.lock:
+            for table_name, request in RequestItems.items():
+                table = self.get_table(table_name)
+                for key in request['Keys']:
+                    if self.unprocessed():
+                        unprocessed.setdefault(table_name, {'Keys': []})['Keys'].append(key)
+                    elif self.get_key(table_name, key) in table:
+                        responses.setdefault(table_name, []).append(dict(table[self.get_key(table_name, key)]))
+        return {'Responses': responses, 'UnprocessedKeys': unprocessed}
+
+    def batch_write_item(self, RequestItems):
+        self.call('batch_write_item')
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise ClientError({'Error': {'Code': 'ValidationException',
+                                         'Message': 'Too many items requested for the BatchWriteItem call'}},
+                              'BatchWriteItem')
+        unprocessed = {}
+        with self.lock:
+            for table_name, requests in RequestItems.items():
+                table = self.get_table(table_name)
+                for request in requests:
+                    if self.unprocessed():
+                        unprocessed.setdefault(table_name, []).append(request)
+                    elif 'PutRequest' in request:
+                        item = request['PutRequest']['Item']
+                        table[self.get_key(table_name, item)] = dict(item)
+                    else:
+                        table.pop(self.get_key(table_name, request['DeleteRequest']['Key']), None)
+        return {'UnprocessedItems': unprocessed}
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues, ConditionExpression=None,
+                    **kwargs):
+        '''
+        Update an item with the SET name = :value and ADD name :number clauses of UpdateExpression, if
+        it meets an attribute_not_exists(name) ConditionExpression.
+        '''
+        self.call('update_item')
+        with self.lock:
+            if not self.check(TableName, Key, ConditionExpression):
+                raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException',
+                                             'Message': 'The conditional request failed'}}, 'UpdateItem')
+            self.apply_update(TableName, Key, UpdateExpression, ExpressionAttributeValues)
+        return {}
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        '''
+        Apply the Update actions of a transaction if all their conditions are met, or none of them.
+        '''
+        self.call('transact_write_items')
+        if len(TransactItems) > 100:
+            raise ClientError({'Error': {'Code': 'ValidationException',
+                                         'Message': 'Member must have length less than or equal to 100'}},
+                              'TransactWriteItems')
+        with self.lock:
+            reasons = [{'Code': 'None'} if self.check(action['Update']['TableName'], action['Update']['Key'],
+                                                      action['Update'].get('ConditionExpression'))
+                       else {'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'}
+                       for action in TransactItems]
+            if any(reason['Code'] != 'None' for reason in reasons):
+                raise ClientError({'Error': {'Code': 'TransactionCanceledException',
+                                             'Message': 'Transaction cancelled'},
+                                   'CancellationReasons': reasons}, 'TransactWriteItems')
+            for action in TransactItems:
+                update = action['Update']
+                self.apply_update(update['TableName'], update['Key'], update['UpdateExpression'],
+                                  update['ExpressionAttributeValues'])
+        return {}
+
+    def check(self, table_name, key, condition):
+        if condition is None:
+            return True
+        match = not_exists_pattern.match(condition.strip())
+        if match is None:
+            raise ValueError('Unsupported condition {}'.format(condition))
+        return match.group(1) not in self.get_table(table_name).get(self.get_key(table_name, key), {})
+
+    def apply_update(self, table_name, key, update_expression, values):
+        parts = clause_pattern.split(update_expression)
+        item = self.get_table(table_name).setdefault(self.get_key(table_name, key), dict(key))
+        for clause, actions in zip(parts[1::2], parts[2::2]):
+            for action in actions.split(','):
+                if clause.upper() == 'SET':
+                    name, value = [part.strip() for part in action.split('=')]
+                    item[name] = values[value]
+                else:
+                    name, value = action.split()
+                    total = Decimal(item.get(name, {'N': '0'})['N']) + Decimal(values[value]['N'])
+                    item[name] = {'N': str(total)}
@@ -1,59 +1,147 @@
 import os
-import sys
+import argparse
+import requests
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from gphoton_schema import header
+from partition_layout import (PartitionRouter, get_uniform_layout, plan_layout, save_layout, layout_file_name,
+                              zone_pattern)
 
-def make_folders(partitions, index=0, paths=None):
+parser = argparse.ArgumentParser(description='Create the zoneID/ra partition folders and the layout spec describing them.')
+parser.add_argument('path', help='Path to folder where to create the partitions.')
+parser.add_argument('-z', '--zones', default='10829,10830,10831', metavar='',
+                    help='Comma separated list of zoneIDs to create partitions for (default: 10829,10830,10831).')
+parser.add_argument('-f', '--factor', default=10, type=int, metavar='',
+                    help='Number of equal RA partitions per zone, when the layout is not planned from data (default=10).')
+parser.add_argument('-c', '--csv', default=None, metavar='',
+                    help='Path to TXT file listing the CSVs to sample to plan the RA partitions by density.')
+parser.add_argument('-q', '--parquet', default=None, metavar='',
+                    help='Path to partitions of PARQUET files whose statistics are used to plan the RA partitions.')
+parser.add_argument('-r', '--rows', default=5000000, type=int, metavar='',
+                    help='Target number of rows per partition of a planned layout (default=5,000,000).')
+parser.add_argument('-s', '--samplesize', default=4, type=int, metavar='',
+                    help='Number of MB sampled from each CSV (default=4).')
+parser.add_argument('-n', '--numchunks', default=8, type=int, metavar='',
+                    help='Number of evenly spaced chunks the sample of a CSV is read in (default=8).')
+
+
+def sample_csv(file_name, sample_size, num_chunks):
     '''
-    Recursively create the directory structure and then make the directories.
+    zoneID and RA of rows read from evenly spaced byte ranges of a CSV.
+
+    Returns
+    -------
+    tuple
+        (zoneIDs, RAs, number of rows each sampled row stands for)
     '''
-    if paths is None:
-        paths = [PATH]
-    temp_paths = []
-    for path in paths:
-        try:
-            for partition in partitions[index]:
-                temp_path = os.path.join(path, partition)
-                temp_paths.append(temp_path)
-        except:
-            for path in paths:
-                try:
-                    os.mkdir(path)
-                except:
-                    os.makedirs(path)
-            return
-    make_folders(partitions=partitions, index=index+1, paths=temp_paths)
-
-def get_partitions(params):
+    size = int(requests.head(file_name, allow_redirects=True, timeout=60).headers['Content-Length'])
+    chunk_size = max(sample_size//num_chunks, 1)
+    read_options = pv.ReadOptions(column_names=header)
+    parse_options = pv.ParseOptions(delimiter='|', invalid_row_handler=lambda row: 'skip')
+    convert_options = pv.ConvertOptions(include_columns=['zoneID', 'ra'],
+                                        column_types={'zoneID': pa.string(), 'ra': pa.string()})
+    zone_ids, ra = [], []
+    num_bytes = 0
+    for offset in np.unique(np.linspace(0, max(size - chunk_size, 0), num_chunks).astype(np.int64)):
+        headers = {'Range': 'bytes={}-{}'.format(offset, offset + chunk_size - 1), 'Accept-Encoding': 'identity'}
+        with requests.get(file_name, headers=headers, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            # servers ignoring the range send the whole file; only the chunk is read either way
+            data = response.raw.read(chunk_size)
+        # drop the partial lines at both ends of the chunk
+        if offset:
+            data = data[data.find(b'\n') + 1:]
+        data = data[:data.rfind(b'\n') + 1]
+        if not data:
+            continue
+        tbl = pv.read_csv(pa.py_buffer(data), read_options=read_options, parse_options=parse_options,
+                          convert_options=convert_options)
+        # rows with values that do not convert are dropped, as they are when ingesting
+        zones = pd.to_numeric(tbl['zoneID'].to_pandas(), errors='coerce').to_numpy()
+        values = pd.to_numeric(tbl['ra'].to_pandas(), errors='coerce').to_numpy()
+        valid = np.isfinite(zones) & (zones == np.round(zones)) & np.isfinite(values)
+        zone_ids.append(zones[valid].astype(np.int64))
+        ra.append(values[valid])
+        num_bytes += len(data)
+    if not num_bytes:
+        return np.array([], dtype=np.int64), np.array([]), 0
+    return np.concatenate(zone_ids), np.concatenate(ra), size/num_bytes
+
+
+def sample_parquet_statistics(path, num_points=16):
     '''
-    For a given ID, create a list of partitions based on the min, max, and step values.
+    zoneID and RA points standing for the rows of every row group of the PARQUET files below path,
+    spread evenly between the RA minimum and maximum of the row group statistics.
+
+    Returns
+    -------
+    tuple
+        (zoneIDs, RAs, number of rows each point stands for)
     '''
-    partitions = []
-    for val in range(params['min'], params['max'], params['step']):
-        if val == (params['max'] - params['step']):
-            partitions.append('{}<={}<={}'.format(val, params['id'], val+params['step']))
-        else:
-            partitions.append('{}<={}<{}'.format(val, params['id'], val+params['step']))
-    return partitions
+    zone_ids, ra, weights = [], [], []
+    for folder, _, file_names in sorted(os.walk(path)):
+        for file in sorted(filter(lambda x: x.endswith('parquet'), file_names)):
+            metadata = pq.ParquetFile(os.path.join(folder, file)).metadata
+            columns = metadata.schema.names
+            for index in range(metadata.num_row_groups):
+                row_group = metadata.row_group(index)
+                ra_stats = row_group.column(columns.index('ra')).statistics
+                zone_stats = row_group.column(columns.index('zoneID')).statistics if 'zoneID' in columns else None
+                if ra_stats is None or not ra_stats.has_min_max:
+                    continue
+                if zone_stats is not None and zone_stats.has_min_max and zone_stats.min == zone_stats.max:
+                    zone_id = zone_stats.min
+                else:
+                    # zoneID is only a partition column of the files written by acquire_gPhoton_csv_files.py
+                    match = [zone_pattern.match(part) for part in os.path.relpath(folder, path).split(os.sep)]
+                    match = [item for item in match if item is not None]
+                    if not match:
+                        continue
+                    zone_id = int(match[0].group(1))
+                zone_ids.append(np.full(num_points, zone_id, dtype=np.int64))
+                ra.append(np.linspace(ra_stats.min, ra_stats.max, num_points))
+                weights.append(np.full(num_points, row_group.num_rows/num_points))
+    if not ra:
+        return np.array([], dtype=np.int64), np.array([]), np.array([])
+    return np.concatenate(zone_ids), np.concatenate(ra), np.concatenate(weights)
+
+
+def make_folders(path, layout):
+    '''
+    Create the zoneID/ra partition folders of a layout spec and save the spec next to them.
+    '''
+    router = PartitionRouter.from_layout(path, layout)
+    for partition_path in router.paths:
+        os.makedirs(partition_path, exist_ok=True)
+    save_layout(os.path.join(path, layout_file_name), layout)
+    return router
+
 
 if __name__ == '__main__':
-    PATH = sys.argv[1]
-    partition_factor = 10
-    zoneIDs = [10829, 10830, 10831]
-    ra = {
-        'id': 'ra',
-        'min': 0,
-        'max': 360
-    }
-    ra['step'] = int((ra['max'] - ra['min'])/partition_factor)
-    dec = {
-        'id': 'dec',
-        'min': -90,
-        'max': 90
-    }
-    dec['step'] = int((dec['max'] - dec['min'])/partition_factor)
-
-    p = [
-         ['zoneID={}'.format(id) for id in zoneIDs],
-         get_partitions(ra),
-         #get_partitions(dec)
-    ]
-    make_folders(p)
+    args = parser.parse_args()
+    zone_ids = [int(zone_id) for zone_id in args.zones.split(',')]
+    if args.csv is not None:
+        sampled_zone_ids, sampled_ra, weights = [], [], []
+        with open(args.csv) as txt_file:
+            file_names = [line.strip() for line in txt_file if line.strip()]
+        for file_name in file_names:
+            zones, ra, weight = sample_csv(file_name, args.samplesize*1024*1024, args.numchunks)
+            print('Sampled {:,} rows of {} (~{:,.0f} rows in file).'.format(len(ra), file_name, len(ra)*weight))
+            sampled_zone_ids.append(zones)
+            sampled_ra.append(ra)
+            weights.append(np.full(len(ra), weight))
+        layout = plan_layout(np.concatenate(sampled_zone_ids), np.concatenate(sampled_ra), args.rows,
+                             weights=np.concatenate(weights), zones=zone_ids)
+    elif args.parquet is not None:
+        sampled_zone_ids, sampled_ra, weights = sample_parquet_statistics(args.parquet)
+        print('Read statistics of ~{:,.0f} rows in {}.'.format(weights.sum(), args.parquet))
+        layout = plan_layout(sampled_zone_ids, sampled_ra, args.rows, weights=weights, zones=zone_ids)
+    else:
+        layout = get_uniform_layout(zone_ids, args.factor)
+    router = make_folders(args.path, layout)
+    for zone_id in router.zone_ids:
+        print('zoneID={}: {} RA partitions'.format(zone_id, len(router.boundaries[int(zone_id)]) - 1))
+    print('Wrote {} partitions and {}'.format(len(router), os.path.join(args.path, layout_file_name)))
@@ -0,0 +1,23 @@
+import numpy as np
+import pyarrow as pa
+
+# columns of the gPhoton CSVs, in order, and their dtypes
+header = [       'zoneID',     'time',        'cx',        'cy',         'cz',        'x',           'y',         'xa',
+                   'ya',        'q',          'xi',        'eta',        'ra',       'dec',         'flag'              ]
+header_dtypes = [np.int32,    np.int64,    np.float64,   np.float64,  np.float64,  np.float64,    np.float64,   np.int16,
+                 np.int16,    np.int16,    np.float64,   np.float64,  np.float64,  np.float64,    np.int8                ]
+schema = pa.schema([(name, pa.from_numpy_dtype(dtype)) for name, dtype in zip(header, header_dtypes)])
+# rows of batch cone searches come with the id of their target first
+batch_schema = pa.schema([('target_id', pa.int64())] + list(schema))
+
+
+def cast_to_schema(tbl):
+    '''
+    Rename the columns of a table to the gPhoton names, whatever their case (Athena lower cases them),
+    and cast them to the gPhoton dtypes, with target_id as int64; other columns are kept as they are.
+    '''
+    canonical_names = {name.lower(): name for name in batch_schema.names}
+    tbl = tbl.rename_columns([canonical_names.get(name.lower(), name) for name in tbl.column_names])
+    fields = [batch_schema.field(name) if name in canonical_names.values() else tbl.schema.field(name)
+              for name in tbl.column_names]
+    return tbl.cast(pa.schema(fields))
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import threading
+from collections import Counter
+
+
+class IngestMetrics:
+    '''
+    Counters of the ingest of a worker, sampled every interval seconds by a thread which prints the
+    progress in one line, and appends each sample to the metrics file at path as a JSON line.
+
+    Counters are added to from any thread: rows_read, rows_retained, bytes_read (of the CSVs),
+    parquet_files and parquet_bytes (written), and the rows dropped by reason. gauges maps names
+    to functions read at each sample, such as the number of open partitions or the RSS; the peak of
+    each gauge over the samples is kept for the summary.
+    '''
+    def __init__(self, name, interval=1.0, path=None, gauges=None, in_place=True):
+        self.name = name
+        self.interval = interval
+        self.path = path
+        self.gauges = gauges or {}
+        # rewrite the progress line with \r, or print a line per sample when workers share the terminal
+        self.in_place = in_place
+        self.width = 0
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.dropped = Counter()
+        self.peaks = {}
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_time = None
+        self.last = None
+
+    def add(self, **counts):
+        with self.lock:
+            self.counters.update(counts)
+
+    def drop(self, reason, count=1):
+        if count:
+            with self.lock:
+                self.dropped[reason] += count
+
+    def start(self):
+        self.start_time = time.time()
+        self.last = (self.start_time, Counter())
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report(self.sample())
+
+    def stop(self, **totals):
+        '''
+        Stop sampling, after a last sample.
+
+        Returns
+        -------
+        dict
+            the summary of the ingest, updated with totals kept by the caller
+        '''
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report(self.sample())
+        if self.in_place:
+            print()
+        summary = self.summary()
+        summary.update(totals)
+        self.write(dict(summary, type='summary'))
+        return summary
+
+    def sample(self):
+        '''
+        Counters, gauges and rates since the previous sample.
+        '''
+        now = time.time()
+        with self.lock:
+            counters = Counter(self.counters)
+            dropped = dict(self.dropped)
+        last_time, last_counters = self.last
+        self.last = (now, counters)
+        seconds = now - last_time
+        sample = {
+            'type': 'sample',
+            'worker': self.name,
+            'pid': os.getpid(),
+            'time': now,
+            'elapsed': now - self.start_time,
+            'rows_read': counters['rows_read'],
+            'rows_retained': counters['rows_retained'],
+            'rows_per_second': (counters['rows_read'] - last_counters['rows_read'])/seconds if seconds else 0.0,
+            'input_mb_per_second': ((counters['bytes_read'] - last_counters['bytes_read'])/(1024*1024)/seconds
+                                    if seconds else 0.0),
+            'input_mb': counters['bytes_read']/(1024*1024),
+            'parquet_files': counters['parquet_files'],
+            'parquet_mb': counters['parquet_bytes']/(1024*1024),
+            'dropped': dropped
+        }
+        for name, gauge in self.gauges.items():
+            sample[name] = gauge()
+            self.peaks[name] = max(self.peaks.get(name, sample[name]), sample[name])
+        return sample
+
+    def report(self, sample):
+        self.write(sample)
+        progress = '{}: {:,} rows read ({:,.0f} rows/s, {:.1f} MB/s), {:,} files ({:.1f} MB) written'.format(
+            self.name, sample['rows_read'], sample['rows_per_second'], sample['input_mb_per_second'],
+            sample['parquet_files'], sample['parquet_mb'])
+        if 'open_partitions' in sample:
+            progress += ', {} open partitions'.format(sample['open_partitions'])
+        if 'rss_mb' in sample:
+            progress += ', RSS ~{:.0f} MB'.format(sample['rss_mb'])
+        if self.in_place:
+            # pad over the end of a longer previous line
+            print('\r' + progress.ljust(self.width), end='', flush=True)
+            self.width = len(progress)
+        else:
+            print(progress, flush=True)
+
+    def write(self, record):
+        if self.path is not None:
+            with open(self.path, 'a') as metrics_file:
+                metrics_file.write(json.dumps(record) + '\n')
+
+    def summary(self):
+        '''
+        Totals and average rates of the ingest, with the peak of each gauge.
+        '''
+        seconds = time.time() - self.start_time
+        with self.lock:
+            counters = Counter(self.counters)
+            dropped = dict(self.dropped)
+        summary = {
+            'worker': self.name,
+            'pid': os.getpid(),
+            'seconds': seconds,
+            'rows_read': counters['rows_read'],
+            'rows_retained': counters['rows_retained'],
+            'rows_per_second': counters['rows_read']/seconds if seconds else 0.0,
+            'input_mb': counters['bytes_read']/(1024*1024),
+            'input_mb_per_second': counters['bytes_read']/(1024*1024)/seconds if seconds else 0.0,
+            'parquet_files': counters['parquet_files'],
+            'parquet_mb': counters['parquet_bytes']/(1024*1024),
+            'dropped': dropped
+        }
+        summary.update({'peak_' + name: peak for name, peak in self.peaks.items()})
+        return summary
+
+
+def combine_summaries(summaries, seconds):
+    '''
+    Overall summary of workers which ran side by side for seconds of wall time.
+    '''
+    dropped = Counter()
+    for summary in summaries:
+        dropped.update(summary['dropped'])
+    combined = {'worker': 'overall', 'seconds': seconds}
+    for name in ['rows_read', 'rows_retained', 'input_mb', 'parquet_files', 'parquet_mb']:
+        combined[name] = sum(summary[name] for summary in summaries)
+    combined.update({
+        'rows_per_second': combined['rows_read']/seconds if seconds else 0.0,
+        'input_mb_per_second': combined['input_mb']/seconds if seconds else 0.0,
+        'dropped': dict(dropped)
+    })
+    return combined
+
+
+def format_summary(summary):
+    lines = ['{}: {:,} rows read, {:,} retained in ~{:.1f} seconds ({:,.0f} rows/s, {:.1f} MB/s of {:.1f} MB)'.format(
+        summary['worker'], summary['rows_read'], summary['rows_retained'], summary['seconds'],
+        summary['rows_per_second'], summary['input_mb_per_second'], summary['input_mb'])]
+    lines.append('\t{:,} Parquet files written, ~{:.1f} MB'.format(summary['parquet_files'], summary['parquet_mb']))
+    if summary['dropped']:
+        lines.append('\trows dropped: ' + ', '.join('{} {:,}'.format(reason, count)
+                                                    for reason, count in sorted(summary['dropped'].items())))
+    if 'peak_open_partitions' in summary:
+        lines.append('\tpeak open partitions: {}; peak buffered: ~{:.1f} MB; peak RSS: ~{:.1f} MB'.format(
+            summary['peak_open_partitions'], summary.get('peak_buffered_mb', 0), summary.get('peak_rss_mb', 0)))
+    return '\n'.join(lines)
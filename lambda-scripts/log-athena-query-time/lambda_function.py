@@ -1,59 +1,272 @@
 import os
+import time
 import boto3
+from botocore.exceptions import ClientError
+from urllib.parse import unquote_plus
 from datetime import datetime, timezone
 
+ATHENA_COST_PER_BYTE = 5/1e+12 # $5/TB scanned
+MIN_BILLED_BYTES = 10*1024*1024 # Athena bills at least 10 MB per query
+# maximum number of ids, items or actions per call of batch_get_query_execution, BatchGetItem,
+# BatchWriteItem and TransactWriteItems
+ATHENA_BATCH_SIZE = 50
+GET_BATCH_SIZE = 100
+WRITE_BATCH_SIZE = 25
+TRANSACT_SIZE = 100
+MAX_RETRIES = 8
+
+# clients are created once per container and reused by the invocations it serves
+clients = {}
+
+
+def get_client(name):
+    if name not in clients:
+        clients[name] = boto3.client(name)
+    return clients[name]
+
+
+def get_execution_ids(event):
+    '''
+    Execution ids of the CSV results of all the records of an S3 event, without repeats.
+    '''
+    execution_ids = []
+    for record in event.get('Records', []):
+        key = unquote_plus(record['s3']['object']['key'])
+        if key.endswith('.csv'):
+            execution_ids.append(key.split('/')[-1][:-len('.csv')])
+    return list(dict.fromkeys(execution_ids))
+
+
+def retry(function, request, unprocessed_name):
+    '''
+    Call a batch function until nothing of the request is unprocessed, backing off between calls.
+
+    Returns
+    -------
+    list
+        the responses of the calls
+    '''
+    responses = []
+    for attempt in range(MAX_RETRIES):
+        response = function(request)
+        responses.append(response)
+        request = response.get(unprocessed_name)
+        if not request:
+            return responses
+        time.sleep(min(0.05*2**attempt, 1.0))
+    raise RuntimeError('{} left unprocessed after {} attempts'.format(unprocessed_name, MAX_RETRIES))
+
+
+def get_query_executions(athena_client, execution_ids):
+    '''
+    Query executions by id; the ids Athena does not know are left out.
+    '''
+    executions = {}
+    for index in range(0, len(execution_ids), ATHENA_BATCH_SIZE):
+        response = athena_client.batch_get_query_execution(QueryExecutionIds=execution_ids[index:index+ATHENA_BATCH_SIZE])
+        for execution in response['QueryExecutions']:
+            executions[execution['QueryExecutionId']] = execution
+    return executions
+
+
+def get_items(db_client, table_id, execution_ids):
+    items = {}
+    for index in range(0, len(execution_ids), GET_BATCH_SIZE):
+        request = {table_id: {'Keys': [{'EXECUTION_ID': {'S': execution_id}}
+                                       for execution_id in execution_ids[index:index+GET_BATCH_SIZE]]}}
+        for response in retry(lambda request: db_client.batch_get_item(RequestItems=request), request,
+                              'UnprocessedKeys'):
+            for item in response['Responses'].get(table_id, []):
+                items[item['EXECUTION_ID']['S']] = item
+    return items
+
+
+def write_items(db_client, table_id, items):
+    for index in range(0, len(items), WRITE_BATCH_SIZE):
+        request = {table_id: [{'PutRequest': {'Item': item}} for item in items[index:index+WRITE_BATCH_SIZE]]}
+        retry(lambda request: db_client.batch_write_item(RequestItems=request), request, 'UnprocessedItems')
+
+
+def get_item(execution_id, item, execution, end_time):
+    '''
+    Item of an execution with its times, data scanned and cost as numbers, keeping the attributes
+    written when the query started.
+
+    Returns
+    -------
+    tuple
+        (item, seconds from the start to the end of the query)
+    '''
+    status = execution['Status']
+    statistics = execution.get('Statistics', {})
+    item = dict(item or {'EXECUTION_ID': {'S': execution_id}})
+    # queries not started by query_athena_and_log_to_dynamodb.py start when Athena received them
+    if 'EXECUTION_START_TIME' not in item:
+        item['EXECUTION_START_TIME'] = {'S': status['SubmissionDateTime'].isoformat(timespec='microseconds')}
+    if 'CompletionDateTime' in status:
+        end_time = status['CompletionDateTime'].astimezone(timezone.utc).isoformat(timespec='microseconds')
+    elapsed = (datetime.fromisoformat(end_time) - datetime.fromisoformat(item['EXECUTION_START_TIME']['S'])).total_seconds()
+    bytes_scanned = int(statistics.get('DataScannedInBytes', 0))
+    item.update({
+        'EXECUTION_END_TIME': {'S': end_time},
+        'STATE': {'S': status['State']},
+        'DATA_SCANNED_IN_BYTES': {'N': str(bytes_scanned)},
+        'QUERY_COST': {'N': '{:.10f}'.format(max(bytes_scanned, MIN_BILLED_BYTES)*ATHENA_COST_PER_BYTE)},
+        'TIME_ELAPSED_IN_SECONDS': {'N': '{:.6f}'.format(elapsed)},
+        'QUEUE_TIME_IN_SECONDS': {'N': '{:.3f}'.format(statistics.get('QueryQueueTimeInMillis', 0)/1000)},
+        'ENGINE_EXECUTION_TIME_IN_SECONDS': {'N': '{:.3f}'.format(statistics.get('EngineExecutionTimeInMillis', 0)/1000)}
+    })
+    return item, elapsed
+
+
+def get_aggregate_update(table_id, query_id, items, end_time):
+    '''
+    Update adding the count, seconds, squared seconds, bytes and cost of items to the running totals of
+    a query id; the mean and standard deviation follow from them.
+    '''
+    seconds = sum(elapsed for _, elapsed in items)
+    return {'Update': {
+        'TableName': table_id,
+        'Key': {
+            'QUERY_ID': {
+                'S': query_id
+            }
+        },
+        'UpdateExpression': 'ADD QUERY_COUNT :n, TOTAL_SECONDS :s, TOTAL_SQUARED_SECONDS :s2, '
+                            'TOTAL_DATA_SCANNED_IN_BYTES :b, TOTAL_COST :c SET LAST_END_TIME = :et',
+        'ExpressionAttributeValues': {
+            ':n': {'N': str(len(items))},
+            ':s': {'N': '{:.6f}'.format(seconds)},
+            ':s2': {'N': '{:.6f}'.format(sum(elapsed**2 for _, elapsed in items))},
+            ':b': {'N': str(sum(int(item['DATA_SCANNED_IN_BYTES']['N']) for item, _ in items))},
+            ':c': {'N': '{:.10f}'.format(sum(float(item['QUERY_COST']['N']) for item, _ in items))},
+            ':et': {'S': end_time}
+        }
+    }}
+
+
+def update_aggregates(db_client, table_id, aggregate_table_id, items, end_time):
+    '''
+    Add the items of each query id to its running totals in the aggregate table, marking them as
+    AGGREGATED in the same transaction, on the condition that they are not already. An item is then
+    counted once however often its event is delivered or retried, and not lost if the Lambda fails.
+    '''
+    groups = {}
+    for item, elapsed in items:
+        if 'QUERY_ID' in item:
+            groups.setdefault(item['QUERY_ID']['S'], []).append((item, elapsed))
+    for query_id, group in groups.items():
+        for index in range(0, len(group), TRANSACT_SIZE - 1):
+            chunk = group[index:index+TRANSACT_SIZE-1]
+            while chunk:
+                marks = [{'Update': {
+                    'TableName': table_id,
+                    'Key': {'EXECUTION_ID': item['EXECUTION_ID']},
+                    'UpdateExpression': 'SET AGGREGATED = :t',
+                    'ConditionExpression': 'attribute_not_exists(AGGREGATED)',
+                    'ExpressionAttributeValues': {':t': {'BOOL': True}}
+                }} for item, _ in chunk]
+                try:
+                    db_client.transact_write_items(
+                        TransactItems=[get_aggregate_update(aggregate_table_id, query_id, chunk, end_time)] + marks)
+                    break
+                except ClientError as error:
+                    reasons = error.response.get('CancellationReasons', [])[1:]
+                    counted = [reason.get('Code') == 'ConditionalCheckFailed' for reason in reasons]
+                    if error.response['Error']['Code'] != 'TransactionCanceledException' or not any(counted):
+                        raise
+                    # items counted by another delivery of the event since they were read
+                    chunk = [entry for entry, is_counted in zip(chunk, counted) if not is_counted]
+
+
+def is_logged(item):
+    return 'AGGREGATED' in item or ('EXECUTION_END_TIME' in item and 'QUERY_ID' not in item)
+
+
 def lambda_handler(event, context):
     # before anything else, let's get the current time
     end_time = datetime.now(timezone.utc).isoformat(timespec='microseconds')
-    
-    ATHENA_COST_PER_BYTE = 5/1e+12 # $5/TB scanned
+
     athena_table_id = os.environ.get('ATHENA_TABLE')
-    profile_name = os.environ.get('PROFILE_NAME')
-    region_name = os.environ.get('REGION_NAME')
-    athena_client = boto3.client('athena')
-    db_client = boto3.client('dynamodb')
-    
-    key = event['Records'][0]['s3']['object']['key']
-    execution_id = key.split('/')[-1].replace('.csv', '')
-    
-    response = athena_client.get_query_execution(
-        QueryExecutionId=execution_id
-    )
-    bytes_scanned = int(response['QueryExecution']['Statistics']['DataScannedInBytes'])
-    start_time = db_client.get_item(
-        TableName=athena_table_id,
-        Key={
-            'EXECUTION_ID':{
-                'S': execution_id
-            }
-        },
-        AttributesToGet=[
-            'EXECUTION_START_TIME'
-        ],
-    )
-    start_time = start_time['Item']['EXECUTION_START_TIME']['S']
-    time_difference = datetime.fromisoformat(end_time) - datetime.fromisoformat(start_time)
-    time_difference = time_difference.seconds + (time_difference.microseconds*1e-6)
-    db_client.update_item(
-        TableName=athena_table_id,
-        Key={
-            'EXECUTION_ID':{
-                'S': execution_id
-            }
-        },
-        UpdateExpression='SET EXECUTION_END_TIME=:et, QUERY_COST=:cost, DATA_SCANNED=:data, TIME_ELAPSED_IN_SECONDS=:tm',
-        ExpressionAttributeValues={
-            ':et': {
-                'S': end_time
-            },
-            ':cost': {
-                'S': '${:.10f}'.format(bytes_scanned*ATHENA_COST_PER_BYTE)
-            },
-            ':data': {
-                'S': '{:.10f} GB'.format(bytes_scanned*1e-9)
-            },
-            ':tm': {
-                'S': '{:.6f}'.format(time_difference)
-            }
-        }
-    )
+    # the totals of each query id, in a table of their own with the hash key QUERY_ID
+    aggregate_table_id = os.environ['AGGREGATE_TABLE']
+    athena_client = get_client('athena')
+    db_client = get_client('dynamodb')
+
+    execution_ids = get_execution_ids(event)
+    executions = get_query_executions(athena_client, execution_ids)
+    started = get_items(db_client, athena_table_id, execution_ids)
+    # S3 can deliver an event more than once, and Lambda retries a failed invocation; executions already
+    # logged are not logged again, but those logged and not yet counted in the aggregates are
+    items = [get_item(execution_id, started.get(execution_id), executions[execution_id], end_time)
+             for execution_id in execution_ids
+             if execution_id in executions and not is_logged(started.get(execution_id, {}))]
+    write_items(db_client, athena_table_id, [item for item, _ in items])
+    update_aggregates(db_client, athena_table_id, aggregate_table_id, items, end_time)
+    missing = [execution_id for execution_id in execution_ids if execution_id not in executions]
+    if missing:
+        print('No query executions found for {}'.format(', '.join(missing)))
+    return {'processed': len(items), 'missing': missing}
+
+
+if __name__ == '__main__':
+    # run the handler locally on sample events, with the Athena and DynamoDB stubs of the repository
+    import sys
+    import json
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    from athena_stub import AthenaStub
+    from dynamodb_stub import DynamoDBStub
+
+    os.environ['ATHENA_TABLE'] = 'athena-query-times'
+    os.environ['AGGREGATE_TABLE'] = 'athena-query-aggregates'
+    clients['athena'] = AthenaStub(run_time=(0.01, 0.05))
+    clients['dynamodb'] = DynamoDBStub(unprocessed_rate=0.2, key_names={'athena-query-aggregates': 'QUERY_ID'})
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_event.json')) as sample:
+        record = json.load(sample)['Records'][0]
+
+    # 120 results landing at once, from queries of three ids, each reported in two batched events
+    execution_ids = []
+    for index in range(120):
+        execution_id = clients['athena'].start_query_execution(
+            QueryString='SELECT {};'.format(index),
+            ResultConfiguration={'OutputLocation': 's3://bucket/athena/results/'})['QueryExecutionId']
+        clients['dynamodb'].put_item(TableName='athena-query-times', Item={
+            'EXECUTION_ID': {'S': execution_id}, 'QUERY_ID': {'S': str(index % 3 + 1)},
+            'EXECUTION_START_TIME': {'S': datetime.now(timezone.utc).isoformat(timespec='microseconds')}})
+        execution_ids.append(execution_id)
+    time.sleep(0.1)
+    events = [{'Records': [dict(record, s3=dict(record['s3'], object={'key': 'athena/results/{}.csv'.format(execution_id)}))
+                           for execution_id in batch]}
+              for batch in [execution_ids[:60], execution_ids[60:]]]
+    print(lambda_handler(events[0], None))
+    # the aggregates of the second event fail after its executions are logged; the retry counts them once
+    transact_write_items = clients['dynamodb'].transact_write_items
+
+    def fail(**kwargs):
+        raise ClientError({'Error': {'Code': 'InternalServerError', 'Message': 'Stub failure'}}, 'TransactWriteItems')
+    clients['dynamodb'].transact_write_items = fail
+    try:
+        lambda_handler(events[1], None)
+        raise AssertionError('The failure of the aggregates was not raised.')
+    except ClientError:
+        pass
+    clients['dynamodb'].transact_write_items = transact_write_items
+    assert all('EXECUTION_END_TIME' in clients['dynamodb'].tables['athena-query-times'][execution_id]
+               for execution_id in execution_ids[60:])
+    print(lambda_handler(events[1], None))
+    # a repeated delivery is not counted twice
+    assert lambda_handler(events[0], None)['processed'] == 0
+    assert lambda_handler(events[1], None)['processed'] == 0
+    print(lambda_handler(json.load(open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sample_event.json'))), None))
+
+    table = clients['dynamodb'].tables['athena-query-times']
+    assert all(table[execution_id]['STATE']['S'] == 'SUCCEEDED' and 'TIME_ELAPSED_IN_SECONDS' in table[execution_id]
+               for execution_id in execution_ids)
+    assert all(table[execution_id]['AGGREGATED']['BOOL'] for execution_id in execution_ids)
+    aggregates = clients['dynamodb'].tables['athena-query-aggregates']
+    assert sum(int(item['QUERY_COUNT']['N']) for item in aggregates.values()) == len(execution_ids)
+    for key, item in sorted(aggregates.items()):
+        print('{}: {} queries, mean {:.3f} seconds, ${} total'.format(
+            key, item['QUERY_COUNT']['N'], float(item['TOTAL_SECONDS']['N'])/int(item['QUERY_COUNT']['N']),
+            item['TOTAL_COST']['N']))
+    print(dict(clients['dynamodb'].calls), dict(clients['athena'].calls))
@@ -0,0 +1,268 @@
+import os
+import time
+import boto3
+import tempfile
+import argparse
+import numpy as np
+from numpy import math
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from athena_orchestrator import run_queries
+from cone_search import get_search_plan, read_csv_table
+from cone_search_local import get_router, get_files, prune
+from partition_layout import PartitionRouter, load_layout, select_partitions, get_partition_predicate
+
+light_curve_query = '''
+            SELECT (time - {time_start}) / {bin_width} AS bin,{flag_column}
+                COUNT_IF(dot > {cos_source}) AS counts{background_column}
+            FROM (
+                SELECT time, flag, ({cx}*cx + {cy}*cy + {cz}*cz) AS dot
+                FROM gPhoton_partitioned
+                WHERE {partition_predicate}zoneID BETWEEN {min_zoneid} AND {max_zoneid}
+                    AND dec BETWEEN {dec_min} AND {dec_max}
+                    AND ({ra_predicate})
+                    AND time >= {time_start} AND time < {time_end}{flag_predicate}
+            )
+            WHERE dot > {cos_outer}
+            GROUP BY {group_by}
+            ORDER BY {group_by};
+         '''
+
+
+def get_light_curve_plan(ra, dec, radius, annulus=None):
+    '''
+    Search plan of the box around the source cone, or around the outer edge of the background annulus.
+
+    Returns
+    -------
+    dict
+        the plan of cone_search.get_search_plan of the outer radius, with cos_source (rows whose dot
+        product with the center is greater are source photons) and, with an annulus, cos_inner (rows
+        with a dot product less or equal, and greater than cos_radius, are background photons)
+    '''
+    outer = radius if annulus is None else annulus[1]
+    if annulus is not None:
+        assert radius <= annulus[0] < annulus[1], 'The annulus must be outside the source cone.'
+    plan = get_search_plan(ra, dec, outer)
+    plan['cos_source'] = math.cos(math.radians(radius))
+    if annulus is not None:
+        plan['cos_inner'] = math.cos(math.radians(annulus[0]))
+    return plan
+
+
+def get_light_curve_query(plan, time_start, time_end, bin_width, flag=0, by_flag=False, router=None):
+    '''
+    Athena query binning the photons of a light curve plan by time: one row per non-empty bin (and
+    flag, with by_flag) with the counts of the source and, with an annulus, of the background.
+    The RA ranges of a cone wrapping past 360 are OR'd in one SELECT.
+    '''
+    partition_predicate = ''
+    if router is not None:
+        partition_predicate = get_partition_predicate(router, select_partitions(
+            router, plan['min_zoneid'], plan['max_zoneid'], plan['ra_ranges'])) + '\n                    AND '
+    return light_curve_query.format(
+        time_start=int(time_start), time_end=int(time_end), bin_width=int(bin_width),
+        flag_column='\n                flag,' if by_flag else '',
+        cos_source=plan['cos_source'],
+        background_column=',\n                COUNT_IF(dot <= {}) AS background'.format(plan['cos_inner'])
+                          if 'cos_inner' in plan else '',
+        cx=plan['cx'], cy=plan['cy'], cz=plan['cz'],
+        partition_predicate=partition_predicate,
+        min_zoneid=plan['min_zoneid'], max_zoneid=plan['max_zoneid'],
+        dec_min=plan['dec_range'][0], dec_max=plan['dec_range'][1],
+        ra_predicate=' OR '.join('ra BETWEEN {} AND {}'.format(*ra_range) for ra_range in plan['ra_ranges']),
+        flag_predicate='' if flag is None else '\n                    AND flag = {}'.format(flag),
+        cos_outer=plan['cos_radius'],
+        group_by='1, 2' if by_flag else '1')
+
+
+def count_photons(time, flag, dot, plan, time_start, bin_width, by_flag=False):
+    '''
+    Photons of rows of the box binned by time, with NumPy.
+
+    Returns
+    -------
+    tuple
+        (keys, source counts, background counts) of the non-empty bins, the key of a bin being
+        flag*2**40 + bin with by_flag, else bin
+    '''
+    keep = dot > plan['cos_radius']
+    bins = (time[keep] - time_start) // bin_width
+    keys = (flag[keep].astype(np.int64) * 2**40 + bins) if by_flag else bins
+    keys, index = np.unique(keys, return_inverse=True)
+    source = np.bincount(index, weights=dot[keep] > plan['cos_source'], minlength=len(keys))
+    background = np.bincount(index, weights=dot[keep] <= plan.get('cos_inner', -2.0), minlength=len(keys))
+    return keys, source.astype(np.int64), background.astype(np.int64)
+
+
+def merge_counts(counts):
+    '''
+    Sum the (keys, source, background) counts of several scans.
+    '''
+    counts = [item for item in counts if len(item[0])]
+    if not counts:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    keys, index = np.unique(np.concatenate([item[0] for item in counts]), return_inverse=True)
+    source = np.bincount(index, weights=np.concatenate([item[1] for item in counts]), minlength=len(keys))
+    background = np.bincount(index, weights=np.concatenate([item[2] for item in counts]), minlength=len(keys))
+    return keys, source.astype(np.int64), background.astype(np.int64)
+
+
+def get_light_curve_table(keys, source, background, plan, time_start, bin_width, by_flag=False):
+    '''
+    Light curve of binned counts.
+
+    Returns
+    -------
+    pandas.DataFrame
+        bin, time (start of the bin), flag (with by_flag), counts and, with an annulus, background and
+        net (counts less the background scaled to the area of the source cone)
+    '''
+    keys = np.asarray(keys, dtype=np.int64)
+    bins = keys % 2**40 if by_flag else keys
+    columns = {'bin': bins, 'time': time_start + bins*bin_width}
+    if by_flag:
+        columns['flag'] = (keys - bins) // 2**40
+    columns['counts'] = np.asarray(source, dtype=np.int64)
+    if 'cos_inner' in plan:
+        # solid angle of the source cone over that of the annulus
+        ratio = (1 - plan['cos_source'])/(plan['cos_inner'] - plan['cos_radius'])
+        columns['background'] = np.asarray(background, dtype=np.int64)
+        columns['net'] = columns['counts'] - ratio*columns['background']
+    df = pd.DataFrame(columns)
+    return df.sort_values(['bin', 'flag'] if by_flag else ['bin'], ignore_index=True)
+
+
+def bin_photons(tbl, ra, dec, radius, time_start, time_end, bin_width, flag=0, by_flag=False, annulus=None):
+    '''
+    Light curve of the raw rows of a cone search, for backends that cannot aggregate: the rows must
+    cover the outer radius (the annulus, if any) with the flags wanted. Rows outside the time range,
+    end excluded, are not counted.
+
+    Returns
+    -------
+    pandas.DataFrame
+        as light_curve
+    '''
+    plan = get_light_curve_plan(ra, dec, radius, annulus)
+    tbl = tbl if isinstance(tbl, pa.Table) else pa.Table.from_pandas(tbl, preserve_index=False)
+    columns = {name.lower(): tbl[name].to_numpy() for name in tbl.column_names}
+    keep = (columns['time'] >= time_start) & (columns['time'] < time_end)
+    if flag is not None:
+        keep &= columns['flag'] == flag
+    dot = plan['cx']*columns['cx'][keep] + plan['cy']*columns['cy'][keep] + plan['cz']*columns['cz'][keep]
+    counts = count_photons(columns['time'][keep], columns['flag'][keep], dot, plan, time_start, bin_width, by_flag)
+    return get_light_curve_table(*counts, plan, time_start, bin_width, by_flag)
+
+
+def light_curve(ra, dec, radius, time_start, time_end, bin_width,
+                aws_profile, aws_region, s3_output_location, athena_database, athena_workgroup,
+                flag=0, by_flag=False, annulus=None, layout=None, query_life=10, wait_time=0.1):
+    '''
+    Light curve of a source, binned by Athena: only the counts of each time bin are returned.
+
+    Parameters
+    ----------
+    ra, dec, radius: float
+        center and radius of the source cone in degrees
+    time_start, time_end: int
+        time range searched, end excluded; bins start at time_start
+    bin_width: int
+        width of the time bins, in the units of the time column
+    flag: int
+        flag of the photons counted, None for all flags
+    by_flag: bool
+        count each flag separately
+    annulus: tuple
+        (inner, outer) radii in degrees of an annulus around the source whose photons are counted as
+        background (default: no background)
+    layout: dict or str
+        layout spec to prune partitions by the partition keys, as in cone_search
+
+    Returns
+    -------
+    pandas.DataFrame
+        bin, time (start of the bin), flag (with by_flag), counts and, with an annulus, background and
+        net; bins without photons are left out
+    '''
+    plan = get_light_curve_plan(ra, dec, radius, annulus)
+    router = None
+    if layout is not None:
+        router = PartitionRouter.from_layout('', load_layout(layout) if isinstance(layout, str) else layout)
+    query = get_light_curve_query(plan, time_start, time_end, bin_width, flag, by_flag, router)
+    sess = boto3.Session(profile_name=aws_profile,
+                         region_name=aws_region)
+    athena_client = sess.client('athena')
+    s3_client = sess.client('s3')
+    bucket = s3_output_location.replace('s3://', '').split('/')[0]
+    additional_s3_path = s3_output_location.replace('s3://{}/'.format(bucket), '')
+    start_time = time.time()
+    execution, = run_queries(athena_client, [query], athena_database, s3_output_location, athena_workgroup,
+                             query_life=query_life, min_wait=wait_time)
+    print('Time taken to query: ~{:.4f} seconds'.format(time.time()-start_time))
+    if execution['state'] != 'SUCCEEDED':
+        return None
+    tbl = read_csv_table(s3_client, bucket, os.path.join(additional_s3_path, execution['execution_id'] + '.csv'),
+                         os.path.join(tempfile.gettempdir(), execution['execution_id'] + '.csv'))
+    keys = tbl['bin'].to_numpy() + (tbl['flag'].to_numpy().astype(np.int64) * 2**40 if by_flag else 0)
+    return get_light_curve_table(keys, tbl['counts'].to_numpy(),
+                                 tbl['background'].to_numpy() if annulus is not None else np.zeros(tbl.num_rows),
+                                 plan, time_start, bin_width, by_flag)
+
+
+def light_curve_local(ra, dec, radius, time_start, time_end, bin_width, path, flag=0, by_flag=False, annulus=None):
+    '''
+    Light curve of a source over the partitioned PARQUET files in path, binned while the row groups
+    are scanned, so that no rows are kept.
+
+    Returns
+    -------
+    pandas.DataFrame
+        as light_curve
+    '''
+    plan = get_light_curve_plan(ra, dec, radius, annulus)
+    router = get_router(path)
+    field = ds.field
+    counts = []
+    for ra_range in plan['ra_ranges']:
+        files = get_files(router, plan, ra_range)
+        if not files:
+            continue
+        expression = ((field('zoneID') >= plan['min_zoneid']) & (field('zoneID') <= plan['max_zoneid']) &
+                      (field('dec') >= plan['dec_range'][0]) & (field('dec') <= plan['dec_range'][1]) &
+                      (field('ra') >= ra_range[0]) & (field('ra') <= ra_range[1]) &
+                      (field('time') >= time_start) & (field('time') < time_end))
+        if flag is not None:
+            expression = expression & (field('flag') == flag)
+        pruned, _, _ = prune(files, expression)
+        for batch in pruned.to_batches(columns=['zoneID', 'dec', 'ra', 'cx', 'cy', 'cz', 'time', 'flag'],
+                                       filter=expression):
+            columns = {name: batch.column(name).to_numpy() for name in batch.schema.names}
+            dot = plan['cx']*columns['cx'] + plan['cy']*columns['cy'] + plan['cz']*columns['cz']
+            counts.append(count_photons(columns['time'], columns['flag'], dot, plan, time_start, bin_width, by_flag))
+    return get_light_curve_table(*merge_counts(counts), plan, time_start, bin_width, by_flag)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Light curve of a source over the local partitions.')
+    parser.add_argument('path', help='Path to folder containing the zoneID partitions.')
+    parser.add_argument('ra', type=float, help='RA of the source.')
+    parser.add_argument('dec', type=float, help='DEC of the source.')
+    parser.add_argument('radius', type=float, help='Radius of the source cone in degrees.')
+    parser.add_argument('timestart', type=int, help='Start of the first bin.')
+    parser.add_argument('timeend', type=int, help='End of the time range, excluded.')
+    parser.add_argument('binwidth', type=int, help='Width of the time bins.')
+    parser.add_argument('-f', '--flag', default=0, type=int, metavar='',
+                        help='Flag of the photons counted (default=0).')
+    parser.add_argument('-b', '--byflag', action='store_true',
+                        help='Count the photons of all flags, each flag separately.')
+    parser.add_argument('-a', '--annulus', nargs=2, type=float, default=None, metavar='',
+                        help='Inner and outer radius of the background annulus in degrees.')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    df = light_curve_local(args.ra, args.dec, args.radius, args.timestart, args.timeend, args.binwidth, args.path,
+                           None if args.byflag else args.flag, args.byflag, args.annulus)
+    print('Time taken to bin: ~{:.4f} seconds\n'.format(time.time()-start_time))
+    print(df)
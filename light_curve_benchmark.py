@@ -0,0 +1,58 @@
+import io
+import csv
+import time
+import argparse
+from cone_search_local import cone_search_local
+from light_curve import light_curve_local, bin_photons
+
+parser = argparse.ArgumentParser(description='Compare the bytes and time of a light curve binned by the engine with '
+                                             'retrieving the raw photons and binning them on the client.')
+parser.add_argument('path', help='Path to folder containing the zoneID partitions.')
+parser.add_argument('ra', type=float, help='RA of the source.')
+parser.add_argument('dec', type=float, help='DEC of the source.')
+parser.add_argument('radius', type=float, help='Radius of the source cone in degrees.')
+parser.add_argument('timestart', type=int, help='Start of the first bin.')
+parser.add_argument('timeend', type=int, help='End of the time range, excluded.')
+parser.add_argument('binwidth', type=int, help='Width of the time bins.')
+parser.add_argument('-f', '--flag', default=0, type=int, metavar='',
+                    help='Flag of the photons counted (default=0).')
+parser.add_argument('-a', '--annulus', nargs=2, type=float, default=None, metavar='',
+                    help='Inner and outer radius of the background annulus in degrees.')
+parser.add_argument('-i', '--numiterations', default=3, type=int, metavar='',
+                    help='Number of times each mode is run; the fastest is reported (default=3).')
+
+
+def get_csv_bytes(df):
+    '''
+    Size of a result as Athena writes it: a quoted CSV with lower case column names.
+    '''
+    output = io.StringIO()
+    df.rename(columns=str.lower).to_csv(output, index=False, quoting=csv.QUOTE_ALL)
+    return len(output.getvalue().encode())
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    outer = args.radius if args.annulus is None else args.annulus[1]
+    timings = {'raw': [], 'aggregated': []}
+    for _ in range(args.numiterations):
+        start = time.time()
+        rows = cone_search_local(args.ra, args.dec, outer, args.timestart, args.timeend, args.flag, args.path)
+        raw = bin_photons(rows, args.ra, args.dec, args.radius, args.timestart, args.timeend, args.binwidth,
+                          args.flag, annulus=args.annulus)
+        timings['raw'].append(time.time()-start)
+        start = time.time()
+        aggregated = light_curve_local(args.ra, args.dec, args.radius, args.timestart, args.timeend, args.binwidth,
+                                       args.path, args.flag, annulus=args.annulus)
+        timings['aggregated'].append(time.time()-start)
+    assert raw.equals(aggregated), 'The binned raw rows differ from the aggregated light curve.'
+    # the aggregated result has the columns of the GROUP BY query, the rest is computed on the client
+    sizes = {'raw': get_csv_bytes(rows),
+             'aggregated': get_csv_bytes(aggregated[[name for name in ['bin', 'counts', 'background']
+                                                     if name in aggregated.columns]])}
+    print('\nRESULTS\n')
+    print('{} photons in {} bins\n'.format(len(rows), len(aggregated)))
+    print('{:<12}{:>12}{:>16}{:>14}'.format('mode', 'seconds', 'result bytes', 'rows'))
+    for mode, num_rows in [('raw', len(rows)), ('aggregated', len(aggregated))]:
+        print('{:<12}{:>12.4f}{:>16,}{:>14,}'.format(mode, min(timings[mode]), sizes[mode], num_rows))
+    print('\nThe aggregated result is ~{:,.0f}x smaller.'.format(sizes['raw']/max(sizes['aggregated'], 1)))
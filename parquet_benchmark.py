@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import itertools
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from gphoton_schema import header, header_dtypes, schema
+from cone_search import get_alpha
+
+parser = argparse.ArgumentParser(description='Benchmark Parquet codecs, encodings and row group sizes on gPhoton data.')
+parser.add_argument('-s', '--sample', default=None, metavar='',
+                    help='Path to a Parquet file or a folder of Parquet files to sample (default: synthetic rows).')
+parser.add_argument('-n', '--numrows', default=1000000, type=int, metavar='',
+                    help='Number of rows to benchmark with (default=1,000,000).')
+parser.add_argument('-c', '--codecs', default='snappy,zstd-1,zstd-3,zstd-9,lz4,gzip', metavar='',
+                    help='Comma separated list of codecs, with an optional -level (default: snappy,zstd-1,zstd-3,'
+                         'zstd-9,lz4,gzip).')
+parser.add_argument('-e', '--encodings', default='dictionary,plain,delta,byte_stream_split,delta+byte_stream_split',
+                    metavar='', help='Comma separated list of encodings (default: all).')
+parser.add_argument('-g', '--rowgroups', default='65536,1048576', metavar='',
+                    help='Comma separated list of row group sizes in rows (default: 65536,1048576).')
+parser.add_argument('-r', '--radius', default=0.008333333, type=float, metavar='',
+                    help='Radius of the cone read to time predicate reads (default=0.008333333).')
+parser.add_argument('-i', '--numiterations', default=3, type=int, metavar='',
+                    help='Number of times each measurement is repeated; the median is reported (default=3).')
+parser.add_argument('-o', '--output', default=None, metavar='',
+                    help='Path of the JSON file to write the results to (default: standard output).')
+
+float_columns = [name for name, dtype in zip(header, header_dtypes) if np.issubdtype(dtype, np.floating)]
+
+
+def get_encoding_options(encoding):
+    '''
+    write_table options of an encoding:
+        dictionary: dictionary encode every column (the pyarrow default)
+        plain: no dictionary encoding
+        delta: DELTA_BINARY_PACKED for time
+        byte_stream_split: BYTE_STREAM_SPLIT for the float columns
+    '''
+    if encoding == 'dictionary':
+        return {'use_dictionary': True}
+    if encoding == 'plain':
+        return {'use_dictionary': False}
+    column_encoding = {}
+    for name in encoding.split('+'):
+        if name == 'delta':
+            column_encoding['time'] = 'DELTA_BINARY_PACKED'
+        elif name == 'byte_stream_split':
+            column_encoding.update({column: 'BYTE_STREAM_SPLIT' for column in float_columns})
+        else:
+            raise ValueError('Unknown encoding {}'.format(name))
+    # columns with an explicit encoding cannot also be dictionary encoded
+    return {'use_dictionary': [column for column in header if column not in column_encoding],
+            'column_encoding': column_encoding}
+
+
+def get_codec_options(codec):
+    name, _, level = codec.partition('-')
+    options = {'compression': name}
+    if level:
+        options['compression_level'] = int(level)
+    return options
+
+
+def generate_rows(num_rows, seed=0):
+    '''
+    Synthetic rows with the gPhoton schema: photons of a few zones, sorted by ra like the ingested files.
+    '''
+    rng = np.random.default_rng(seed)
+    zone_ids = rng.integers(10829, 10832, num_rows)
+    zoneHeight = 30.0/3600.0
+    dec = (zone_ids + rng.random(num_rows))*zoneHeight - 90.0
+    ra = np.sort(rng.uniform(0, 36, num_rows))
+    cos_dec = np.cos(np.radians(dec))
+    columns = {
+        'zoneID': zone_ids,
+        'time': rng.integers(740229107995, 1012464073985, num_rows),
+        'cx': cos_dec*np.cos(np.radians(ra)),
+        'cy': cos_dec*np.sin(np.radians(ra)),
+        'cz': np.sin(np.radians(dec)),
+        'x': rng.normal(0, 1000, num_rows),
+        'y': rng.normal(0, 1000, num_rows),
+        'xa': rng.integers(0, 800, num_rows),
+        'ya': rng.integers(0, 800, num_rows),
+        'q': rng.integers(0, 30, num_rows),
+        'xi': rng.normal(0, 0.5, num_rows),
+        'eta': rng.normal(0, 0.5, num_rows),
+        'ra': ra,
+        'dec': dec,
+        'flag': rng.choice([0, 0, 0, 0, 1, 2], num_rows)
+    }
+    return pa.Table.from_arrays([pa.array(columns[name].astype(dtype)) for name, dtype in zip(header, header_dtypes)],
+                                schema=schema)
+
+
+def load_sample(path, num_rows):
+    '''
+    Up to num_rows rows with the gPhoton schema read from a Parquet file or a folder of them.
+    '''
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(folder, file) for folder, _, file_names in os.walk(path)
+                       for file in file_names if file.endswith('.parquet'))
+    tables = []
+    for file in files:
+        tables.append(pq.read_table(file, columns=header).cast(schema))
+        if sum(tbl.num_rows for tbl in tables) >= num_rows:
+            break
+    return pa.concat_tables(tables).slice(0, num_rows).sort_by('ra')
+
+
+def get_cone_filters(tbl, radius):
+    '''
+    Row group filters of the dec and ra box of a cone_search around the middle row of the table.
+    '''
+    ra = tbl['ra'][tbl.num_rows//2].as_py()
+    dec = tbl['dec'][tbl.num_rows//2].as_py()
+    alpha = get_alpha(radius, dec)
+    return [('dec', '>=', dec - radius), ('dec', '<=', dec + radius),
+            ('ra', '>=', ra - alpha), ('ra', '<=', ra + alpha)]
+
+
+def measure(function, num_iterations):
+    '''
+    Median seconds taken by function and its last result.
+    '''
+    elapsed = []
+    for _ in range(num_iterations):
+        start = time.perf_counter()
+        result = function()
+        elapsed.append(time.perf_counter() - start)
+    return float(np.median(elapsed)), result
+
+
+def run(tbl, codecs, encodings, row_group_sizes, filters, num_iterations):
+    num_mb = tbl.nbytes/(1024*1024)
+    temp_path = tempfile.mkdtemp()
+    results = []
+    try:
+        for codec, encoding, row_group_size in itertools.product(codecs, encodings, row_group_sizes):
+            options = dict(get_codec_options(codec), **get_encoding_options(encoding))
+            options['row_group_size'] = row_group_size
+            path = os.path.join(temp_path, 'benchmark.parquet')
+            write_time, _ = measure(lambda: pq.write_table(tbl, path, **options), num_iterations)
+            read_time, _ = measure(lambda: pq.read_table(path), num_iterations)
+            cone_time, cone = measure(lambda: pq.read_table(path, filters=filters), num_iterations)
+            result = {
+                'codec': codec,
+                'encoding': encoding,
+                'row_group_size': row_group_size,
+                'file_size_mb': os.path.getsize(path)/(1024*1024),
+                'compression_ratio': num_mb/(os.path.getsize(path)/(1024*1024)),
+                'write_mb_per_second': num_mb/write_time,
+                'read_mb_per_second': num_mb/read_time,
+                'cone_read_seconds': cone_time,
+                'cone_rows': cone.num_rows,
+                'options': options
+            }
+            print('{codec:<8}{encoding:<26}{row_group_size:>10,}{file_size_mb:>10.2f} MB'
+                  '{write_mb_per_second:>12.1f}{read_mb_per_second:>11.1f}'
+                  '{cone_read_seconds:>9.4f}'.format(**result), file=sys.stderr)
+            results.append(result)
+    finally:
+        shutil.rmtree(temp_path)
+    return results
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.sample is not None:
+        tbl = load_sample(args.sample, args.numrows)
+    else:
+        tbl = generate_rows(args.numrows)
+    filters = get_cone_filters(tbl, args.radius)
+    print('{:,} rows, ~{:.1f} MB in memory\n'.format(tbl.num_rows, tbl.nbytes/(1024*1024)), file=sys.stderr)
+    print('{:<8}{:<26}{:>10}{:>13}{:>12}{:>11}{:>9}'.format('codec', 'encoding', 'rows/rg', 'size', 'write MB/s',
+                                                           'read MB/s', 'cone s'), file=sys.stderr)
+    results = {
+        'num_rows': tbl.num_rows,
+        'mb': tbl.nbytes/(1024*1024),
+        'sample': args.sample,
+        'radius': args.radius,
+        'filters': filters,
+        'pyarrow': pa.__version__,
+        'results': run(tbl, args.codecs.split(','), args.encodings.split(','),
+                       [int(size) for size in args.rowgroups.split(',')], filters, args.numiterations)
+    }
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
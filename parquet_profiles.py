@@ -0,0 +1,147 @@
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+import pyarrow.parquet as pq
+from cone_search import get_alpha
+from partition_layout import PartitionRouter
+
+# Options passed to pyarrow.parquet.write_table for each named writer profile.
+#   default: what the ingest has always written; one row group per file, no page index
+#   pruning: small row groups and pages with full statistics and a page index so that engines can
+#            skip row groups and pages by min/max; zoneID and flag are dictionary encoded so that
+#            their dictionary pages can rule out a value (pyarrow cannot write bloom filters)
+#   compact: the pruning layout with the best size/speed trade-off of parquet_benchmark.py; zstd level 3,
+#            DELTA_BINARY_PACKED time and BYTE_STREAM_SPLIT floats write ~30% smaller files than snappy
+#            with dictionaries, and write and scan faster
+profiles = {
+    'default': {
+        'compression': 'snappy'
+    },
+    'pruning': {
+        'compression': 'snappy',
+        'row_group_size': 65536,
+        'data_page_size': 64*1024,
+        'write_statistics': True,
+        'write_page_index': True,
+        'use_dictionary': ['zoneID', 'flag']
+    },
+    'compact': {
+        'compression': 'zstd',
+        'compression_level': 3,
+        'row_group_size': 65536,
+        'data_page_size': 64*1024,
+        'write_statistics': True,
+        'write_page_index': True,
+        'use_dictionary': ['zoneID', 'xa', 'ya', 'q', 'flag'],
+        'column_encoding': {
+            'time': 'DELTA_BINARY_PACKED',
+            'cx': 'BYTE_STREAM_SPLIT',
+            'cy': 'BYTE_STREAM_SPLIT',
+            'cz': 'BYTE_STREAM_SPLIT',
+            'x': 'BYTE_STREAM_SPLIT',
+            'y': 'BYTE_STREAM_SPLIT',
+            'xi': 'BYTE_STREAM_SPLIT',
+            'eta': 'BYTE_STREAM_SPLIT',
+            'ra': 'BYTE_STREAM_SPLIT',
+            'dec': 'BYTE_STREAM_SPLIT'
+        }
+    }
+}
+
+
+def write_table(tbl, path, profile='default'):
+    '''
+    Write a table to a Parquet file with the options of a writer profile.
+    '''
+    pq.write_table(tbl, path, **profiles[profile])
+
+
+def get_cone_predicate(ra, dec, radius, time_start, time_end, flag):
+    '''
+    Ranges of the columns filtered by the cone_search query.
+
+    Returns
+    -------
+    dict
+        column -> list of (min, max) ranges, a value must be in one of them
+    '''
+    alpha = get_alpha(radius, dec)
+    if (ra - alpha) < 0:
+        ra = ra + 360
+    zoneHeight = 30.0/3600.0
+    ra_ranges = [(ra - alpha, ra + alpha)]
+    if (ra + alpha) > 360:
+        ra_ranges.append((0, ra - 360 + alpha))
+    return {
+        'zoneID': [(np.floor((dec - radius + 90.0) / zoneHeight), np.floor((dec + radius + 90.0) / zoneHeight))],
+        'dec': [(dec - radius, dec + radius)],
+        'ra': ra_ranges,
+        # time < time_end is exclusive, time_end - 1 is the largest matching value
+        'time': [(time_start, time_end - 1)],
+        'flag': [(flag, flag)]
+    }
+
+
+def count_row_groups(path, predicate):
+    '''
+    Number of row groups in a Parquet file and number of those whose statistics rule out the predicate.
+    '''
+    metadata = pq.ParquetFile(path).metadata
+    names = [metadata.schema.column(index).name for index in range(metadata.num_columns)]
+    num_skipped = 0
+    for row_group_index in range(metadata.num_row_groups):
+        row_group = metadata.row_group(row_group_index)
+        for column, ranges in predicate.items():
+            statistics = row_group.column(names.index(column)).statistics
+            if statistics is None or not statistics.has_min_max:
+                continue
+            if all(statistics.max < low or statistics.min > high for low, high in ranges):
+                num_skipped += 1
+                break
+    return metadata.num_row_groups, num_skipped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark how many row groups each writer profile lets a '
+                                                 'cone search skip.')
+    parser.add_argument('path', help='Path to folder containing the zoneID partitions.')
+    parser.add_argument('ra', type=float, help='RA query parameter.')
+    parser.add_argument('dec', type=float, help='DEC query parameter.')
+    parser.add_argument('radius', type=float, help='Radius used to determine the zone to be searched.')
+    parser.add_argument('timestart', type=int, help='Start time to be searched in query.')
+    parser.add_argument('timeend', type=int, help='End time to be searched in query.')
+    parser.add_argument('flag', type=int, help='Flag to be searched in query.')
+    parser.add_argument('-w', '--writer', default=','.join(profiles), metavar='',
+                        help='Comma separated list of writer profiles to compare (default: all).')
+    args = parser.parse_args()
+
+    predicate = get_cone_predicate(args.ra, args.dec, args.radius, args.timestart, args.timeend, args.flag)
+    # only the row groups of the partitions the cone touches are left to be pruned by statistics
+    router = PartitionRouter.from_path(args.path)
+    (min_zoneid, max_zoneid), = predicate['zoneID']
+    files = []
+    for (zone_id, low, high), path in zip(router.partitions, router.paths):
+        if min_zoneid <= zone_id <= max_zoneid and any(low <= b and a <= high for a, b in predicate['ra']):
+            files.extend(os.path.join(path, file) for file in sorted(os.listdir(path)) if file.endswith('.parquet'))
+    print('Rewriting {} files of the partitions touched by the cone with each profile.\n'.format(len(files)))
+    for profile in args.writer.split(','):
+        temp_path = tempfile.mkdtemp()
+        num_bytes = 0
+        num_row_groups = 0
+        num_skipped = 0
+        start = time.time()
+        for index, file in enumerate(files):
+            save_path = os.path.join(temp_path, '{}.parquet'.format(index))
+            write_table(pq.read_table(file), save_path, profile)
+            num_bytes += os.path.getsize(save_path)
+            total, skipped = count_row_groups(save_path, predicate)
+            num_row_groups += total
+            num_skipped += skipped
+        shutil.rmtree(temp_path)
+        print('Profile: {}\n\tsize: ~{:.2f} MB, written in ~{:.2f} seconds\n'
+              '\trow groups skipped: {:,} of {:,} ({:.1%})\n'.format(profile, num_bytes*1e-6, time.time()-start,
+                                                                      num_skipped, num_row_groups,
+                                                                      num_skipped/num_row_groups if num_row_groups else 0))
@@ -0,0 +1,360 @@
+import os
+import re
+import json
+import time
+import argparse
+import numpy as np
+
+# name of the layout spec written to the folder containing the zoneID partitions
+layout_file_name = 'layout.json'
+# partition keys of the Athena table, registered by register_partitions.py: the zoneID and the name of
+# the RA folder of each partition (zoneID and ra are also data columns of the files)
+partition_columns = (('zone', 'INT'), ('ra_slab', 'STRING'))
+zone_pattern = re.compile(r'^zoneID=(-?\d+)$')
+ra_pattern = re.compile(r'^([-\d.]+)<=ra<(=?)([-\d.]+)$')
+
+
+class PartitionRouter:
+    '''
+    Map (zoneID, ra) to the zoneID=.../a<=ra<b partitions created by generate_directory.py.
+
+    The directory tree is read once when the router is built. Routing is then a binary search
+    over the sorted zoneIDs and RA boundaries, done for whole arrays at a time.
+    '''
+    def __init__(self, root, zone_ids, boundaries):
+        '''
+        Parameters
+        ----------
+        root: str
+            path to the folder containing the zoneID partitions
+        zone_ids: list
+            zoneIDs with a partition
+        boundaries: dict
+            zoneID -> sorted RA boundaries [b0, b1, ..., bn] of the n RA partitions of the zone,
+            the last of which includes its upper boundary
+        '''
+        self.root = root
+        self.zone_ids = np.array(sorted(zone_ids), dtype=np.int64)
+        self.boundaries = {int(zone_id): np.asarray(boundaries[zone_id], dtype=np.float64)
+                           for zone_id in self.zone_ids}
+        num_partitions = [len(self.boundaries[zone_id]) - 1 for zone_id in self.zone_ids]
+        self.offsets = np.concatenate([[0], np.cumsum(num_partitions)]).astype(np.int64)
+        self.paths = []
+        self.partitions = []
+        for zone_id in self.zone_ids:
+            edges = self.boundaries[int(zone_id)]
+            for index in range(len(edges) - 1):
+                self.partitions.append((int(zone_id), edges[index], edges[index+1]))
+                self.paths.append(os.path.join(root,
+                                               'zoneID={}'.format(zone_id),
+                                               get_ra_partition_name(edges[index], edges[index+1],
+                                                                     index == len(edges) - 2)))
+        # when every zone has the same RA boundaries a single search routes all the rows
+        first = self.boundaries[int(self.zone_ids[0])] if len(self.zone_ids) else None
+        self.uniform = all(np.array_equal(first, edges) for edges in self.boundaries.values())
+
+    @classmethod
+    def from_directory(cls, path):
+        '''
+        Build the router from the folders found under path.
+        '''
+        zone_ids = []
+        boundaries = {}
+        for zone_folder in os.listdir(path):
+            match = zone_pattern.match(zone_folder)
+            if match is None or not os.path.isdir(os.path.join(path, zone_folder)):
+                continue
+            edges = set()
+            for ra_folder in os.listdir(os.path.join(path, zone_folder)):
+                ra_match = ra_pattern.match(ra_folder)
+                if ra_match is None or not os.path.isdir(os.path.join(path, zone_folder, ra_folder)):
+                    continue
+                edges.update([float(ra_match.group(1)), float(ra_match.group(3))])
+            if edges:
+                zone_ids.append(int(match.group(1)))
+                boundaries[int(match.group(1))] = sorted(edges)
+        if not zone_ids:
+            raise ValueError('No zoneID=.../a<=ra<b partitions found in {}'.format(path))
+        return cls(path, zone_ids, boundaries)
+
+    @classmethod
+    def from_layout(cls, path, layout=None):
+        '''
+        Build the router from a layout spec, by default the one saved in path.
+        '''
+        if layout is None:
+            layout = load_layout(os.path.join(path, layout_file_name))
+        return cls(path, [int(zone_id) for zone_id in layout['zones']],
+                   {int(zone_id): edges for zone_id, edges in layout['zones'].items()})
+
+    @classmethod
+    def from_path(cls, path):
+        '''
+        Build the router from the layout spec saved in path, or from its folders if there is none.
+        '''
+        if os.path.exists(os.path.join(path, layout_file_name)):
+            return cls.from_layout(path)
+        return cls.from_directory(path)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def route(self, zone_ids, ra):
+        '''
+        Partition ids of the rows with the given zoneIDs and RAs.
+
+        Returns
+        -------
+        numpy.ndarray
+            partition id of each row (index into self.paths), or -1 if no partition holds the row
+        '''
+        zone_ids = np.asarray(zone_ids, dtype=np.int64)
+        ra = np.asarray(ra, dtype=np.float64)
+        zone_index = np.minimum(np.searchsorted(self.zone_ids, zone_ids), len(self.zone_ids) - 1)
+        valid = self.zone_ids[zone_index] == zone_ids
+        if self.uniform:
+            edges = self.boundaries[int(self.zone_ids[0])]
+            ra_index = np.searchsorted(edges[1:-1], ra, side='right')
+            valid &= (ra >= edges[0]) & (ra <= edges[-1])
+        else:
+            ra_index = np.zeros(len(ra), dtype=np.int64)
+            order = np.argsort(zone_index, kind='stable')
+            bounds = np.searchsorted(zone_index[order], np.arange(len(self.zone_ids) + 1))
+            for index in range(len(self.zone_ids)):
+                rows = order[bounds[index]:bounds[index+1]]
+                if not len(rows):
+                    continue
+                edges = self.boundaries[int(self.zone_ids[index])]
+                ra_index[rows] = np.searchsorted(edges[1:-1], ra[rows], side='right')
+                valid[rows] &= (ra[rows] >= edges[0]) & (ra[rows] <= edges[-1])
+        return np.where(valid, self.offsets[zone_index] + ra_index, -1)
+
+    def get_partitions(self, min_zoneid, max_zoneid, ra_min, ra_max):
+        '''
+        Ids of the partitions of the zones min_zoneid to max_zoneid whose RA range overlaps [ra_min, ra_max].
+        '''
+        partition_ids = []
+        for partition_id, (zone_id, lower, upper) in enumerate(self.partitions):
+            last = upper == self.boundaries[zone_id][-1]
+            if min_zoneid <= zone_id <= max_zoneid and lower <= ra_max and (ra_min < upper or last and ra_min <= upper):
+                partition_ids.append(partition_id)
+        return partition_ids
+
+    def group(self, partition_ids):
+        '''
+        Group rows by partition id, skipping the rows without a partition.
+
+        Returns
+        -------
+        generator
+            (partition id, indices of the rows in that partition)
+        '''
+        partition_ids = np.asarray(partition_ids)
+        order = np.argsort(partition_ids, kind='stable')
+        sorted_ids = partition_ids[order]
+        bounds = np.flatnonzero(np.diff(sorted_ids)) + 1
+        for indices in np.split(order, bounds):
+            if len(indices) and partition_ids[indices[0]] >= 0:
+                yield int(partition_ids[indices[0]]), indices
+
+
+def select_partitions(router, min_zoneid, max_zoneid, ra_ranges):
+    '''
+    Ids of the partitions of the zones min_zoneid to max_zoneid overlapping any of the RA ranges of a
+    cone, e.g. both slabs of a cone wrapping past 360.
+    '''
+    partition_ids = set()
+    for ra_min, ra_max in ra_ranges:
+        partition_ids.update(router.get_partitions(min_zoneid, max_zoneid, ra_min, ra_max))
+    return sorted(partition_ids)
+
+
+def get_partition_predicate(router, partition_ids):
+    '''
+    SQL predicate on the partition keys matching exactly the partitions; consecutive zones with the
+    same RA slabs share a term.
+    '''
+    slabs = {}
+    for partition_id in partition_ids:
+        zone_id, lower, upper = router.partitions[partition_id]
+        slabs.setdefault(zone_id, []).append(os.path.basename(router.paths[partition_id]))
+    terms = []
+    for zone_id in sorted(slabs):
+        if terms and terms[-1][1] == zone_id - 1 and terms[-1][2] == slabs[zone_id]:
+            terms[-1][1] = zone_id
+        else:
+            terms.append([zone_id, zone_id, slabs[zone_id]])
+    if not terms:
+        return 'FALSE'
+    zone_column, slab_column = [name for name, _ in partition_columns]
+    return '(' + ' OR '.join('({} AND {} IN ({}))'.format(
+        '{} = {}'.format(zone_column, first) if first == last else '{} BETWEEN {} AND {}'.format(zone_column, first, last),
+        slab_column, ', '.join("'{}'".format(name) for name in names)) for first, last, names in terms) + ')'
+
+
+def get_add_partition_queries(router, table_name, location, batch_size=100):
+    '''
+    ALTER TABLE queries registering the partitions of the router with the Athena table, batch_size
+    partitions per query.
+    '''
+    zone_column, slab_column = [name for name, _ in partition_columns]
+    queries = []
+    for index in range(0, len(router), batch_size):
+        partitions = []
+        for partition_id in range(index, min(index + batch_size, len(router))):
+            partitions.append("PARTITION ({} = {}, {} = '{}') LOCATION '{}/'".format(
+                zone_column, router.partitions[partition_id][0], slab_column,
+                os.path.basename(router.paths[partition_id]),
+                location.rstrip('/') + '/' + router.paths[partition_id]))
+        queries.append('ALTER TABLE {} ADD IF NOT EXISTS\n{};'.format(table_name, '\n'.join(partitions)))
+    return queries
+
+
+def test():
+    '''
+    Check the partitions selected for cones against the layouts they are cut from.
+    '''
+    from cone_search import get_search_plan
+    layout = get_uniform_layout(range(10000, 10020))
+    router = PartitionRouter.from_layout('', layout)
+
+    def names(partition_ids):
+        return [(router.partitions[partition_id][0], os.path.basename(router.paths[partition_id]))
+                for partition_id in partition_ids]
+
+    # a cone inside one slab of one zone
+    plan = get_search_plan(100.0, -6.62, 0.001)
+    assert names(select_partitions(router, plan['min_zoneid'], plan['max_zoneid'], plan['ra_ranges'])) == [
+        (10005, '72<=ra<108')]
+    plan = {'min_zoneid': 10005, 'max_zoneid': 10006, 'ra_ranges': [(100.0, 110.0)]}
+    assert names(select_partitions(router, **plan)) == [(10005, '72<=ra<108'), (10005, '108<=ra<144'),
+                                                        (10006, '72<=ra<108'), (10006, '108<=ra<144')]
+    # a cone wrapping past 360 selects the last and first slabs only, once each
+    plan = get_search_plan(0.01, -6.55, 0.02)
+    assert plan['min_zoneid'] >= 10000 and plan['max_zoneid'] <= 10019 and len(plan['ra_ranges']) == 2
+    selected = names(select_partitions(router, plan['min_zoneid'], plan['max_zoneid'], plan['ra_ranges']))
+    assert selected == [(zone_id, name) for zone_id in range(plan['min_zoneid'], plan['max_zoneid'] + 1)
+                        for name in ['0<=ra<36', '324<=ra<=360']]
+    predicate = get_partition_predicate(router, select_partitions(router, plan['min_zoneid'], plan['max_zoneid'],
+                                                                  plan['ra_ranges']))
+    assert predicate == "((zone BETWEEN {} AND {} AND ra_slab IN ('0<=ra<36', '324<=ra<=360')))".format(
+        plan['min_zoneid'], plan['max_zoneid'])
+    # the upper boundary of a slab belongs to the next slab, except for the last slab of a zone
+    assert names(select_partitions(router, 10000, 10000, [(36.0, 36.0)])) == [(10000, '36<=ra<72')]
+    assert names(select_partitions(router, 10000, 10000, [(360.0, 360.0)])) == [(10000, '324<=ra<=360')]
+    # zones outside the layout select nothing
+    assert select_partitions(router, 20000, 20001, [(0.0, 360.0)]) == []
+    assert get_partition_predicate(router, []) == 'FALSE'
+    # zones whose slabs differ get their own terms
+    layout = {'zones': {'1': [0.0, 180.0, 360.0], '2': [0.0, 90.0, 360.0], '3': [0.0, 90.0, 360.0]}}
+    router = PartitionRouter.from_layout('', layout)
+    partition_ids = select_partitions(router, 1, 3, [(100.0, 120.0)])
+    assert names(partition_ids) == [(1, '0<=ra<180'), (2, '90<=ra<=360'), (3, '90<=ra<=360')]
+    assert get_partition_predicate(router, partition_ids) == ("((zone = 1 AND ra_slab IN ('0<=ra<180')) OR "
+                                                              "(zone BETWEEN 2 AND 3 AND ra_slab IN ('90<=ra<=360')))")
+    print('select_partitions tests passed')
+
+
+def get_uniform_layout(zone_ids, num_partitions=10, ra_min=0, ra_max=360):
+    '''
+    Layout spec of num_partitions equal RA partitions in every zone.
+    '''
+    step = (ra_max - ra_min)/num_partitions
+    edges = [ra_min + index*step for index in range(num_partitions)] + [float(ra_max)]
+    return {'zones': {str(zone_id): edges for zone_id in zone_ids}}
+
+
+def plan_layout(zone_ids, ra, target_rows, weights=None, zones=(), decimals=4):
+    '''
+    Layout spec with variable-width RA partitions holding about target_rows rows each.
+
+    Each zone is cut into ceil(rows/target_rows) partitions at the quantiles of its RA values.
+
+    Parameters
+    ----------
+    zone_ids, ra: array_like
+        zoneID and RA of sampled rows
+    target_rows: int
+        number of rows wanted per partition
+    weights: array_like
+        number of rows each sampled row stands for (default: 1)
+    zones: iterable
+        zoneIDs to include even if they were not sampled; they get a single partition
+    decimals: int
+        decimals the RA boundaries are rounded to
+
+    Returns
+    -------
+    dict
+        layout spec: zoneID -> RA boundaries
+    '''
+    zone_ids = np.asarray(zone_ids, dtype=np.int64)
+    ra = np.asarray(ra, dtype=np.float64)
+    weights = np.ones(len(ra)) if weights is None else np.asarray(weights, dtype=np.float64)
+    layout = {'target_rows': target_rows, 'zones': {}}
+    for zone_id in sorted(set(np.unique(zone_ids).tolist()) | set(zones)):
+        mask = zone_ids == zone_id
+        edges = [0.0, 360.0]
+        if mask.any():
+            order = np.argsort(ra[mask], kind='stable')
+            values = ra[mask][order]
+            cumulative = np.cumsum(weights[mask][order])
+            num_partitions = max(1, int(np.ceil(cumulative[-1]/target_rows)))
+            cuts = np.interp(np.arange(1, num_partitions)*cumulative[-1]/num_partitions, cumulative, values)
+            edges = np.unique(np.round(np.clip(np.concatenate([[0], cuts, [360]]), 0, 360), decimals)).tolist()
+        layout['zones'][str(zone_id)] = edges
+    return layout
+
+
+def save_layout(path, layout):
+    with open(path, 'w') as layout_file:
+        json.dump(layout, layout_file, indent=2)
+
+
+def load_layout(path):
+    with open(path) as layout_file:
+        return json.load(layout_file)
+
+
+def get_ra_partition_name(lower, upper, last):
+    '''
+    Name of the folder of an RA partition; only the last partition of a zone includes its upper boundary.
+    '''
+    return '{}<=ra<{}{}'.format(format_boundary(lower), '=' if last else '', format_boundary(upper))
+
+
+def format_boundary(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark routing rows to the partitions in a directory.')
+    parser.add_argument('path', nargs='?', default=None, help='Path to folder containing the zoneID partitions.')
+    parser.add_argument('-n', '--numrows', default=int(1e7), type=int, metavar='',
+                        help='Number of rows to route (default=10,000,000).')
+    parser.add_argument('-t', '--test', action='store_true',
+                        help='Run the tests of the partitions selected for cones instead.')
+    args = parser.parse_args()
+    if args.test:
+        test()
+        raise SystemExit
+    assert args.path is not None, 'Give the path to the partitions, or --test.'
+
+    start = time.time()
+    router = PartitionRouter.from_path(args.path)
+    print('Time taken to build router ({} partitions): ~{:.4f} seconds'.format(len(router), time.time()-start))
+    rng = np.random.default_rng(0)
+    zone_ids = rng.choice(router.zone_ids, args.numrows)
+    ra = rng.uniform(0, 360, args.numrows)
+    start = time.time()
+    partition_ids = router.route(zone_ids, ra)
+    elapsed = time.time()-start
+    print('Time taken to route {:,} rows: ~{:.4f} seconds ({:,.0f} rows/sec)'.format(args.numrows, elapsed,
+                                                                                   args.numrows/elapsed))
+    start = time.time()
+    num_groups = sum(1 for _ in router.group(partition_ids))
+    elapsed = time.time()-start
+    print('Time taken to group {:,} rows into {} partitions: ~{:.4f} seconds ({:,.0f} rows/sec)'.format(args.numrows,
+                                                                                                     num_groups,
+                                                                                                     elapsed,
+                                                                                                     args.numrows/elapsed))
@@ -0,0 +1,171 @@
+import time
+import queue
+import threading
+
+
+class StageCounter:
+    '''
+    Throughput and queue-depth counters of a pipeline stage.
+    '''
+    def __init__(self, name, num_workers):
+        self.name = name
+        self.num_workers = num_workers
+        self.lock = threading.Lock()
+        self.num_items = 0
+        self.num_bytes = 0
+        self.busy = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.num_samples = 0
+
+    def record(self, num_bytes, busy):
+        with self.lock:
+            self.num_items += 1
+            self.num_bytes += num_bytes
+            self.busy += busy
+
+    def sample(self, depth):
+        with self.lock:
+            self.depth_total += depth
+            self.depth_max = max(self.depth_max, depth)
+            self.num_samples += 1
+
+    def report(self, elapsed):
+        '''
+        Summary of the stage over elapsed seconds of wall time.
+        '''
+        return {
+            'stage': self.name,
+            'workers': self.num_workers,
+            'items': self.num_items,
+            'mb': self.num_bytes/(1024*1024),
+            'busy_seconds': self.busy,
+            'mb_per_second': self.num_bytes/(1024*1024)/self.busy if self.busy else 0,
+            'utilization': self.busy/(elapsed*self.num_workers) if elapsed else 0,
+            'queue_depth_mean': self.depth_total/self.num_samples if self.num_samples else 0,
+            'queue_depth_max': self.depth_max
+        }
+
+
+class Pipeline:
+    '''
+    Stages of worker threads connected by bounded queues.
+
+    A full queue blocks the stage putting into it, so a slow stage holds back the stages before it
+    instead of letting their output pile up in memory. The first error raised by any stage stops
+    the pipeline and is raised again by check().
+    '''
+    def __init__(self):
+        self.stop = threading.Event()
+        self.error = None
+        self.counters = []
+        self.threads = []
+        self.start_time = time.time()
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.stop.set()
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        self.check()
+
+    def get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.check()
+
+    def source(self, name, iterable, stage, size=None):
+        '''
+        Feed the items of iterable into stage from a thread of its own.
+        '''
+        counter = StageCounter(name, 1)
+        self.counters.append(counter)
+
+        def run():
+            items = iter(iterable)
+            try:
+                while not self.stop.is_set():
+                    start = time.time()
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        break
+                    counter.record(size(item) if size else 0, time.time()-start)
+                    stage.submit(item)
+            except Exception as error:
+                self.fail(error)
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return counter
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        return [counter.report(elapsed) for counter in self.counters]
+
+    def close(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+
+
+class Stage:
+    '''
+    A pool of worker threads applying function to the items put into a bounded queue, and
+    putting the results into output if given.
+    '''
+    def __init__(self, pipeline, name, function, num_workers=1, queue_depth=4, output=None, size=None):
+        self.pipeline = pipeline
+        self.function = function
+        self.output = output
+        self.size = size
+        self.input = queue.Queue(maxsize=queue_depth)
+        self.counter = StageCounter(name, num_workers)
+        pipeline.counters.append(self.counter)
+        for index in range(num_workers):
+            thread = threading.Thread(target=self._work, name='{}-{}'.format(name, index), daemon=True)
+            thread.start()
+            pipeline.threads.append(thread)
+
+    def submit(self, item):
+        self.counter.sample(self.input.qsize())
+        self.pipeline.put(self.input, item)
+
+    def _work(self):
+        while not self.pipeline.stop.is_set():
+            try:
+                item = self.input.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                start = time.time()
+                result = self.function(item)
+                self.counter.record(self.size(item) if self.size else 0, time.time()-start)
+                if self.output is not None:
+                    self.pipeline.put(self.output, result)
+            except Exception as error:
+                self.pipeline.fail(error)
+            finally:
+                self.input.task_done()
+
+    def join(self):
+        '''
+        Wait until every item submitted so far has been processed.
+        '''
+        while self.input.unfinished_tasks and not self.pipeline.stop.is_set():
+            time.sleep(0.01)
+        self.pipeline.check()
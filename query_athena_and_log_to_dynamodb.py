@@ -1,10 +1,18 @@
+import os
 import boto3
 import json
+import time
+import random
 from functools import reduce
 from collections import OrderedDict
-import time
+import asyncio
+import functools
 from datetime import datetime, timezone
 import argparse
+import numpy as np
+from athena_orchestrator import QueryOrchestrator
+from query_benchmark import load_templates, get_cones, fill_template
+from query_planner import min_billed_bytes
 
 parser = argparse.ArgumentParser(description='Get queries, AWS credentials, and Athena, DynamoDB, and S3 info.')
 parser.add_argument('-p', '--profile', default='default', metavar='',
@@ -18,95 +26,227 @@ parser.add_argument('-n', '--querycycles', default=2, type=int, metavar='',
                     help='Number of query cycles - i.e. number of times to run the queries')
 parser.add_argument('-l', '--querylife', default=10, type=int, metavar='',
                     help='Maximum number of seconds query should be allowed to run before stopping/cancelling (default=10).')
-parser.add_argument('-w', '--wait', default=1, type=int, metavar='',
-                    help='Time to wait between checks to see if a query is still running (default=1).')
+parser.add_argument('-w', '--wait', default=1, type=float, metavar='',
+                    help='Initial time to wait between checks to see if a query is still running (default=1).')
+parser.add_argument('-m', '--mode', default='cycles', choices=['cycles', 'load'],
+                    help='cycles: run the queries one at a time, querycycles times; load: drive random queries at '
+                         'each concurrency or arrival rate and report the throughput (default=cycles).')
+parser.add_argument('-q', '--queries', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'test-queries.json'), metavar='',
+                    help='JSON file of the query templates (default: test-queries.json next to this script).')
+parser.add_argument('-t', '--athenatable', default='gphoton', metavar='',
+                    help='Name of the Athena table queried (default=gphoton).')
+parser.add_argument('-c', '--cone', nargs=3, type=float, default=[323.067607, 0.254556, 0.008333333], metavar='',
+                    help='RA, DEC and radius of the cone in degrees (default: 323.067607 0.254556 0.008333333).')
+parser.add_argument('-s', '--spread', default=1.0, type=float, metavar='',
+                    help='Maximum offset in degrees of the random cones of the load mode from the cone (default=1).')
+parser.add_argument('-r', '--timerange', nargs=2, type=int, default=[740229107995, 1012464073985], metavar='',
+                    help='Start and end of the time range (default: 740229107995 1012464073985).')
+parser.add_argument('-f', '--flag', default=0, type=int, metavar='',
+                    help='Flag of the rows (default=0).')
+parser.add_argument('-j', '--concurrency', default='1,2,4,8,16,32', metavar='',
+                    help='Comma separated numbers of queries kept running at once by the load mode (default=1,2,4,8,16,32).')
+parser.add_argument('-a', '--rates', default=None, metavar='',
+                    help='Comma separated arrival rates in queries per second, with random (Poisson) arrivals, to '
+                         'drive the load mode with instead of concurrencies (default: use concurrencies).')
+parser.add_argument('-k', '--numqueries', default=40, type=int, metavar='',
+                    help='Number of queries run at each concurrency or arrival rate (default=40).')
+parser.add_argument('-g', '--seed', default=0, type=int, metavar='',
+                    help='Seed of the random templates, cones and arrivals (default=0).')
+parser.add_argument('-x', '--stub', action='store_true',
+                    help='Run against the Athena stub instead of AWS, without logging to DynamoDB.')
+parser.add_argument('-u', '--maxrunning', default=20, type=int, metavar='',
+                    help='Number of queries the Athena stub runs at once (default=20).')
+parser.add_argument('-e', '--runtime', nargs=2, type=float, default=[1.0, 3.0], metavar='',
+                    help='Minimum and maximum seconds a query runs in the Athena stub (default: 1 3).')
+parser.add_argument('-o', '--output', default=None, metavar='',
+                    help='Path of the JSON file to write the records of the load mode to (default: not written).')
 args = parser.parse_args()
 
-if __name__ == '__main__':
-    sess = boto3.Session(profile_name=args.profile,
-                         region_name=args.region)
-    athena_client = sess.client('athena')
-    dynamodb_client = sess.client('dynamodb')
-    
-    queries = {
-        "1":
-        '''
-        SELECT *
-        from gphoton
-        WHERE zoneID BETWEEN 10829 AND 10831
-        LIMIT 1000000;
-        ''',
-        "2":
-        '''
-        SELECT *
-        FROM gphoton
-        WHERE zoneID BETWEEN 10829 AND 10831
-        AND dec BETWEEN 0.24622267 AND 0.26288933000000003
-        AND ra BETWEEN 323.05927358775426 AND 323.07594041224576
-        AND (0.7993371853621515*cx + -0.6008663124164834*cy + 0.0044428257146426255*cz) > 0.9999999894230147
-        AND time >= 740229107995 AND time < 1012464073985
-        AND flag = 0;
-        ''',
-        "3":
-        '''
-        SELECT COUNT(*) AS item_count
-        FROM gphoton
-        WHERE zoneID BETWEEN 10829 AND 10831
-        AND dec BETWEEN 0.24622267 AND 0.26288933000000003
-        AND ra BETWEEN 323.05927358775426 AND 323.07594041224576
-        AND (0.7993371853621515*cx + -0.6008663124164834*cy + 0.0044428257146426255*cz) > 0.9999999894230147
-        AND time >= 740229107995 AND time < 1012464073985
-        AND flag = 0;
-        '''
+ATHENA_COST_PER_BYTE = 5/1e+12 # $5/TB scanned
+
+
+def get_workload(templates, cones, num_queries, rng):
+    '''
+    Queries of templates and cones drawn at random.
+
+    Returns
+    -------
+    list
+        (template name, query)
+    '''
+    names = list(templates)
+    workload = []
+    for _ in range(num_queries):
+        name = rng.choice(names)
+        workload.append((name, fill_template(templates[name], args.athenatable, *rng.choice(cones),
+                                             args.timerange[0], args.timerange[1], args.flag)))
+    return workload
+
+
+async def run_level(orchestrator, workload, concurrency=None, rate=None, rng=None, on_start=None):
+    '''
+    Run a workload with concurrency queries running at once (a closed loop: a query is submitted as
+    soon as one ends), or with queries arriving at random at rate queries per second (an open loop).
+
+    Returns
+    -------
+    list
+        a record of each query: template, execution_id, state, submit (seconds since the start of the
+        level), accepted (when Athena returned its execution id), end (when Athena completed it, from its
+        total execution time, which is not rounded up to the next poll), seen (when the poller saw its end),
+        queue (seconds Athena queued it), engine (seconds it ran), bytes_scanned and cost (in dollars)
+    '''
+    start = time.monotonic()
+    records = []
+
+    async def run_query(name, query):
+        record = {'template': name, 'submit': time.monotonic() - start}
+
+        def accepted(execution_id):
+            record['accepted'] = time.monotonic() - start
+            if on_start is not None:
+                asyncio.get_running_loop().run_in_executor(None, on_start, name, execution_id)
+
+        future = await orchestrator.submit(query, on_start=accepted)
+        result = await future
+        seen = time.monotonic() - start
+        statistics = result['statistics']
+        bytes_scanned = statistics.get('DataScannedInBytes')
+        record.update({
+            'execution_id': result['execution_id'],
+            'state': result['state'],
+            'end': (record['accepted'] + statistics['TotalExecutionTimeInMillis']/1000
+                    if 'TotalExecutionTimeInMillis' in statistics else seen),
+            'seen': seen,
+            'queue': statistics['QueryQueueTimeInMillis']/1000 if 'QueryQueueTimeInMillis' in statistics else None,
+            'engine': (statistics['EngineExecutionTimeInMillis']/1000
+                       if 'EngineExecutionTimeInMillis' in statistics else None),
+            'bytes_scanned': bytes_scanned,
+            'cost': max(bytes_scanned, min_billed_bytes)*ATHENA_COST_PER_BYTE if bytes_scanned is not None else None
+        })
+        records.append(record)
+
+    if rate is None:
+        queries = iter(workload)
+
+        async def worker():
+            for name, query in queries:
+                await run_query(name, query)
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    else:
+        tasks = []
+        for name, query in workload:
+            tasks.append(asyncio.ensure_future(run_query(name, query)))
+            await asyncio.sleep(rng.expovariate(rate))
+        await asyncio.gather(*tasks)
+    return sorted(records, key=lambda record: record['submit'])
+
+
+def summarize_level(records):
+    '''
+    Throughput, latency, queueing delay and cost of the records of a level.
+    '''
+    succeeded = [record for record in records if record['state'] == 'SUCCEEDED']
+    duration = max(record['end'] for record in records) - min(record['submit'] for record in records)
+    latencies = [record['end'] - record['submit'] for record in succeeded]
+    # the delay before Athena runs a query: retries of throttled submissions, then its own queue
+    delays = [record['accepted'] - record['submit'] + (record['queue'] or 0) for record in succeeded]
+    costs = [record['cost'] for record in records if record['cost'] is not None]
+    return {
+        'queries': len(records),
+        'succeeded': len(succeeded),
+        'seconds': duration,
+        'queries_per_minute': 60*len(succeeded)/duration if duration else 0.0,
+        'latency_p50': float(np.percentile(latencies, 50)) if latencies else None,
+        'latency_p95': float(np.percentile(latencies, 95)) if latencies else None,
+        'queue_mean': float(np.mean(delays)) if delays else None,
+        'queue_p95': float(np.percentile(delays, 95)) if delays else None,
+        'bytes_scanned': sum(record['bytes_scanned'] or 0 for record in records),
+        'cost': sum(costs)
     }
-    
-    
-    for i in range(args.querycycles):
-        msg = 'Query cycle {} of {}\n'.format(i+1, args.querycycles)
-        print(msg + '-'*(len(msg)-1))
-        for query in queries:
-            response = athena_client.start_query_execution(
-                    QueryString=queries[query],
-                    QueryExecutionContext={
-                        'Database': args.database
-                    },
-                    ResultConfiguration={
-                        'OutputLocation': args.output_location
-                    },
-                    WorkGroup=args.workgroup
-            )
-            start_time = datetime.now(timezone.utc).isoformat(timespec='microseconds')
-            item = {
-                'EXECUTION_ID':
-                    {"S": response['QueryExecutionId']},
-                'QUERY_ID':
-                    {"S": str(query)},
-                'EXECUTION_START_TIME':
-                    {"S": start_time}
-            }
+
+
+def format_seconds(value):
+    return '{:>10.2f}'.format(value) if value is not None else '{:>10}'.format('-')
+
+
+if __name__ == '__main__':
+    if args.stub:
+        from athena_stub import AthenaStub
+        athena_client = AthenaStub(run_time=args.runtime, max_running=args.maxrunning, seed=args.seed)
+        dynamodb_client = None
+    else:
+        sess = boto3.Session(profile_name=args.profile,
+                             region_name=args.region)
+        athena_client = sess.client('athena')
+        dynamodb_client = sess.client('dynamodb')
+
+    templates = load_templates(args.queries)
+    queries = {name: fill_template(template, args.athenatable, *args.cone, args.timerange[0], args.timerange[1],
+                                   args.flag)
+               for name, template in templates.items()}
+
+
+    def log_start(query, execution_id):
+        start_time = datetime.now(timezone.utc).isoformat(timespec='microseconds')
+        item = {
+            'EXECUTION_ID':
+                {"S": execution_id},
+            'QUERY_ID':
+                {"S": str(query)},
+            'EXECUTION_START_TIME':
+                {"S": start_time}
+        }
+        if dynamodb_client is not None:
             dynamodb_client.put_item(TableName=args.table, Item=item)
-            print('Query Execution ID: {}'.format(response['QueryExecutionId']))
-            rsp = athena_client.get_query_execution(QueryExecutionId=response['QueryExecutionId'])
-            succeeded_query = True if rsp['QueryExecution']['Status']['State'] == 'SUCCEEDED' else False
-            num_sec_query_has_been_running = 0
-            # check to see if the query has succeeded
-            while not succeeded_query:
-                if num_sec_query_has_been_running >= args.querylife:
-                    print('QUERY CANCELLED: Query {} has been running for ~{} seconds.'.format(response['QueryExecutionId'],
-                                                                                                num_sec_query_has_been_running))
-                    _ = athena_client.stop_query_execution(QueryExecutionId=response['QueryExecutionId'])
-                    break
-                if num_sec_query_has_been_running % 60 == 0 and num_sec_query_has_been_running:
-                    duration = int(num_sec_query_has_been_running/60)
-                    word = 'minutes' if duration > 1 else 'minute'
-                    print('...Query has been running for ~{} {}.'.format(duration, word))
-                # wait until query has succeeded to start the next query
-                if num_sec_query_has_been_running + args.wait > args.querylife:
-                    sleep_time = args.querylife - num_sec_query_has_been_running
-                else:
-                    sleep_time = args.wait
-                time.sleep(sleep_time)
-                num_sec_query_has_been_running += sleep_time
-                rsp = athena_client.get_query_execution(QueryExecutionId=response['QueryExecutionId'])
-                succeeded_query = True if rsp['QueryExecution']['Status']['State'] == 'SUCCEEDED' else False
-        print('='*60)
+        if args.mode == 'cycles':
+            print('Query Execution ID: {}'.format(execution_id))
+
+    async def run_cycles():
+        orchestrator = QueryOrchestrator(athena_client, args.database, args.output_location, args.workgroup,
+                                         query_life=args.querylife, min_wait=args.wait, verbose=False)
+        for i in range(args.querycycles):
+            msg = 'Query cycle {} of {}\n'.format(i+1, args.querycycles)
+            print(msg + '-'*(len(msg)-1))
+            for query in queries:
+                # wait until the query has ended to start the next query
+                future = await orchestrator.submit(queries[query], on_start=functools.partial(log_start, query))
+                result = await future
+                if result['state'] != 'SUCCEEDED':
+                    print('QUERY {}: Query {} after ~{:.1f} seconds.'.format(result['state'], result['execution_id'],
+                                                                              result['elapsed']))
+            print('='*60)
+
+    async def run_load():
+        rng = random.Random(args.seed)
+        cones = get_cones(*args.cone, max(args.numqueries, 1), args.spread, seed=args.seed)
+        if args.rates is not None:
+            levels = [('rate', float(rate)) for rate in args.rates.split(',')]
+        else:
+            levels = [('concurrency', int(concurrency)) for concurrency in args.concurrency.split(',')]
+        print('{:<14}{:>8}{:>10}{:>12}{:>10}{:>10}{:>10}{:>10}{:>10}{:>12}'.format(
+            'level', 'queries', 'succeeded', 'queries/min', 'p50 s', 'p95 s', 'queue s', 'queue p95', 'GB', 'cost $'))
+        results = []
+        for kind, level in levels:
+            orchestrator = QueryOrchestrator(athena_client, args.database, args.output_location, args.workgroup,
+                                             query_life=args.querylife, min_wait=args.wait,
+                                             max_in_flight=max(args.numqueries, 1), verbose=False)
+            workload = get_workload(templates, cones, args.numqueries, rng)
+            records = await run_level(orchestrator, workload, rng=rng, on_start=log_start,
+                                      **{kind: level})
+            summary = summarize_level(records)
+            summary.update({kind: level, 'throttled': orchestrator.num_throttled})
+            results.append({'summary': summary, 'records': records})
+            print('{:<14}{:>8}{:>10}{:>12.1f}{}{}{}{}{:>10.3f}{:>12.4f}'.format(
+                '{} {:g}'.format(kind, level), summary['queries'], summary['succeeded'],
+                summary['queries_per_minute'], format_seconds(summary['latency_p50']),
+                format_seconds(summary['latency_p95']), format_seconds(summary['queue_mean']),
+                format_seconds(summary['queue_p95']), summary['bytes_scanned']/1e9, summary['cost']))
+        if args.output is not None:
+            with open(args.output, 'w') as output:
+                json.dump({'workgroup': args.workgroup, 'stub': args.stub, 'templates': list(templates),
+                           'cone': args.cone, 'spread': args.spread, 'levels': results}, output, indent=2)
+
+    asyncio.run(run_cycles() if args.mode == 'cycles' else run_load())
@@ -0,0 +1,440 @@
+import io
+import os
+import re
+import sys
+import csv
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import argparse
+import platform
+import functools
+import subprocess
+import contextlib
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from gphoton_schema import header, schema
+from athena_stub import AthenaStub
+from athena_orchestrator import QueryOrchestrator
+from s3_stub import S3Stub
+from cone_search import get_search_plan, format_double, write_result, output_formats, fetch_csv, parse_csv
+from cone_search_local import get_router, get_partition_files, prune
+
+parser = argparse.ArgumentParser(description='Replay the query templates of test-queries.json against a local PARQUET '
+                                             'engine or a stubbed Athena and S3, reporting latency percentiles and '
+                                             'the time of each stage as JSON.')
+parser.add_argument('path', help='Path to folder containing the zoneID partitions.')
+parser.add_argument('-b', '--backend', default='local', choices=['local', 'stub'],
+                    help='Engine running the queries (default=local).')
+parser.add_argument('-q', '--queries', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'test-queries.json'), metavar='',
+                    help='JSON file of the query templates (default: test-queries.json next to this script).')
+parser.add_argument('-t', '--templates', default=None, metavar='',
+                    help='Comma separated names of the templates to run (default: all).')
+parser.add_argument('-c', '--cone', nargs=3, type=float, default=[323.067607, 0.254556, 0.008333333], metavar='',
+                    help='RA, DEC and radius of the cone in degrees (default: 323.067607 0.254556 0.008333333).')
+parser.add_argument('-n', '--numcones', default=1, type=int, metavar='',
+                    help='Number of cones, drawn around the cone within --spread degrees (default=1).')
+parser.add_argument('-s', '--spread', default=0.0, type=float, metavar='',
+                    help='Maximum offset in degrees of the drawn cones from the cone (default=0).')
+parser.add_argument('-r', '--timerange', nargs=2, type=int, default=[740229107995, 1012464073985], metavar='',
+                    help='Start and end of the time range (default: 740229107995 1012464073985).')
+parser.add_argument('-f', '--flag', default=0, type=int, metavar='',
+                    help='Flag of the rows (default=0).')
+parser.add_argument('-u', '--warmup', default=1, type=int, metavar='',
+                    help='Number of untimed runs of every query first (default=1).')
+parser.add_argument('-i', '--numiterations', default=20, type=int, metavar='',
+                    help='Number of timed runs of every query (default=20).')
+parser.add_argument('-w', '--outputformat', default='csv', choices=list(output_formats), metavar='',
+                    help='Format the rows are written as: {} (default=csv).'.format(', '.join(output_formats)))
+parser.add_argument('-e', '--runtime', nargs=2, type=float, default=[0.05, 0.2], metavar='',
+                    help='Minimum and maximum seconds a query runs in the Athena stub (default: 0.05 0.2).')
+parser.add_argument('-l', '--latency', default=0.02, type=float, metavar='',
+                    help='Seconds of latency of each request to the S3 stub (default=0.02).')
+parser.add_argument('-m', '--bandwidth', default=50.0, type=float, metavar='',
+                    help='MB per second of one GET from the S3 stub (default=50).')
+parser.add_argument('-o', '--output', default=None, metavar='',
+                    help='Path of the JSON file to write the results to (default: standard output).')
+parser.add_argument('-k', '--baseline', default=None, metavar='',
+                    help='JSON results of an earlier run to compare with; exits with 1 on a regression.')
+parser.add_argument('-x', '--tolerance', default=0.2, type=float, metavar='',
+                    help='Fraction by which a p50 or p95 may exceed the baseline before it is a regression '
+                         '(default=0.2).')
+
+table_name = 'gPhoton_partitioned'
+percentiles = [50, 95, 99]
+number = r'(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)'
+query_pattern = re.compile(r'^\s*SELECT\s+(.*?)\s+FROM\s+(\w+)\s+WHERE\s+(.*?)(?:\s+LIMIT\s+(\d+))?\s*;?\s*$',
+                           re.IGNORECASE | re.DOTALL)
+condition_patterns = [
+    ('between', re.compile(r'(\w+)\s+BETWEEN\s+{0}\s+AND\s+{0}'.format(number), re.IGNORECASE)),
+    ('dot', re.compile(r'\(\s*{0}\s*\*\s*cx\s*\+\s*{0}\s*\*\s*cy\s*\+\s*{0}\s*\*\s*cz\s*\)\s*>\s*{0}'.format(number),
+                       re.IGNORECASE)),
+    ('compare', re.compile(r'(\w+)\s*(>=|<=|<>|=|<|>)\s*{}'.format(number)))
+]
+count_pattern = re.compile(r'^COUNT\(\*\)(?:\s+AS\s+(\w+))?$', re.IGNORECASE)
+# column names of SQL are case insensitive
+canonical_names = {name.lower(): name for name in header}
+
+
+def load_templates(path):
+    '''
+    Query templates of a JSON file mapping names to the lines of a query.
+    '''
+    with open(path) as templates:
+        return {name: '\n'.join(lines) for name, lines in json.load(templates).items()}
+
+
+def get_cones(ra, dec, radius, num_cones, spread, seed=0):
+    '''
+    The cone, then num_cones - 1 cones of the same radius drawn within spread degrees of it.
+    '''
+    rng = np.random.default_rng(seed)
+    cones = [(ra, dec, radius)]
+    for _ in range(num_cones - 1):
+        cones.append(((ra + rng.uniform(-spread, spread)) % 360,
+                      float(np.clip(dec + rng.uniform(-spread, spread), -90, 90)), radius))
+    return cones
+
+
+def fill_template(template, table, ra, dec, radius, time_start, time_end, flag):
+    '''
+    Query of a template for a cone. The placeholders are filled in order with the table, the zones,
+    the dec and RA box, the center and cos(radius) of the cone, the time range and the flag, as far as
+    the template has placeholders.
+    '''
+    plan = get_search_plan(ra, dec, radius)
+    ra_min, ra_max = plan['ra_ranges'][0]
+    values = [table, plan['min_zoneid'], plan['max_zoneid']]
+    values += [format_double(value) for value in [plan['dec_range'][0], plan['dec_range'][1], ra_min, ra_max,
+                                                  plan['cx'], plan['cy'], plan['cz'], plan['cos_radius']]]
+    values += [time_start, time_end, flag]
+    return template.format(*values[:template.count('{}')])
+
+
+def parse_number(text):
+    return float(text) if re.search(r'[.eE]', text) else int(text)
+
+
+def parse_query(query):
+    '''
+    The SELECT, a dataset expression of the WHERE clause and the LIMIT of one of the queries of the
+    templates: a conjunction of BETWEEN, comparisons with numbers and the dot-product test of a cone.
+
+    Returns
+    -------
+    dict
+        count: name of the column of a COUNT(*) query, or None for SELECT *
+        expression: pyarrow.dataset.Expression of the WHERE clause
+        ranges: column name: (min, max) of the BETWEEN conditions, to select partitions
+        limit: maximum number of rows, or None
+    '''
+    match = query_pattern.match(query)
+    if match is None:
+        raise ValueError('Unsupported query: {}'.format(query))
+    select, _, where, limit = match.groups()
+    count = None
+    if select.strip() != '*':
+        count_match = count_pattern.match(select.strip())
+        if count_match is None:
+            raise ValueError('Unsupported SELECT: {}'.format(select))
+        count = count_match.group(1) or '_col0'
+    expressions = []
+    ranges = {}
+    remainder = where
+    for kind, pattern in condition_patterns:
+        for condition in list(pattern.finditer(remainder)):
+            values = condition.groups()
+            if kind == 'between':
+                name = canonical_names.get(values[0].lower(), values[0])
+                low, high = parse_number(values[1]), parse_number(values[2])
+                expressions.append((ds.field(name) >= low) & (ds.field(name) <= high))
+                ranges[name] = (low, high)
+            elif kind == 'dot':
+                cx, cy, cz, cos_radius = [parse_number(value) for value in values]
+                expressions.append(ds.field('cx')*cx + ds.field('cy')*cy + ds.field('cz')*cz > cos_radius)
+            else:
+                field, value = ds.field(canonical_names.get(values[0].lower(), values[0])), parse_number(values[2])
+                expressions.append({'>=': field >= value, '<=': field <= value, '<>': field != value,
+                                    '=': field == value, '<': field < value, '>': field > value}[values[1]])
+            remainder = remainder.replace(condition.group(0), '', 1)
+    if re.sub(r'\bAND\b', '', remainder, flags=re.IGNORECASE).strip():
+        raise ValueError('Unsupported conditions: {}'.format(remainder))
+    return {'count': count, 'expression': functools.reduce(lambda a, b: a & b, expressions),
+            'ranges': ranges, 'limit': int(limit) if limit is not None else None}
+
+
+class LocalBackend:
+    '''
+    Run the queries of the templates over the partitioned PARQUET files in path, like Athena would:
+    the partitions are selected by the zoneID and ra ranges, row groups are pruned by their statistics,
+    and the rows are filtered by the WHERE clause as a dataset expression.
+    '''
+    stages = ['plan', 'execute', 'write']
+
+    def __init__(self, path, output_format='csv'):
+        self.path = path
+        self.output_format = output_format
+        self.output_location = tempfile.mkdtemp()
+
+    def plan(self, query):
+        '''
+        The parsed query and the files of the partitions it reads.
+        '''
+        parsed = parse_query(query)
+        router = get_router(self.path)
+        zones = parsed['ranges'].get('zoneID', (0, 2**31))
+        ras = parsed['ranges'].get('ra', (0, 360))
+        files = get_partition_files(router, router.get_partitions(zones[0], zones[1], ras[0], ras[1]))
+        return parsed, files
+
+    def scan(self, parsed, files):
+        '''
+        Table of the result of a parsed query.
+        '''
+        if files:
+            pruned, _, _ = prune(files, parsed['expression'])
+            tbl = pruned.to_table(filter=parsed['expression'])
+        else:
+            tbl = schema.empty_table()
+        if parsed['limit'] is not None:
+            tbl = tbl.slice(0, parsed['limit'])
+        if parsed['count'] is not None:
+            tbl = pa.table({parsed['count']: pa.array([tbl.num_rows], pa.int64())})
+        return tbl
+
+    def write(self, tbl):
+        # the rows are written and removed, only the time taken matters
+        with contextlib.redirect_stdout(io.StringIO()):
+            output_location = write_result(tbl, self.output_location, self.output_format)
+        os.remove(output_location)
+
+    def run(self, template, cone, filters, timings):
+        '''
+        Run the query of a template for a cone (ra, dec, radius) and filters (time_start, time_end,
+        flag), setting the seconds of each stage in timings.
+
+        Returns
+        -------
+        int
+            number of rows of the result
+        '''
+        start = time.perf_counter()
+        query = fill_template(template, table_name, *cone, *filters)
+        parsed, files = self.plan(query)
+        timings['plan'] = time.perf_counter() - start
+        start = time.perf_counter()
+        tbl = self.scan(parsed, files)
+        timings['execute'] = time.perf_counter() - start
+        start = time.perf_counter()
+        self.write(tbl)
+        timings['write'] = time.perf_counter() - start
+        return tbl.num_rows
+
+    def close(self):
+        shutil.rmtree(self.output_location, ignore_errors=True)
+
+
+class StubBackend(LocalBackend):
+    '''
+    Run the queries with a QueryOrchestrator against an AthenaStub, reading the CSV results from an
+    S3Stub with fetch_csv and parse_csv, the stages of cone_search.read_csv_table, so that the submit,
+    poll, fetch and parse code of cone_search is timed without AWS.
+
+    The result of every query is computed once by LocalBackend and written as Athena writes it; when
+    the query starts it is linked as the result of the execution.
+    '''
+    stages = ['plan', 'submit', 'execute', 'fetch', 'parse', 'write']
+
+    def __init__(self, path, output_format='csv', run_time=(0.05, 0.2), latency=0.02, bandwidth=None):
+        super().__init__(path, output_format)
+        self.bucket_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.bucket_path, 'results'))
+        os.makedirs(os.path.join(self.bucket_path, 'athena'))
+        self.athena_client = AthenaStub(run_time=run_time)
+        self.s3_client = S3Stub(self.bucket_path, latency=latency, bandwidth=bandwidth)
+        self.results = {}
+
+    def get_result(self, query):
+        '''
+        Key of the Athena CSV of the rows of a query, written on first use.
+        '''
+        key = os.path.join('results', hashlib.sha1(query.encode()).hexdigest() + '.csv')
+        if key not in self.results:
+            tbl = self.scan(*self.plan(query))
+            tbl = tbl.rename_columns([name.lower() for name in tbl.column_names])
+            tbl.to_pandas().to_csv(os.path.join(self.bucket_path, key), index=False, quoting=csv.QUOTE_ALL)
+            self.results[key] = tbl.num_rows
+        return key
+
+    def link(self, key, execution_id):
+        os.link(os.path.join(self.bucket_path, key), os.path.join(self.bucket_path, 'athena', execution_id + '.csv'))
+
+    async def submit(self, query, key, timings):
+        orchestrator = QueryOrchestrator(self.athena_client, 'benchmark', 's3://benchmark/athena/', 'primary',
+                                         verbose=False)
+        start = time.perf_counter()
+        future = await orchestrator.submit(query, on_start=functools.partial(self.link, key))
+        timings['submit'] = time.perf_counter() - start
+        start = time.perf_counter()
+        execution = await future
+        timings['execute'] = time.perf_counter() - start
+        return execution
+
+    def run(self, template, cone, filters, timings):
+        start = time.perf_counter()
+        query = fill_template(template, table_name, *cone, *filters)
+        timings['plan'] = time.perf_counter() - start
+        execution = asyncio.run(self.submit(query, self.get_result(query), timings))
+        if execution['state'] != 'SUCCEEDED':
+            raise RuntimeError('Query {}: {}'.format(execution['state'], execution['reason']))
+        key = execution['output_location'].replace('s3://benchmark/', '')
+        download_path = os.path.join(self.output_location, os.path.basename(key))
+        start = time.perf_counter()
+        fetch_csv(self.s3_client, 'benchmark', key, download_path)
+        timings['fetch'] = time.perf_counter() - start
+        start = time.perf_counter()
+        tbl = parse_csv(download_path)
+        timings['parse'] = time.perf_counter() - start
+        os.remove(download_path)
+        os.remove(os.path.join(self.bucket_path, key))
+        start = time.perf_counter()
+        self.write(tbl)
+        timings['write'] = time.perf_counter() - start
+        return tbl.num_rows
+
+    def close(self):
+        super().close()
+        shutil.rmtree(self.bucket_path, ignore_errors=True)
+
+
+def summarize(values):
+    '''
+    Percentiles, mean, minimum and maximum of seconds.
+    '''
+    values = np.asarray(values, dtype=float)
+    summary = {'p{}'.format(q): float(np.percentile(values, q)) for q in percentiles}
+    summary.update({'mean': float(values.mean()), 'min': float(values.min()), 'max': float(values.max())})
+    return summary
+
+
+def run_benchmark(backend, templates, cones, filters, num_warmup, num_iterations):
+    '''
+    Run every query num_warmup times untimed, then num_iterations times timed, round robin so that
+    every query sees the same state of the caches.
+
+    Returns
+    -------
+    dict
+        for each template: number of queries, rows returned, latency summary, and summary of each stage
+    '''
+    results = {}
+    for name, template in templates.items():
+        for _ in range(num_warmup):
+            for cone in cones:
+                backend.run(template, cone, filters, {})
+        latencies = []
+        stage_timings = {stage: [] for stage in backend.stages}
+        num_rows = 0
+        for _ in range(num_iterations):
+            for cone in cones:
+                timings = {}
+                start = time.perf_counter()
+                num_rows = backend.run(template, cone, filters, timings)
+                latencies.append(time.perf_counter() - start)
+                for stage in backend.stages:
+                    stage_timings[stage].append(timings[stage])
+        results[name] = {
+            'queries': len(latencies),
+            'rows': num_rows,
+            'latency': summarize(latencies),
+            'stages': {stage: summarize(values) for stage, values in stage_timings.items()}
+        }
+        print('{:<10}{:>8}{:>12,}{}'.format(name, len(latencies), num_rows, ''.join(
+            '{:>10.4f}'.format(results[name]['latency']['p{}'.format(q)]) for q in percentiles)), file=sys.stderr)
+    return results
+
+
+def get_commit():
+    '''
+    Commit of the checked out code, or None outside of git.
+    '''
+    try:
+        output = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return output.stdout.strip() or None
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Print the ratio of the p50 and p95 latencies of each template to those of the baseline.
+
+    Returns
+    -------
+    list
+        (template, percentile) pairs more than tolerance slower than the baseline
+    '''
+    regressions = []
+    print('\n{:<10}{:>12}{:>12}{:>10}'.format('template', 'percentile', 'baseline', 'ratio'), file=sys.stderr)
+    for name, result in results['templates'].items():
+        if name not in baseline['templates']:
+            continue
+        for percentile in ['p50', 'p95']:
+            before = baseline['templates'][name]['latency'][percentile]
+            ratio = result['latency'][percentile]/before if before else float('inf')
+            regressed = ratio > 1 + tolerance
+            if regressed:
+                regressions.append((name, percentile))
+            print('{:<10}{:>12}{:>12.4f}{:>10.2f}{}'.format(name, percentile, before, ratio,
+                                                          '  REGRESSION' if regressed else ''), file=sys.stderr)
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    templates = load_templates(args.queries)
+    if args.templates is not None:
+        templates = {name: templates[name] for name in args.templates.split(',')}
+    cones = get_cones(*args.cone, args.numcones, args.spread)
+    filters = [args.timerange[0], args.timerange[1], args.flag]
+    if args.backend == 'stub':
+        backend = StubBackend(args.path, args.outputformat, run_time=args.runtime, latency=args.latency,
+                              bandwidth=args.bandwidth*1024*1024)
+    else:
+        backend = LocalBackend(args.path, args.outputformat)
+    print('{:<10}{:>8}{:>12}{}'.format('template', 'queries', 'rows', ''.join(
+        '{:>10}'.format('p{}'.format(q)) for q in percentiles)), file=sys.stderr)
+    try:
+        results = {
+            'backend': args.backend,
+            'commit': get_commit(),
+            'python': platform.python_version(),
+            'pyarrow': pa.__version__,
+            'path': args.path,
+            'cones': cones,
+            'time_range': args.timerange,
+            'flag': args.flag,
+            'warmup': args.warmup,
+            'iterations': args.numiterations,
+            'output_format': args.outputformat,
+            'templates': run_benchmark(backend, templates, cones, filters, args.warmup, args.numiterations)
+        }
+    finally:
+        backend.close()
+    if args.backend == 'stub':
+        results.update({'run_time': args.runtime, 'latency': args.latency, 'bandwidth': args.bandwidth})
+    if args.output is None:
+        print(json.dumps(results, indent=2))
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as baseline:
+            if compare(results, json.load(baseline), args.tolerance):
+                sys.exit(1)
@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pyarrow.parquet as pq
+from partition_layout import PartitionRouter, zone_pattern, ra_pattern
+from cone_search import get_search_plan, get_zone_groups
+
+# Athena bills at least 10 MB per query
+min_billed_bytes = 10*1024*1024
+# bytes read from a file whose RA statistics rule it out (footer and row group statistics)
+footer_bytes = 64*1024
+# seconds = intercept + sum(coefficient*feature); a guess until calibrate() fits them to observed times
+default_coefficients = {
+    'intercept': 1.5,   # start, run and poll one query
+    'queries': 0.05,    # each further query started and polled (round-trips)
+    'selects': 0.15,    # planning each SELECT of a UNION ALL
+    'max_gb': 4.0,      # scanning the largest query, the queries running concurrently
+    'total_gb': 0.5     # contention of all the queries for the workgroup
+}
+features = ['queries', 'selects', 'max_gb', 'total_gb']
+
+
+def get_partition_statistics(path):
+    '''
+    Size of the partitions of a local zoneID/ra tree.
+
+    Returns
+    -------
+    list
+        [zoneID, RA min, RA max, bytes, rows, files] of each partition
+    '''
+    router = PartitionRouter.from_path(path)
+    partitions = []
+    for (zone_id, lower, upper), partition_path in zip(router.partitions, router.paths):
+        size = rows = files = 0
+        if os.path.isdir(partition_path):
+            for file in os.listdir(partition_path):
+                if file.startswith('.') or not os.path.isfile(os.path.join(partition_path, file)):
+                    continue
+                size += os.path.getsize(os.path.join(partition_path, file))
+                rows += pq.ParquetFile(os.path.join(partition_path, file)).metadata.num_rows
+                files += 1
+        partitions.append([zone_id, float(lower), float(upper), size, rows, files])
+    return partitions
+
+
+def get_s3_partition_statistics(s3_client, bucket, prefix):
+    '''
+    Size of the partitions of a zoneID/ra tree in S3, from the object listing; the rows are not
+    known without reading the footers and are given as 0.
+    '''
+    sizes = {}
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            folders = item['Key'][len(prefix):].strip('/').split('/')
+            if len(folders) < 3:
+                continue
+            zone_match = zone_pattern.match(folders[-3])
+            ra_match = ra_pattern.match(folders[-2])
+            if zone_match is None or ra_match is None:
+                continue
+            key = (int(zone_match.group(1)), float(ra_match.group(1)), float(ra_match.group(3)))
+            size, files = sizes.get(key, (0, 0))
+            sizes[key] = (size + item['Size'], files + 1)
+    return [[*key, size, 0, files] for key, (size, files) in sorted(sizes.items())]
+
+
+def save_statistics(path, statistics):
+    with open(path + '.tmp', 'w') as statistics_file:
+        json.dump(statistics, statistics_file, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_statistics(path):
+    with open(path) as statistics_file:
+        return json.load(statistics_file)
+
+
+def get_features(queries):
+    '''
+    Features of the cost model of a strategy, from the (zone ranges, RA ranges) scanned by each of its
+    queries and the bytes each query scans.
+    '''
+    scanned = [query['bytes'] for query in queries]
+    return {
+        'queries': len(queries) - 1,
+        'selects': sum(len(query['selects']) for query in queries) - 1,
+        'max_gb': max(scanned)/1024**3,
+        'total_gb': sum(scanned)/1024**3
+    }
+
+
+def calibrate(log_path, coefficients=None):
+    '''
+    Fit the coefficients of the cost model to the times observed in a planner log, by least squares
+    with non-negative coefficients.
+
+    Returns
+    -------
+    dict
+        fitted coefficients; the coefficients given are kept for features that never varied in the log
+    '''
+    coefficients = dict(default_coefficients if coefficients is None else coefficients)
+    with open(log_path) as log:
+        records = [json.loads(line) for line in log if line.strip()]
+    records = [record for record in records if record['observed_seconds'] is not None]
+    if not records:
+        raise ValueError('No observed queries in {}'.format(log_path))
+    x = np.array([[record['features'][name] for name in features] for record in records], dtype=np.float64)
+    y = np.array([record['observed_seconds'] for record in records], dtype=np.float64)
+    # features without any variation cannot be told apart from the intercept: their coefficients are kept
+    active = [index for index in range(len(features)) if np.ptp(x[:, index]) > 0]
+    for index in range(len(features)):
+        if index not in active:
+            y = y - coefficients[features[index]]*x[:, index]
+    while True:
+        design = np.column_stack([np.ones(len(y))] + [x[:, index] for index in active])
+        solution = np.linalg.lstsq(design, y, rcond=None)[0]
+        negative = [index for index, value in zip(active, solution[1:]) if value < 0]
+        if not negative:
+            break
+        active = [index for index in active if index not in negative]
+    fitted = dict(coefficients)
+    fitted['intercept'] = max(float(solution[0]), 0.0)
+    for index in range(len(features)):
+        if index not in active and np.ptp(x[:, index]) > 0:
+            fitted[features[index]] = 0.0
+    for index, value in zip(active, solution[1:]):
+        fitted[features[index]] = float(value)
+    return fitted
+
+
+class QueryPlanner:
+    '''
+    Choose how cone_search splits a cone into Athena queries, by a cost model over the sizes of the
+    partitions.
+
+    Strategies:
+        single: one query over all the zones of the cone (zoneID BETWEEN)
+        per-zone: one query with a UNION ALL of a SELECT per zone
+        grouped: a query per group of width zones, run concurrently; width 1 is a query per zone
+    A cone whose RA range wraps past 360 has two SELECTs per query of any strategy, unless the queries
+    prune partitions.
+
+    The bytes a query scans are those of the partitions of its zones overlapping its RA ranges, plus
+    the footers of the other partitions of its zones unless the queries prune partitions. The predicted time is
+        intercept + sum(coefficient*feature)
+    over the features: queries (round-trips beyond the first), selects (beyond the first), max_gb
+    (GB scanned by the largest query) and total_gb (GB scanned by all queries). Each chosen plan can be
+    logged with the observed time and bytes, and calibrate() fits the coefficients to the log. The
+    hpx predicate of sky_index is not modelled.
+    '''
+    def __init__(self, statistics, coefficients=None, widths=(1, 2, 4, 8), objective='time', log_path=None,
+                 partition_pruning=False):
+        '''
+        Parameters
+        ----------
+        statistics: dict
+            {'partitions': [[zoneID, RA min, RA max, bytes, rows, files], ...], 'coefficients': {...}}
+        coefficients: dict
+            coefficients of the cost model (default: those of the statistics, else default_coefficients)
+        widths: tuple
+            widths of the zone groups tried by the grouped strategy
+        objective: str
+            'time' chooses the lowest predicted time, 'bytes' the lowest billed bytes
+        log_path: str
+            JSON lines file where the predicted and observed costs are appended (default: no log)
+        partition_pruning: bool
+            whether cone_search is given the layout, so that its queries filter on the partition keys:
+            only the partitions overlapping the cone are read, and a wrapping cone is one SELECT
+        '''
+        partitions = np.array(statistics['partitions'], dtype=np.float64).reshape(-1, 6)
+        self.zone_ids = partitions[:, 0].astype(np.int64)
+        self.ra_min = partitions[:, 1]
+        self.ra_max = partitions[:, 2]
+        self.bytes = partitions[:, 3]
+        self.files = partitions[:, 5]
+        self.coefficients = dict(default_coefficients)
+        self.coefficients.update(statistics.get('coefficients', {}) if coefficients is None else coefficients)
+        self.widths = widths
+        self.objective = objective
+        self.log_path = log_path
+        self.partition_pruning = partition_pruning
+
+    @classmethod
+    def from_path(cls, path, **options):
+        '''
+        Build the planner from statistics saved by save_statistics.
+        '''
+        return cls(load_statistics(path), **options)
+
+    def get_scanned_bytes(self, min_zoneid, max_zoneid, ra_ranges):
+        '''
+        Bytes scanned by one SELECT over the zones min_zoneid to max_zoneid and the RA ranges.
+        '''
+        in_zones = (self.zone_ids >= min_zoneid) & (self.zone_ids <= max_zoneid)
+        overlaps = np.zeros(len(in_zones), dtype=bool)
+        for ra_min, ra_max in ra_ranges:
+            overlaps |= in_zones & (self.ra_min <= ra_max) & (ra_min <= self.ra_max)
+        if self.partition_pruning:
+            return self.bytes[overlaps].sum()
+        return self.bytes[overlaps].sum() + footer_bytes*self.files[in_zones & ~overlaps].sum()
+
+    def predict(self, features):
+        return self.coefficients['intercept'] + sum(self.coefficients[name]*features[name] for name in features)
+
+    def estimate(self, plan):
+        '''
+        Cost of each strategy for a cone.
+
+        Parameters
+        ----------
+        plan: dict
+            the plan of the cone, from cone_search.get_search_plan
+
+        Returns
+        -------
+        list
+            a dict per strategy: strategy, width, queries (zone range, SELECTs and bytes of each query),
+            features, predicted_seconds and billed_bytes
+        '''
+        min_zoneid, max_zoneid = plan['min_zoneid'], plan['max_zoneid']
+        num_zones = max_zoneid - min_zoneid + 1
+        candidates = [('single', num_zones, [(min_zoneid, max_zoneid)])]
+        if num_zones > 1:
+            candidates.append(('per-zone', 1, [(min_zoneid, max_zoneid)]))
+            for width in self.widths:
+                if width < num_zones:
+                    candidates.append(('grouped', width, get_zone_groups(min_zoneid, max_zoneid, width)))
+        estimates = []
+        for strategy, width, zone_ranges in candidates:
+            queries = []
+            # a SELECT per RA range, or one over both ranges with partition pruning
+            ra_ranges = [plan['ra_ranges']] if self.partition_pruning else [[ra_range] for ra_range in plan['ra_ranges']]
+            for zone_min, zone_max in zone_ranges:
+                if strategy == 'per-zone':
+                    selects = [(zone_id, zone_id, select_ranges) for zone_id in range(zone_min, zone_max + 1)
+                               for select_ranges in ra_ranges]
+                else:
+                    selects = [(zone_min, zone_max, select_ranges) for select_ranges in ra_ranges]
+                queries.append({
+                    'zones': (zone_min, zone_max),
+                    'selects': selects,
+                    'bytes': sum(self.get_scanned_bytes(*select) for select in selects)
+                })
+            query_features = get_features(queries)
+            estimates.append({
+                'strategy': strategy,
+                'width': width,
+                'queries': queries,
+                'features': query_features,
+                'predicted_seconds': self.predict(query_features),
+                'billed_bytes': sum(max(query['bytes'], min_billed_bytes) for query in queries)
+            })
+        return estimates
+
+    def choose(self, plan):
+        '''
+        The estimate of the cheapest strategy for a cone, by the objective of the planner.
+        '''
+        estimates = self.estimate(plan)
+        if self.objective == 'bytes':
+            return min(estimates, key=lambda estimate: (estimate['billed_bytes'], estimate['predicted_seconds']))
+        return min(estimates, key=lambda estimate: (estimate['predicted_seconds'], estimate['billed_bytes']))
+
+    def record(self, estimate, observed_seconds, executions=()):
+        '''
+        Append the prediction of a strategy and what was observed running it to the log.
+
+        Parameters
+        ----------
+        estimate: dict
+            the estimate of the strategy run, from estimate or choose
+        observed_seconds: float
+            time taken by the queries, None if they did not all succeed
+        executions: list
+            the execution dicts of the queries, from athena_orchestrator
+        '''
+        if self.log_path is None:
+            return
+        scanned = [execution['statistics'].get('DataScannedInBytes') for execution in executions]
+        record = {
+            'time': time.time(),
+            'strategy': estimate['strategy'],
+            'width': estimate['width'],
+            'features': estimate['features'],
+            'predicted_seconds': estimate['predicted_seconds'],
+            'predicted_bytes': sum(query['bytes'] for query in estimate['queries']),
+            'observed_seconds': observed_seconds,
+            'observed_bytes': sum(scanned) if scanned and None not in scanned else None
+        }
+        with open(self.log_path, 'a') as log:
+            log.write(json.dumps(record) + '\n')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the cost of the ways to split a cone search into Athena '
+                                                 'queries.')
+    parser.add_argument('statistics', help='JSON file of partition statistics and cost model coefficients.')
+    parser.add_argument('-s', '--source', default=None, metavar='',
+                        help='Folder or s3://bucket/prefix of the zoneID partitions to (re)build the statistics from.')
+    parser.add_argument('-p', '--profile', default='default', metavar='',
+                        help='Name of the AWS profile to use for an S3 source (default="default").')
+    parser.add_argument('-k', '--calibrate', default=None, metavar='',
+                        help='Planner log to fit the coefficients to; they are saved with the statistics.')
+    parser.add_argument('-c', '--cone', nargs=3, type=float, default=None, metavar='',
+                        help='RA, DEC and radius of a cone to print the estimates of.')
+    parser.add_argument('-y', '--pruning', action='store_true',
+                        help='Estimate queries pruning partitions by the partition keys (cone_search with a layout).')
+    parser.add_argument('-o', '--objective', default='time', choices=['time', 'bytes'],
+                        help='Choose the lowest predicted time or billed bytes (default=time).')
+    args = parser.parse_args()
+
+    if args.source is not None:
+        start_time = time.time()
+        statistics = load_statistics(args.statistics) if os.path.exists(args.statistics) else {}
+        if args.source.startswith('s3://'):
+            import boto3
+            bucket, _, prefix = args.source[len('s3://'):].partition('/')
+            s3_client = boto3.Session(profile_name=args.profile).client('s3')
+            statistics['partitions'] = get_s3_partition_statistics(s3_client, bucket, prefix)
+        else:
+            statistics['partitions'] = get_partition_statistics(args.source)
+        save_statistics(args.statistics, statistics)
+        print('Statistics of {} partitions written to {} in ~{:.4f} seconds'.format(
+            len(statistics['partitions']), args.statistics, time.time()-start_time))
+    if args.calibrate is not None:
+        statistics = load_statistics(args.statistics)
+        before = QueryPlanner(statistics)
+        statistics['coefficients'] = calibrate(args.calibrate, before.coefficients)
+        save_statistics(args.statistics, statistics)
+        with open(args.calibrate) as log:
+            records = [json.loads(line) for line in log if line.strip()]
+        records = [record for record in records if record['observed_seconds'] is not None]
+        after = QueryPlanner(statistics)
+        for name, planner in [('before', before), ('after', after)]:
+            errors = [abs(planner.predict(record['features']) - record['observed_seconds']) for record in records]
+            print('Mean absolute error {} calibrating on {} queries: ~{:.4f} seconds'.format(name, len(records),
+                                                                                           np.mean(errors)))
+        print('Coefficients: {}'.format(', '.join('{} {:.4f}'.format(name, value)
+                                                  for name, value in statistics['coefficients'].items())))
+    if args.cone is not None:
+        planner = QueryPlanner.from_path(args.statistics, objective=args.objective, partition_pruning=args.pruning)
+        plan = get_search_plan(*args.cone)
+        chosen = planner.choose(plan)
+        print('{:<10}{:>7}{:>9}{:>9}{:>14}{:>14}{:>12}'.format('strategy', 'width', 'queries', 'selects', 'scanned MB',
+                                                              'billed MB', 'seconds'))
+        for estimate in planner.estimate(plan):
+            print('{:<10}{:>7}{:>9}{:>9}{:>14.1f}{:>14.1f}{:>12.3f}{}'.format(
+                estimate['strategy'], estimate['width'], len(estimate['queries']),
+                sum(len(query['selects']) for query in estimate['queries']),
+                sum(query['bytes'] for query in estimate['queries'])/1024**2, estimate['billed_bytes']/1024**2,
+                estimate['predicted_seconds'], '  <-' if estimate == chosen else ''))
@@ -0,0 +1,75 @@
+import time
+import boto3
+import argparse
+from athena_orchestrator import run_queries
+from partition_layout import PartitionRouter, partition_columns, load_layout, get_add_partition_queries
+
+parser = argparse.ArgumentParser(description='Register the zoneID/ra partitions of a layout as partition keys of an '
+                                             'Athena table, so that cone_search can prune RA slabs.')
+parser.add_argument('-p', '--profile', default='default', metavar='',
+                    help='Name of the AWS profile to use (default="default").')
+parser.add_argument('region', help='Name of AWS region.')
+parser.add_argument('database', help='Name of Athena Database containing the table.')
+parser.add_argument('workgroup', help='Name of Athena workgroup.')
+parser.add_argument('output_location', help='S3 location where to save query results.')
+parser.add_argument('layout', help='Path to the layout spec written by generate_directory.py.')
+parser.add_argument('location', help='S3 location of the folder containing the zoneID partitions.')
+parser.add_argument('-t', '--table', default='gPhoton_partitioned', metavar='',
+                    help='Name of the table (default=gPhoton_partitioned).')
+parser.add_argument('-c', '--create', action='store_true',
+                    help='Create the table, partitioned by {}, before registering the partitions.'.format(
+                        ' and '.join(name for name, _ in partition_columns)))
+parser.add_argument('-x', '--skyindex', action='store_true',
+                    help='The files have the hpx sky pixel column.')
+parser.add_argument('-b', '--batchsize', default=100, type=int, metavar='',
+                    help='Number of partitions registered per query (default=100).')
+parser.add_argument('-l', '--querylife', default=60, type=int, metavar='',
+                    help='Maximum number of seconds query should be allowed to run before stopping/cancelling (default=60).')
+
+create_query = '''
+              CREATE EXTERNAL TABLE IF NOT EXISTS {} (
+              zoneID INT,
+              time BIGINT,
+              cx DOUBLE,
+              cy DOUBLE,
+              cz DOUBLE,
+              x DOUBLE,
+              y DOUBLE,
+              xa INT,
+              ya INT,
+              q INT,
+              xi DOUBLE,
+              eta DOUBLE,
+              ra DOUBLE,
+              dec DOUBLE,
+              flag TINYINT{}
+              ) PARTITIONED BY ({})
+              STORED AS PARQUET
+              LOCATION '{}'
+              tblproperties ("parquet.compress"="SNAPPY");
+              '''
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    sess = boto3.Session(profile_name=args.profile,
+                         region_name=args.region)
+    athena_client = sess.client('athena')
+    router = PartitionRouter.from_layout('', load_layout(args.layout))
+    location = args.location.rstrip('/') + '/'
+
+    start_time = time.time()
+    if args.create:
+        query = create_query.format(args.table, ',\n              hpx BIGINT' if args.skyindex else '',
+                                    ', '.join('{} {}'.format(name, dtype) for name, dtype in partition_columns),
+                                    location)
+        execution, = run_queries(athena_client, [query], args.database, args.output_location, args.workgroup,
+                                 query_life=args.querylife)
+        assert execution['state'] == 'SUCCEEDED', 'Creating {} failed: {}'.format(args.table, execution['reason'])
+    queries = get_add_partition_queries(router, args.table, location, args.batchsize)
+    executions = run_queries(athena_client, queries, args.database, args.output_location, args.workgroup,
+                             query_life=args.querylife, verbose=False)
+    failed = [execution for execution in executions if execution['state'] != 'SUCCEEDED']
+    print('Registered {} partitions with {} in {} queries (~{:.4f} seconds), {} queries failed'.format(
+        len(router), args.table, len(queries), time.time()-start_time, len(failed)))
+    for execution in failed:
+        print('{}: {}'.format(execution['state'], execution['reason']))
@@ -0,0 +1,185 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cone_search import get_search_plan
+from cone_search_local import get_mask
+from gphoton_schema import header
+
+# columns of Athena results are lower case
+canonical_names = {name.lower(): name for name in header}
+
+
+def get_key(source, ra, dec, radius, time_start, time_end, flag):
+    '''
+    Normalized cone search parameters identifying the results of a query.
+    '''
+    return json.dumps([source, round(float(ra) % 360, 10), round(float(dec), 10), round(float(radius), 10),
+                       int(time_start), int(time_end), int(flag)])
+
+
+def get_separation(ra1, dec1, ra2, dec2):
+    '''
+    Angular distance in degrees between two points, by the haversine formula.
+    '''
+    ra1, dec1, ra2, dec2 = np.radians([ra1, dec1, ra2, dec2])
+    a = np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2
+    return float(np.degrees(2*np.arcsin(np.sqrt(min(a, 1.0)))))
+
+
+def filter_rows(tbl, ra, dec, radius, time_start, time_end, flag):
+    '''
+    Rows of a cached result that a contained query returns, in the same order.
+    '''
+    names = tbl.column_names
+    renamed = tbl.rename_columns([canonical_names.get(name.lower(), name) for name in names])
+    plan = get_search_plan(ra, dec, radius)
+    tables = [renamed.filter(pa.array(get_mask(renamed, plan, ra_range, time_start, time_end, flag)))
+              for ra_range in plan['ra_ranges']]
+    return pa.concat_tables(tables).rename_columns(names)
+
+
+class ResultCache:
+    '''
+    Cone search results saved as PARQUET files in a folder, evicting the least recently used results
+    once they take more than max_bytes.
+
+    A query is answered from the cache when the same query was cached, or when a cached query with
+    the same flag contains its cone and time window, by filtering the cached rows.
+    '''
+    def __init__(self, path, max_bytes=1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.index_path = os.path.join(path, 'index.json')
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index:
+                self.index = json.load(index)
+        else:
+            self.index = {'clock': 0, 'entries': {},
+                          'counters': {'hits': 0, 'contained_hits': 0, 'misses': 0, 'bytes_saved': 0, 'evictions': 0}}
+
+    @property
+    def counters(self):
+        return self.index['counters']
+
+    @property
+    def size(self):
+        return sum(entry['size'] for entry in self.index['entries'].values())
+
+    def save(self):
+        with open(self.index_path + '.tmp', 'w') as index:
+            json.dump(self.index, index, indent=2)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def touch(self, entry):
+        self.index['clock'] += 1
+        entry['last_used'] = self.index['clock']
+
+    def find_container(self, source, ra, dec, radius, time_start, time_end, flag):
+        '''
+        Key of the smallest cached result whose query contains the given one, or None.
+        '''
+        best = None
+        for key, entry in self.index['entries'].items():
+            if entry['source'] != source or entry['flag'] != flag:
+                continue
+            if not entry['time_start'] <= time_start or not time_end <= entry['time_end']:
+                continue
+            # keep a margin so that rounding in the dot-product test cannot matter
+            if get_separation(entry['ra'], entry['dec'], ra, dec) + radius > entry['radius'] - 1e-9:
+                continue
+            if best is None or entry['size'] < self.index['entries'][best]['size']:
+                best = key
+        return best
+
+    def get(self, source, ra, dec, radius, time_start, time_end, flag, as_arrow=False):
+        '''
+        Cached rows of a query, or None if they are not in the cache.
+
+        Parameters
+        ----------
+        source: str
+            name of the data queried, e.g. the Athena database; only results of the same source are used
+        ra, dec, radius, time_start, time_end, flag:
+            parameters of the cone search
+        as_arrow: bool
+            return the pyarrow.Table read instead of converting it to a DataFrame
+
+        Returns
+        -------
+        pandas.DataFrame or pyarrow.Table
+        '''
+        key = get_key(source, ra, dec, radius, time_start, time_end, flag)
+        contained = key not in self.index['entries']
+        if contained:
+            key = self.find_container(source, ra, dec, radius, time_start, time_end, flag)
+        if key is None:
+            self.counters['misses'] += 1
+            self.save()
+            return None
+        entry = self.index['entries'][key]
+        tbl = pq.read_table(os.path.join(self.path, entry['file']))
+        if contained:
+            tbl = filter_rows(tbl, ra, dec, radius, time_start, time_end, flag)
+            self.counters['contained_hits'] += 1
+        else:
+            self.counters['hits'] += 1
+        self.counters['bytes_saved'] += entry['scanned_bytes']
+        self.touch(entry)
+        self.save()
+        return tbl if as_arrow else tbl.to_pandas()
+
+    def put(self, source, ra, dec, radius, time_start, time_end, flag, df, scanned_bytes=None):
+        '''
+        Cache the rows of a query, then evict the least recently used results over max_bytes.
+
+        Parameters
+        ----------
+        df: pandas.DataFrame or pyarrow.Table
+            rows returned by the query
+        scanned_bytes: int
+            bytes the query scanned, counted as saved when the result is used (default: size of the result)
+        '''
+        key = get_key(source, ra, dec, radius, time_start, time_end, flag)
+        file_name = hashlib.sha1(key.encode()).hexdigest() + '.parquet'
+        tbl = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df, preserve_index=False)
+        pq.write_table(tbl, os.path.join(self.path, file_name))
+        size = os.path.getsize(os.path.join(self.path, file_name))
+        entry = {'source': source, 'ra': float(ra) % 360, 'dec': float(dec), 'radius': float(radius),
+                 'time_start': int(time_start), 'time_end': int(time_end), 'flag': int(flag),
+                 'file': file_name, 'size': size,
+                 'scanned_bytes': int(scanned_bytes) if scanned_bytes is not None else size}
+        self.touch(entry)
+        self.index['entries'][key] = entry
+        self.evict(keep=key)
+        self.save()
+
+    def evict(self, keep=None):
+        entries = self.index['entries']
+        for key in sorted(entries, key=lambda x: entries[x]['last_used']):
+            if self.size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            os.remove(os.path.join(self.path, entries.pop(key)['file']))
+            self.counters['evictions'] += 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the counters of a cone search result cache.')
+    parser.add_argument('path', help='Path to folder of the cache.')
+    parser.add_argument('-c', '--clear', action='store_true', help='To remove every cached result.')
+    args = parser.parse_args()
+
+    cache = ResultCache(args.path)
+    if args.clear:
+        cache.max_bytes = 0
+        cache.evict()
+        cache.save()
+    print('{} results, ~{:.2f} MB'.format(len(cache.index['entries']), cache.size/(1024*1024)))
+    for name, value in cache.counters.items():
+        print('{}: {:,}'.format(name, value))
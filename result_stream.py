@@ -0,0 +1,227 @@
+import io
+import os
+import csv
+import time
+import tempfile
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.parquet as pq
+from gphoton_schema import schema, batch_schema, cast_to_schema
+
+# Athena writes the column names of its CSV results in lower case
+csv_column_types = {field.name.lower(): field.type for field in batch_schema}
+
+
+class RangedDownload:
+    '''
+    Download S3 objects with concurrent ranged GETs into memory, in parts of part_size bytes.
+
+    All the parts of all the objects are requested up front from max_workers threads, so the transfer
+    runs ahead of the reader. Parts that arrive before the reader needs them are kept in memory until
+    they take spool_threshold bytes; later parts are spooled to a temporary file until they are read.
+    '''
+    def __init__(self, s3_client, bucket, keys, part_size=8*1024*1024, max_workers=8, spool_threshold=256*1024*1024):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.keys = list(keys)
+        self.spool_threshold = spool_threshold
+        self.lock = threading.Lock()
+        self.buffers = {}
+        self.buffered = 0
+        self.spool = None
+        self.num_spooled = 0
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.sizes = list(self.executor.map(
+            lambda key: s3_client.head_object(Bucket=bucket, Key=key)['ContentLength'], self.keys))
+        self.futures = [[self.executor.submit(self.fetch, key_index, part_index, start, min(start + part_size, size) - 1)
+                         for part_index, start in enumerate(range(0, size, part_size))]
+                        for key_index, size in enumerate(self.sizes)]
+
+    def fetch(self, key_index, part_index, start, end):
+        if self.closed:
+            return
+        data = self.s3_client.get_object(Bucket=self.bucket, Key=self.keys[key_index],
+                                         Range='bytes={}-{}'.format(start, end))['Body'].read()
+        with self.lock:
+            if self.buffered + len(data) > self.spool_threshold:
+                if self.spool is None:
+                    self.spool = tempfile.TemporaryFile()
+                self.spool.seek(0, os.SEEK_END)
+                self.buffers[(key_index, part_index)] = (self.spool.tell(), len(data))
+                self.spool.write(data)
+                self.num_spooled += len(data)
+            else:
+                self.buffers[(key_index, part_index)] = data
+                self.buffered += len(data)
+
+    def iter_chunks(self, key_index):
+        '''
+        Parts of an object, in order, as they arrive.
+        '''
+        for part_index, future in enumerate(self.futures[key_index]):
+            future.result()
+            with self.lock:
+                item = self.buffers.pop((key_index, part_index))
+                if isinstance(item, tuple):
+                    self.spool.seek(item[0])
+                    item = self.spool.read(item[1])
+                else:
+                    self.buffered -= len(item)
+            yield item
+
+    def close(self):
+        self.closed = True
+        for futures in self.futures:
+            for future in futures:
+                future.cancel()
+        self.executor.shutdown(wait=True)
+        if self.spool is not None:
+            self.spool.close()
+        self.buffers.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ChunkReader(io.RawIOBase):
+    '''
+    Read-only file over an iterator of bytes.
+    '''
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset >= len(self.chunk):
+            self.chunk = next(self.chunks, None)
+            self.offset = 0
+            if self.chunk is None:
+                self.chunk = b''
+                return 0
+        size = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:size] = self.chunk[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+def iter_csv_batches(s3_client, bucket, keys, block_size=4*1024*1024, **options):
+    '''
+    Stream the CSV results of queries, parsing them into record batches while the rest downloads.
+
+    Parameters
+    ----------
+    keys: list
+        keys of the CSVs, read in order
+    block_size: int
+        bytes of CSV parsed into each record batch
+    options:
+        part_size, max_workers and spool_threshold of RangedDownload
+
+    Returns
+    -------
+    generator
+        record batches with the columns of the CSVs, renamed from the lower case names Athena writes
+        to the gPhoton names, and typed with the gPhoton dtypes
+    '''
+    with RangedDownload(s3_client, bucket, keys, **options) as download:
+        for key_index, size in enumerate(download.sizes):
+            if not size:
+                continue
+            stream = io.BufferedReader(ChunkReader(download.iter_chunks(key_index)), buffer_size=block_size)
+            reader = pcsv.open_csv(stream, read_options=pcsv.ReadOptions(block_size=block_size),
+                                   convert_options=pcsv.ConvertOptions(column_types=csv_column_types))
+            for batch in reader:
+                yield from cast_to_schema(pa.Table.from_batches([batch])).to_batches()
+
+
+def iter_parquet_batches(s3_client, bucket, keys, **options):
+    '''
+    Stream PARQUET results of queries into record batches, with the gPhoton names and dtypes. A file is
+    read once it is in memory, since its footer comes last, while the next files download.
+    '''
+    with RangedDownload(s3_client, bucket, keys, **options) as download:
+        for key_index in range(len(keys)):
+            parquet_file = pq.ParquetFile(pa.BufferReader(b''.join(download.iter_chunks(key_index))))
+            for batch in parquet_file.iter_batches():
+                yield from cast_to_schema(pa.Table.from_batches([batch])).to_batches()
+
+
+def read_csv_stream(s3_client, bucket, keys, result_schema=schema, **options):
+    '''
+    Table of the CSV results of queries, streamed with iter_csv_batches, or an empty table of
+    result_schema when they have no rows.
+    '''
+    batches = list(iter_csv_batches(s3_client, bucket, keys, **options))
+    if not batches:
+        return result_schema.empty_table()
+    return pa.Table.from_batches(batches)
+
+
+if __name__ == '__main__':
+    import resource
+    import numpy as np
+    import pandas as pd
+    from s3_stub import S3Stub
+    from gphoton_schema import header, header_dtypes
+
+    parser = argparse.ArgumentParser(description='Compare downloading a query result then parsing it with streaming '
+                                                 'it with ranged GETs, against a local S3 stub.')
+    parser.add_argument('-n', '--numrows', default=1000000, type=int, metavar='',
+                        help='Number of rows of the result (default=1,000,000).')
+    parser.add_argument('-b', '--bandwidth', default=50.0, type=float, metavar='',
+                        help='MB per second of one GET from the stub (default=50).')
+    parser.add_argument('-l', '--latency', default=0.02, type=float, metavar='',
+                        help='Seconds of latency of each request to the stub (default=0.02).')
+    parser.add_argument('-w', '--workers', default=8, type=int, metavar='',
+                        help='Number of concurrent ranged GETs (default=8).')
+    parser.add_argument('-s', '--spool', default=256, type=float, metavar='',
+                        help='MB of parts held in memory before spooling to disk (default=256).')
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({name.lower(): rng.integers(0, 100, args.numrows).astype(dtype)
+                       if np.issubdtype(dtype, np.integer) else rng.uniform(-1, 1, args.numrows)
+                       for name, dtype in zip(header, header_dtypes)})
+    df.to_csv(os.path.join(path, 'result.csv'), index=False, quoting=csv.QUOTE_ALL)
+    size = os.path.getsize(os.path.join(path, 'result.csv'))
+    s3_client = S3Stub(path, latency=args.latency, bandwidth=args.bandwidth*1024*1024)
+    print('{:,} rows, CSV of ~{:.1f} MB\n'.format(args.numrows, size/(1024*1024)))
+
+    start = time.time()
+    s3_client.download_file('bucket', 'result.csv', os.path.join(path, 'download.csv'))
+    downloaded = pd.read_csv(os.path.join(path, 'download.csv'), engine='python')
+    elapsed = time.time()-start
+    os.remove(os.path.join(path, 'download.csv'))
+    print('download_file then read_csv: ~{:.4f} seconds'.format(elapsed))
+
+    start = time.time()
+    first = None
+    num_rows = 0
+    batches = []
+    for batch in iter_csv_batches(s3_client, 'bucket', ['result.csv'], max_workers=args.workers,
+                                  spool_threshold=int(args.spool*1024*1024)):
+        first = time.time()-start if first is None else first
+        num_rows += batch.num_rows
+        batches.append(batch)
+    elapsed = time.time()-start
+    print('ranged streaming: ~{:.4f} seconds, first batch after ~{:.4f} seconds'.format(elapsed, first))
+    streamed = pa.Table.from_batches(batches).to_pandas().rename(columns=str.lower)
+    assert num_rows == len(downloaded) == args.numrows
+    # the rows written, which pandas' own float parser can miss by the last bit
+    assert all(np.array_equal(streamed[name].to_numpy(), df[name].to_numpy()) for name in df.columns)
+    print('\nThe streamed rows equal the rows written; peak memory ~{:.1f} MB'.format(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024))
+    os.remove(os.path.join(path, 'result.csv'))
+    os.rmdir(path)
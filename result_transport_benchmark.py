@@ -0,0 +1,150 @@
+import os
+import csv
+import time
+import shutil
+import resource
+import tempfile
+import argparse
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from cone_search import cone_search, read_csv_table, read_parquet_result, write_result
+from cone_search_local import cone_search_local
+from result_stream import read_csv_stream
+from s3_stub import S3Stub
+
+parser = argparse.ArgumentParser(description='Compare the latency and peak memory of CSV, streamed CSV and PARQUET cone '
+                                             'search results, and with --local of the pandas CSV reader they replace.')
+parser.add_argument('ra', type=float, help='RA query parameter.')
+parser.add_argument('dec', type=float, help='DEC query parameter.')
+parser.add_argument('radius', type=float, help='Radius used to determine the zone to be searched.')
+parser.add_argument('timestart', type=int, help='Start time to be searched in query.')
+parser.add_argument('timeend', type=int, help='End time to be searched in query.')
+parser.add_argument('flag', type=int, help='?')
+parser.add_argument('-a', '--athena', nargs=4, default=None, metavar='',
+                    help='Region, database, workgroup and S3 output location to query Athena with.')
+parser.add_argument('-p', '--profile', default='default', metavar='',
+                    help='Name of the AWS profile to use (default="default").')
+parser.add_argument('-l', '--local', default=None, metavar='',
+                    help='Path to the zoneID partitions to serve the results from instead of Athena: the rows of the '
+                         'cone are written once as an Athena CSV and as PARQUET, and only reading them is timed.')
+parser.add_argument('-i', '--numiterations', default=3, type=int, metavar='',
+                    help='Number of times each path is run; the median is reported (default=3).')
+
+
+class LocalS3:
+    '''
+    Stand-in for the S3 client methods used to read query results, serving files of a folder.
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def download_file(self, bucket, key, download_path):
+        shutil.copyfile(os.path.join(self.path, key), download_path)
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {'Contents': [{'Key': os.path.join(Prefix, file)}
+                            for file in sorted(os.listdir(os.path.join(self.path, Prefix)))]}
+
+    def get_object(self, Bucket, Key):
+        return {'Body': open(os.path.join(self.path, Key), 'rb')}
+
+    def delete_objects(self, Bucket, Delete):
+        pass
+
+
+def read_csv_baseline(s3_client, bucket, key, download_path):
+    '''
+    Download the CSV result of a query and read it with the pandas python engine, as cone_search
+    did before reading CSVs into Arrow.
+    '''
+    s3_client.download_file(bucket, key, download_path)
+    df = pd.read_csv(download_path, engine='python')
+    os.remove(download_path)
+    return df
+
+
+def serve_locally(path, args, result_path):
+    '''
+    Write the rows of the cone as Athena writes them: a quoted CSV with lower case column names, and
+    PARQUET files of an UNLOAD.
+    '''
+    df = cone_search_local(args.ra, args.dec, args.radius, args.timestart, args.timeend, args.flag, path)
+    df.columns = [name.lower() for name in df.columns]
+    df.to_csv(os.path.join(result_path, 'result.csv'), index=False, quoting=csv.QUOTE_ALL)
+    os.makedirs(os.path.join(result_path, 'unload'))
+    tbl = pa.Table.from_pandas(df, preserve_index=False)
+    for index, offset in enumerate(range(0, max(tbl.num_rows, 1), 1000000)):
+        pq.write_table(tbl.slice(offset, 1000000), os.path.join(result_path, 'unload', '{:05d}'.format(index)))
+    return len(df)
+
+
+def run_path(task):
+    '''
+    Run one result path in a new process.
+
+    Returns
+    -------
+    tuple
+        (seconds taken, peak memory in MB above the memory of the process when it started)
+    '''
+    result_format, args, result_path, output_path = task
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if args.local is not None:
+        s3_client = LocalS3(result_path)
+        if result_format == 'parquet':
+            write_result(read_parquet_result(s3_client, None, 'unload'), output_path, 'parquet')
+        elif result_format == 'pandas':
+            write_result(read_csv_baseline(s3_client, None, 'result.csv', os.path.join(output_path, 'download.csv')),
+                         output_path, 'csv')
+        elif result_format == 'stream':
+            write_result(read_csv_stream(S3Stub(result_path), None, ['result.csv']), output_path, 'csv')
+        else:
+            write_result(read_csv_table(s3_client, None, 'result.csv', os.path.join(output_path, 'download.csv')),
+                         output_path, 'csv')
+    else:
+        region, database, workgroup, s3_output_location = args.athena
+        cone_search(args.ra, args.dec, args.radius, args.timestart, args.timeend, args.flag,
+                    args.profile, region, s3_output_location, output_path, database, workgroup,
+                    result_format='csv' if result_format == 'stream' else result_format,
+                    streaming=result_format == 'stream')
+    elapsed = time.time()-start
+    return elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)/1024
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert (args.athena is None) != (args.local is None), 'Give either --athena or --local.'
+    result_path = tempfile.mkdtemp()
+    output_path = tempfile.mkdtemp()
+    try:
+        if args.local is not None:
+            num_rows = serve_locally(args.local, args, result_path)
+            print('{:,} rows in the cone; CSV ~{:.1f} MB, PARQUET ~{:.1f} MB\n'.format(
+                num_rows, os.path.getsize(os.path.join(result_path, 'result.csv'))/(1024*1024),
+                sum(os.path.getsize(os.path.join(result_path, 'unload', file))
+                    for file in os.listdir(os.path.join(result_path, 'unload')))/(1024*1024)))
+        results = {}
+        # the baseline reads a CSV already written, so it is only measured with --local
+        result_formats = ['pandas', 'csv', 'stream', 'parquet'] if args.local is not None else ['csv', 'stream', 'parquet']
+        for result_format in result_formats:
+            measurements = []
+            for _ in range(args.numiterations):
+                # a process per run so that the peak memory of each run is its own
+                with mp.Pool(processes=1, maxtasksperchild=1) as pool:
+                    measurements.append(pool.apply(run_path, ((result_format, args, result_path, output_path),)))
+            results[result_format] = np.median(np.array(measurements), axis=0)
+        print('\nRESULTS\n')
+        print('{:<10}{:>12}{:>16}{:>12}'.format('results', 'seconds', 'peak MB', 'speedup'))
+        for result_format, (elapsed, peak) in results.items():
+            speedup = '{:.1f}x'.format(results['pandas'][0]/elapsed) if 'pandas' in results else '-'
+            print('{:<10}{:>12.4f}{:>16.1f}{:>12}'.format(result_format, elapsed, peak, speedup))
+    finally:
+        shutil.rmtree(result_path)
+        shutil.rmtree(output_path)
@@ -0,0 +1,101 @@
+import os
+import io
+import re
+import time
+import shutil
+import threading
+from collections import Counter
+from botocore.exceptions import ClientError
+
+range_pattern = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class S3Stub:
+    '''
+    In-process stand-in for the S3 client methods used to read query results, serving the files of a
+    folder as the objects of any bucket, for testing without AWS.
+
+    Every request waits latency seconds, and a body is read at bandwidth bytes per second per request
+    (default: no limit), like a GET from S3 does.
+    '''
+    def __init__(self, path, latency=0.0, bandwidth=None):
+        self.path = path
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.bytes_sent = 0
+
+    def call(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_path(self, bucket, key):
+        path = os.path.join(self.path, key)
+        if not os.path.isfile(path):
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'The specified key does not exist.'}},
+                              'GetObject')
+        return path
+
+    def send(self, data):
+        with self.lock:
+            self.bytes_sent += len(data)
+        if self.bandwidth:
+            time.sleep(len(data)/self.bandwidth)
+        return data
+
+    def head_object(self, Bucket, Key):
+        self.call('head_object')
+        return {'ContentLength': os.path.getsize(self.get_path(Bucket, Key))}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.call('get_object')
+        path = self.get_path(Bucket, Key)
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        if Range is not None:
+            match = range_pattern.match(Range)
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+        with open(path, 'rb') as stub_file:
+            stub_file.seek(start)
+            data = stub_file.read(max(end - start + 1, 0))
+        return {'ContentLength': len(data), 'Body': io.BytesIO(self.send(data))}
+
+    def download_file(self, bucket, key, download_path):
+        self.call('download_file')
+        with open(self.get_path(bucket, key), 'rb') as stub_file:
+            data = stub_file.read()
+        with open(download_path, 'wb') as download_file:
+            download_file.write(self.send(data))
+
+    def put_object(self, Bucket, Key, Body):
+        self.call('put_object')
+        os.makedirs(os.path.dirname(os.path.join(self.path, Key)) or self.path, exist_ok=True)
+        with open(os.path.join(self.path, Key), 'wb') as stub_file:
+            if hasattr(Body, 'read'):
+                shutil.copyfileobj(Body, stub_file)
+            else:
+                stub_file.write(Body if isinstance(Body, bytes) else Body.encode())
+        return {}
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        self.call('list_objects_v2')
+        folder = os.path.join(self.path, Prefix)
+        if not os.path.isdir(folder):
+            yield {}
+            return
+        yield {'Contents': [{'Key': os.path.join(Prefix, file), 'Size': os.path.getsize(os.path.join(folder, file))}
+                            for file in sorted(os.listdir(folder)) if os.path.isfile(os.path.join(folder, file))]}
+
+    def delete_objects(self, Bucket, Delete):
+        self.call('delete_objects')
+        for item in Delete['Objects']:
+            if os.path.isfile(os.path.join(self.path, item['Key'])):
+                os.remove(os.path.join(self.path, item['Key']))
+        return {}
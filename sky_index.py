@@ -0,0 +1,140 @@
+import numpy as np
+
+# HEALPix order of the nested pixel ids stored in the hpx column (~0.2 arcsec pixels)
+hpx_order = 20
+
+
+def spread_bits(values):
+    '''
+    Move bit i of each value to bit 2i.
+    '''
+    values = values.astype(np.uint64)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def healpix_nest(cx, cy, cz, order=hpx_order):
+    '''
+    HEALPix nested pixel ids of unit vectors (cx, cy, cz).
+
+    Parameters
+    ----------
+    cx, cy, cz: array_like
+        components of the unit vectors, as stored in the gPhoton columns of the same names
+    order: int
+        HEALPix order, nside = 2**order
+
+    Returns
+    -------
+    numpy.ndarray
+        int64 pixel ids
+    '''
+    cx = np.asarray(cx, dtype=np.float64)
+    cy = np.asarray(cy, dtype=np.float64)
+    cz = np.asarray(cz, dtype=np.float64)
+    nside = 1 << order
+    norm = np.sqrt(cx*cx + cy*cy + cz*cz)
+    z = cz/norm
+    za = np.abs(z)
+    tt = np.mod(np.arctan2(cy, cx), 2*np.pi) * (2/np.pi)
+    tt = np.where(tt >= 4, 0, tt)
+    equatorial = za <= 2/3
+
+    # equatorial region
+    temp1 = nside*(0.5 + tt)
+    temp2 = nside*z*0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp = jp >> order
+    ifm = jm >> order
+    face_eq = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix_eq = jm & (nside - 1)
+    iy_eq = nside - (jp & (nside - 1)) - 1
+
+    # polar caps; 1 - |z| from the x, y components keeps precision near the poles
+    ntt = np.minimum(tt.astype(np.int64), 3)
+    tp = tt - ntt
+    one_minus_za = (cx*cx + cy*cy)/(norm*norm)/(1 + za)
+    tmp = nside*np.sqrt(3*one_minus_za)
+    jp_polar = np.minimum((tp*tmp).astype(np.int64), nside - 1)
+    jm_polar = np.minimum(((1 - tp)*tmp).astype(np.int64), nside - 1)
+    north = z >= 0
+    face_polar = np.where(north, ntt, ntt + 8)
+    ix_polar = np.where(north, nside - jm_polar - 1, jp_polar)
+    iy_polar = np.where(north, nside - jp_polar - 1, jm_polar)
+
+    face = np.where(equatorial, face_eq, face_polar).astype(np.uint64)
+    ix = np.where(equatorial, ix_eq, ix_polar)
+    iy = np.where(equatorial, iy_eq, iy_polar)
+    pixels = (face << np.uint64(2*order)) | spread_bits(ix) | (spread_bits(iy) << np.uint64(1))
+    return pixels.astype(np.int64)
+
+
+def get_pixel_size(order):
+    '''
+    Approximate angular size in degrees of the pixels of a HEALPix order.
+    '''
+    return np.degrees(np.sqrt(4*np.pi/(12*4**order)))
+
+
+def cone_ranges(ra, dec, radius, order=hpx_order):
+    '''
+    Ranges of nested pixel ids at order which together cover a cone.
+
+    The cone is covered with pixels of a coarser order, about half the radius in size, found by
+    sampling the cone widened by two pixel sizes on a grid finer than the pixels. Every pixel that
+    overlaps the cone lies inside the widened cone and contains a sample, so the cover never
+    misses a pixel; it can include a few pixels just outside the cone.
+
+    Parameters
+    ----------
+    ra, dec, radius: float
+        center and radius of the cone in degrees
+    order: int
+        HEALPix order of the pixel ids the ranges are expressed in
+
+    Returns
+    -------
+    list
+        sorted, non-overlapping (first, last) pixel ids, both inclusive
+    '''
+    num_pixels = 12*4**order
+    if radius >= 90:
+        return [(0, num_pixels - 1)]
+    cover_order = int(np.clip(np.floor(np.log2(get_pixel_size(0)/max(radius, 1e-9))) + 1, 0, order))
+    pixel_size = get_pixel_size(cover_order)
+    widened = np.radians(min(radius + 2*pixel_size, 180))
+    step = np.radians(pixel_size/6)
+    offsets = np.arange(-widened, widened + step, step)
+    x, y = np.meshgrid(offsets, offsets)
+    rho = np.hypot(x, y)
+    inside = rho <= widened
+    rho, bearing = rho[inside], np.arctan2(x[inside], y[inside])
+
+    # samples at angular distance rho from the center, along bearing measured from north
+    ra, dec = np.radians(ra), np.radians(dec)
+    center = np.array([np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra), np.sin(dec)])
+    north = np.array([-np.sin(dec)*np.cos(ra), -np.sin(dec)*np.sin(ra), np.cos(dec)])
+    east = np.array([-np.sin(ra), np.cos(ra), 0.0])
+    direction = np.outer(np.cos(bearing), north) + np.outer(np.sin(bearing), east)
+    samples = np.outer(np.cos(rho), center) + np.sin(rho)[:, None]*direction
+    pixels = np.unique(healpix_nest(samples[:, 0], samples[:, 1], samples[:, 2], cover_order))
+
+    shift = 2*(order - cover_order)
+    ranges = []
+    for pixel in pixels:
+        first, last = int(pixel) << shift, ((int(pixel) + 1) << shift) - 1
+        if ranges and ranges[-1][1] + 1 == first:
+            ranges[-1] = (ranges[-1][0], last)
+        else:
+            ranges.append((first, last))
+    return ranges
+
+
+def get_range_predicate(ranges, column='hpx'):
+    '''
+    SQL predicate selecting the rows whose pixel id is in one of the ranges.
+    '''
+    return '(' + ' OR '.join('{} BETWEEN {} AND {}'.format(column, first, last) for first, last in ranges) + ')'
@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import functools
+import contextvars
+from collections import defaultdict
+import numpy as np
+
+# spans are written when the path of a trace file is set here, or by enable
+trace_variable = 'GPHOTON_TRACE'
+format_variable = 'GPHOTON_TRACE_FORMAT'
+trace_formats = ('jsonl', 'otlp')
+service_name = 'gphoton'
+
+# the span that spans started in this context are nested in
+current_span = contextvars.ContextVar('current_span', default=None)
+tracer = None
+
+
+class NullSpan:
+    '''
+    Span returned while tracing is disabled, doing nothing.
+    '''
+    def set(self, **attributes):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+null_span = NullSpan()
+
+
+class Span:
+    '''
+    A timed stage of a trace, with attributes such as zoneID, execution_id, bytes and rows. Spans
+    started while it is open, in the same thread or asyncio task, are nested in it.
+    '''
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.start = None
+        self.end = None
+        self.error = None
+        self.token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+        return self
+
+    def __enter__(self):
+        self.token = current_span.set(self)
+        self.start = time.time_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.time_ns()
+        current_span.reset(self.token)
+        if exc_type is not None:
+            self.error = '{}: {}'.format(exc_type.__name__, exc_value)
+        self.tracer.emit(self)
+        return False
+
+
+class Tracer:
+    '''
+    Write ended spans to a file, one per line, as flat JSON records (jsonl) or as OTLP/JSON trace
+    requests (otlp), the format of the OpenTelemetry file exporter, which collectors can ingest.
+
+    The file is appended to, and opened again after a fork, so the processes of a pool write to the
+    same trace.
+    '''
+    def __init__(self, path, trace_format='jsonl'):
+        if trace_format not in trace_formats:
+            raise ValueError('Unknown trace format {}'.format(trace_format))
+        self.path = path
+        self.trace_format = trace_format
+        self.lock = threading.Lock()
+        self.file = None
+        self.pid = None
+
+    def emit(self, span):
+        record = self.to_otlp(span) if self.trace_format == 'otlp' else self.to_record(span)
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            if self.pid != os.getpid():
+                self.file = open(self.path, 'a')
+                self.pid = os.getpid()
+            self.file.write(line)
+            self.file.flush()
+
+    def to_record(self, span):
+        record = {
+            'trace_id': span.trace_id,
+            'span_id': span.span_id,
+            'parent_id': span.parent_id,
+            'name': span.name,
+            'start': span.start/1e9,
+            'seconds': (span.end - span.start)/1e9,
+            'pid': os.getpid(),
+            'attributes': span.attributes
+        }
+        if span.error is not None:
+            record['error'] = span.error
+        return record
+
+    def to_otlp(self, span):
+        status = {'code': 2, 'message': span.error} if span.error is not None else {'code': 1}
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 1,
+            'startTimeUnixNano': str(span.start),
+            'endTimeUnixNano': str(span.end),
+            'attributes': [get_otlp_attribute(key, value) for key, value in span.attributes.items()],
+            'status': status
+        }
+        if span.parent_id is not None:
+            otlp_span['parentSpanId'] = span.parent_id
+        return {'resourceSpans': [{
+            'resource': {'attributes': [get_otlp_attribute('service.name', service_name),
+                                        get_otlp_attribute('process.pid', os.getpid())]},
+            'scopeSpans': [{'scope': {'name': service_name}, 'spans': [otlp_span]}]
+        }]}
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and self.pid == os.getpid():
+                self.file.close()
+            self.file = None
+            self.pid = None
+
+
+def get_otlp_attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, (int, np.integer)):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, (float, np.floating)):
+        return {'key': key, 'value': {'doubleValue': float(value)}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+
+def enable(path, trace_format='jsonl'):
+    '''
+    Trace to the file at path, in trace_format (jsonl or otlp), from now on.
+    '''
+    global tracer
+    if tracer is not None:
+        tracer.close()
+    tracer = Tracer(path, trace_format)
+    return tracer
+
+
+def disable():
+    global tracer
+    if tracer is not None:
+        tracer.close()
+    tracer = None
+
+
+def span(name, **attributes):
+    '''
+    Context manager timing a stage named name, nested in the span open in this context. While
+    tracing is disabled this returns a shared span doing nothing, so instrumented code pays a
+    function call per stage.
+    '''
+    if tracer is None:
+        return null_span
+    return Span(tracer, name, current_span.get(), attributes)
+
+
+def current():
+    '''
+    The span open in this context, to set attributes of, or a span doing nothing.
+    '''
+    if tracer is None:
+        return null_span
+    return current_span.get() or null_span
+
+
+def traced(name):
+    '''
+    Decorator running a function in a span named name when tracing is enabled.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if tracer is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_span(name, start, end, parent=None, **attributes):
+    '''
+    Emit a span of a stage timed elsewhere, such as the queueing of a query by Athena, from start
+    to end in seconds since the epoch, nested in parent or else in the span open in this context.
+
+    Returns
+    -------
+    Span
+        the span emitted, to nest other recorded spans in, or None while tracing is disabled
+    '''
+    if tracer is None:
+        return None
+    stage = Span(tracer, name, parent if parent is not None else current_span.get(), attributes)
+    stage.start, stage.end = int(start*1e9), int(end*1e9)
+    tracer.emit(stage)
+    return stage
+
+
+def bind(function):
+    '''
+    Function running function with the current span as its parent, for calls from other threads,
+    which do not share the context of this one.
+    '''
+    if tracer is None:
+        return function
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return run
+
+
+def read_trace(path):
+    '''
+    Spans of a trace file of either format, as flat records.
+    '''
+    records = []
+    with open(path) as trace:
+        for line in trace:
+            record = json.loads(line)
+            if 'resourceSpans' not in record:
+                records.append(record)
+                continue
+            for resource_spans in record['resourceSpans']:
+                for scope_spans in resource_spans['scopeSpans']:
+                    for otlp_span in scope_spans['spans']:
+                        attributes = {}
+                        for attribute in otlp_span.get('attributes', []):
+                            value = next(iter(attribute['value'].values()))
+                            attributes[attribute['key']] = (int(value) if 'intValue' in attribute['value']
+                                                            else value)
+                        records.append({
+                            'trace_id': otlp_span['traceId'],
+                            'span_id': otlp_span['spanId'],
+                            'parent_id': otlp_span.get('parentSpanId'),
+                            'name': otlp_span['name'],
+                            'start': int(otlp_span['startTimeUnixNano'])/1e9,
+                            'seconds': (int(otlp_span['endTimeUnixNano']) - int(otlp_span['startTimeUnixNano']))/1e9,
+                            'attributes': attributes
+                        })
+    return records
+
+
+def summarize_trace(records):
+    '''
+    Count, total and percentiles of the seconds of the spans of each name, with the rows and bytes
+    they recorded, to attribute tail latency to a stage.
+    '''
+    stages = defaultdict(list)
+    for record in records:
+        stages[record['name']].append(record)
+    summary = {}
+    for name, stage_records in stages.items():
+        seconds = [record['seconds'] for record in stage_records]
+        summary[name] = {
+            'count': len(seconds),
+            'total': float(np.sum(seconds)),
+            'p50': float(np.percentile(seconds, 50)),
+            'p95': float(np.percentile(seconds, 95)),
+            'p99': float(np.percentile(seconds, 99)),
+            'max': float(np.max(seconds)),
+            'rows': sum(record['attributes'].get('rows', 0) for record in stage_records),
+            'bytes': sum(record['attributes'].get('bytes', 0) for record in stage_records)
+        }
+    return summary
+
+
+if os.environ.get(trace_variable):
+    enable(os.environ[trace_variable], os.environ.get(format_variable, 'jsonl'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the stages of a trace file.')
+    parser.add_argument('path', nargs='?', default=None,
+                        help='Trace file, JSON lines or OTLP/JSON (default: trace a demo and time the disabled spans).')
+    args = parser.parse_args()
+
+    if args.path is None:
+        # the cost of the spans of instrumented code when tracing is disabled
+        disable()
+        num_spans = 1000000
+        start_time = time.perf_counter()
+        for _ in range(num_spans):
+            with span('stage', rows=1) as stage:
+                stage.set(bytes=1)
+        print('Disabled span: ~{:.0f} ns'.format((time.perf_counter() - start_time)/num_spans*1e9))
+
+        import tempfile
+        from concurrent.futures import ThreadPoolExecutor
+
+        def fetch(index):
+            with span('fetch', rows=index):
+                time.sleep(0.01)
+
+        for trace_format in trace_formats:
+            path = os.path.join(tempfile.mkdtemp(), 'trace.' + trace_format)
+            enable(path, trace_format)
+            with span('search', ra=323.5) as search:
+                with span('query', zoneID=10829, execution_id='demo') as query:
+                    record_span('queue', time.time() - 0.2, time.time() - 0.1)
+                    query.set(bytes=10*1024*1024)
+                with ThreadPoolExecutor(2) as executor:
+                    list(executor.map(bind(fetch), range(4)))
+                search.set(rows=6)
+            disable()
+            records = read_trace(path)
+            assert len({record['trace_id'] for record in records}) == 1
+            assert sum(record['parent_id'] is None for record in records) == 1
+            assert all(record['parent_id'] == search.span_id for record in records if record['name'] == 'fetch')
+            print('{}: {} spans in {}'.format(trace_format, len(records), path))
+        sys.exit(0)
+
+    summary = summarize_trace(read_trace(args.path))
+    print('{:<32}{:>8}{:>12}{:>10}{:>10}{:>10}{:>10}{:>14}{:>14}'.format(
+        'stage', 'count', 'total s', 'p50 s', 'p95 s', 'p99 s', 'max s', 'rows', 'MB'))
+    for name, stage in sorted(summary.items(), key=lambda item: -item[1]['total']):
+        print('{:<32}{:>8}{:>12.3f}{:>10.4f}{:>10.4f}{:>10.4f}{:>10.4f}{:>14}{:>14.1f}'.format(
+            name, stage['count'], stage['total'], stage['p50'], stage['p95'], stage['p99'], stage['max'],
+            stage['rows'], stage['bytes']/1e6))